@@ -0,0 +1,440 @@
+import os, sys, json, time, base64, signal, socket, asyncio, hashlib, argparse, threading
+from functools import partial
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+# only the standard library and these light modules are imported at startup; LangChain, Chroma and the
+# OpenAI client come in with `model` and `jobs` when `ReaderService.get` first runs
+from tracing import tracer, Span
+from prompts import DEFAULT_TEMPLATES
+
+
+MAX_HEADERS = 100
+ROUTES = ("health", "metrics", "load", "ask", "estimate", "summarize", "translate", "jobs")
+STATUS_TEXT = {
+    200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+
+class HTTPError(Exception):
+    """ Raised by a handler to answer with an error status. """
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+# * The pipeline behind the API
+
+class ReaderService(object):
+    """ The `DocumentReader` and `JobManager` of a worker process, built on first use (see `warm_up`). """
+    def __init__(self, args, resume=True):
+        self.args = args
+        self.resume = resume            # restart the jobs a previous process left running (one worker does)
+        self.lock = threading.Lock()
+        self.doc_reader, self.jobs = None, None
+        self.ready = threading.Event()
+
+    def warm_up(self):
+        threading.Thread(target=self.get, name="warm-up", daemon=True).start()
+
+    def get(self):
+        """ This function returns the document reader and the job manager, building them if needed. """
+        with self.lock:
+            if self.jobs is None:
+                from model import DocumentReader
+                from scheduler import FairLane
+                from jobs import JobManager
+
+                args, limits = self.args, {}
+                if args.fake_latency is not None:
+                    # (no OpenAI rate limits to respect either, as in benchmark.py)
+                    from backends import FakeBackend
+                    limits = dict(
+                        backend=FakeBackend(latency=args.fake_latency),
+                        requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12,
+                        embedding_requests_per_minute=10 ** 9, embedding_tokens_per_minute=10 ** 12,
+                        )
+                self.doc_reader = DocumentReader(
+                    db_dir=args.db_dir, **limits,
+                    embedding_model=args.embedding_model,
+                    max_concurrency=args.max_concurrency,
+                    trace_path=args.trace_file or None,
+                    max_store_bytes=int(args.store_gb * (1 << 30)) if args.store_gb else None,
+                    )
+                tracer.add_collector(self.doc_reader.metrics)
+                # summaries share their workers fairly between users, as in the web UI
+                self.jobs = JobManager(self.doc_reader, max_jobs=args.max_jobs, lane=FairLane(args.summarize_workers))
+                if self.resume:
+                    self.jobs.resume()
+                self.ready.set()
+        return self.doc_reader, self.jobs
+
+    def document(self, body):
+        """ This function returns (doc_path, text, document_name) of the pasted, uploaded or (with --allow-paths) server-side document of a request. """
+        if body.get('text'):
+            return None, body['text'], body.get('document_name')
+        if body.get('content') is not None:
+            filename = os.path.basename(body.get('filename') or "document.txt")
+            data = base64.b64decode(body['content'], validate=True)
+            folder = os.path.join(self.args.db_dir, "uploads", hashlib.sha256(data).hexdigest()[:16])
+            doc_path = os.path.join(folder, filename)
+            if not os.path.exists(doc_path):
+                os.makedirs(folder, exist_ok=True)
+                tmp_path = "{}.{}.tmp".format(doc_path, os.getpid())
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, doc_path)
+            return doc_path, None, body.get('document_name') or filename
+        if body.get('path'):
+            if not self.args.allow_paths:
+                raise HTTPError(400, "Reading files on the server is disabled (see --allow-paths)")
+            if not os.path.isfile(body['path']):
+                raise FileNotFoundError(body['path'])
+            return body['path'], None, body.get('document_name')
+        raise ValueError("No document: give 'text', 'filename' and 'content', or 'path'")
+
+    # * Blocking operations, run in the request threads
+
+    def load(self, body):
+        doc_reader, _ = self.get()
+        doc_path, text, _ = self.document(body)
+        templates = dict(DEFAULT_TEMPLATES, **body.get('templates', {}))
+        chunks, retriever = doc_reader.load(
+            doc_path, text,
+            chunk_size=doc_reader.ask_chunk_size(doc_path, text, body.get('chunk_size'), body.get('chunk_overlap'), templates=templates),
+            chunk_overlap=body.get('chunk_overlap'),
+            )
+        return {'key': retriever.key, 'chunks': len(chunks)}
+
+    def ask(self, body):
+        doc_reader, _ = self.get()
+        doc_path, text, _ = self.document(body)
+        if not body.get('query'):
+            raise ValueError("No query")
+        templates = dict(DEFAULT_TEMPLATES, **body.get('templates', {}))
+        chunks, retriever = doc_reader.load(
+            doc_path, text,
+            chunk_size=doc_reader.ask_chunk_size(doc_path, text, body.get('chunk_size'), body.get('chunk_overlap'), templates=templates),
+            chunk_overlap=body.get('chunk_overlap'),
+            )
+        answer, source_chunks = doc_reader.ask(
+            body['query'], retriever, templates,
+            temperature=body.get('temperature', 0.0), max_tokens=body.get('max_tokens', 1000),
+            retrieval=body.get('retrieval'),
+            )
+        return {
+            'answer': answer,
+            'sources': [{'chunk_id': chunk.metadata.get('chunk_id'), 'content': chunk.page_content} for chunk in source_chunks],
+        }
+
+    def estimate(self, body):
+        doc_reader, _ = self.get()
+        doc_path, text, _ = self.document(body)
+        templates = dict(DEFAULT_TEMPLATES, **body.get('templates', {}))
+        return doc_reader.plan(
+            doc_path, text, templates,
+            summary_option=body.get('summary_option', "map_reduce"),
+            chunk_size=body.get('chunk_size'), max_tokens=body.get('max_tokens', 1000),
+            )
+
+    def submit(self, body, user):
+        _, jobs = self.get()
+        doc_path, text, document_name = self.document(body)
+        return jobs.submit(
+            doc_path, text, dict(DEFAULT_TEMPLATES, **body.get('templates', {})),
+            summary_option=body.get('summary_option', "map_reduce"),
+            chunk_size=body.get('chunk_size'), chunk_overlap=body.get('chunk_overlap', 0),
+            temperature=body.get('temperature', 0.0), max_tokens=body.get('max_tokens', 1000),
+            translate_context_tokens=body.get('translate_context_tokens', 0),
+            refine_segments=body.get('refine_segments'), refine_target_seconds=body.get('refine_target_seconds'),
+            pack=bool(body.get('pack', False)), user=body.get('user') or user,
+            document_name=document_name,
+            )
+
+    def job(self, job_id):
+        _, jobs = self.get()
+        job = jobs.get(job_id) if job_id.isalnum() else None
+        if job is None:
+            raise FileNotFoundError(job_id)
+        return job
+
+    def describe(self, job, result=False):
+        """ This function reports a job; `result` adds its total and section summaries once it is done. """
+        _, jobs = self.get()
+        report = {
+            'job_id': job.job_id, 'status': job.status, 'error': job.error,
+            'progress': job.progress, 'description': job.describe(), 'breakdown': jobs.breakdown(job),
+        }
+        if result and job.status == "done":
+            total_summary, chunk_summaries, section_summaries = jobs.load_result(job)
+            report.update(total_summary=total_summary, section_summaries=section_summaries, chunks=len(chunk_summaries))
+        return report
+
+    def rows(self, job_id, start=0, limit=50):
+        """ This function returns a page of the (chunk, summary) rows of a job, reading that page only. """
+        _, jobs = self.get()
+        _, chunk_summaries, _ = jobs.load_result(self.job(job_id))
+        return {'total': len(chunk_summaries), 'start': start, 'rows': list(chunk_summaries[start:start + limit])}
+
+    def cancel(self, job_id):
+        _, jobs = self.get()
+        return self.describe(jobs.cancel(self.job(job_id).job_id))
+
+
+# * HTTP/1.1 on asyncio
+
+class APIServer(object):
+    """ JSON API over a `ReaderService`, answering 503 with Retry-After beyond `max_requests` running and `max_queue` waiting requests. """
+    def __init__(self, service, max_requests=32, max_queue=256, max_body_bytes=64 << 20, poll_interval=1.0):
+        self.service = service
+        self.poll_interval = poll_interval
+        self.max_requests = max_requests
+        self.max_queue = max_queue
+        self.max_body_bytes = max_body_bytes
+        self.executor = ThreadPoolExecutor(max_workers=max_requests, thread_name_prefix="api")
+        self.slots = asyncio.Semaphore(max_requests)
+        self.admitted = 0               # requests running or waiting for a slot
+        tracer.add_collector(lambda: {'api_requests_admitted': self.admitted})
+
+    async def blocking(self, function, *args):
+        """ This function runs a pipeline call in the request threads, refusing it if too many are pending. """
+        if self.admitted >= self.max_requests + self.max_queue:
+            raise HTTPError(503, "Too many requests, try again", {'Retry-After': "1"})
+        self.admitted += 1
+        try:
+            async with self.slots:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args))
+        finally:
+            self.admitted -= 1
+
+    # * Endpoints
+
+    async def route(self, method, path, query, body, peer):
+        """ This function answers one request with (status, content type, payload). """
+        parts = [part for part in path.split("/") if part]
+        if parts == ["health"]:
+            return 200, None, {'status': "ok", 'ready': self.service.ready.is_set(), 'pid': os.getpid()}
+        if parts == ["metrics"]:
+            return 200, "text/plain; version=0.0.4; charset=utf-8", tracer.render_metrics()
+
+        if method == "POST" and parts == ["load"]:
+            return 200, None, await self.blocking(self.service.load, body)
+        if method == "POST" and parts == ["ask"]:
+            return 200, None, await self.blocking(self.service.ask, body)
+        if method == "POST" and parts == ["estimate"]:
+            return 200, None, await self.blocking(self.service.estimate, body)
+        if method == "POST" and parts in (["summarize"], ["translate"]):
+            if parts == ["translate"]:
+                body = dict(body, summary_option="translate")
+            job = await self.blocking(self.service.submit, body, peer)
+            if not body.get('wait'):
+                return 202, None, self.service.describe(job)
+            while job.status in ("queued", "running"):
+                if job.future is not None:
+                    await asyncio.wrap_future(job.future)
+                    break
+                # (the same job runs in another worker: follow its job file until it is done, failed or cancelled)
+                await asyncio.sleep(self.poll_interval)
+                job = self.service.job(job.job_id)
+            return 200, None, await self.blocking(self.service.describe, job, True)
+
+        if len(parts) >= 2 and parts[0] == "jobs":
+            if method == "GET" and len(parts) == 2:
+                job = await self.blocking(self.service.job, parts[1])
+                return 200, None, await self.blocking(self.service.describe, job, True)
+            if method == "GET" and parts[2:] == ["rows"]:
+                start, limit = int(query.get('start', 0)), min(int(query.get('limit', 50)), 1000)
+                return 200, None, await self.blocking(self.service.rows, parts[1], max(start, 0), max(limit, 0))
+            if method == "DELETE" and len(parts) == 2:
+                return 200, None, await self.blocking(self.service.cancel, parts[1])
+
+        raise HTTPError(405 if parts and parts[0] in ROUTES else 404, "{} {}".format(method, path))
+
+    async def respond(self, method, path, query, body, peer):
+        """ This function runs a request, turning errors into JSON answers, and records it as a span. """
+        start = time.perf_counter()
+        try:
+            status, content_type, payload = await self.route(method, path, query, body, peer)
+            headers = {}
+        except HTTPError as e:
+            status, content_type, payload, headers = e.status, None, {'error': str(e)}, e.headers
+        except FileNotFoundError as e:
+            status, content_type, payload, headers = 404, None, {'error': "Not found: {}".format(e)}, {}
+        except (ValueError, KeyError, TypeError) as e:
+            status, content_type, payload, headers = 400, None, {'error': repr(e)}, {}
+        except Exception as e:
+            status, content_type, payload, headers = 500, None, {'error': repr(e)}, {}
+        # (recorded directly: the spans of concurrent requests interleave on the event loop thread)
+        route = path.strip("/").split("/")[0]
+        span = Span("api_" + (route if route in ROUTES else "other"), {'method': method, 'status': status})
+        tracer.record(span, time.perf_counter() - start)
+        if content_type is None:
+            content_type, payload = "application/json", json.dumps(payload, ensure_ascii=False, default=str)
+        return status, content_type, payload.encode('utf-8'), headers
+
+    async def read_request(self, reader):
+        """ This function reads one request as (method, target, headers, body), or None at the end of the connection. """
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        headers = {'http-version': version}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) > MAX_HEADERS:
+                raise HTTPError(400, "Too many headers")
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if 'transfer-encoding' in headers:
+            raise HTTPError(411, "Chunked requests are not supported, send a Content-Length")
+        length = int(headers.get('content-length') or 0)
+        if length > self.max_body_bytes:
+            raise HTTPError(413, "Request body over {} bytes".format(self.max_body_bytes))
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), target, headers, body
+
+    async def handle(self, reader, writer):
+        """ This function serves the requests of one connection, kept alive between them. """
+        peer = (writer.get_extra_info('peername') or ("local",))[0]
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    method, target, headers, raw = request
+                    if headers['http-version'] == "HTTP/1.1":
+                        keep_alive = headers.get('connection', "").lower() != "close"
+                    else:
+                        keep_alive = headers.get('connection', "").lower() == "keep-alive"
+                    url = urlsplit(target)
+                    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                    body = json.loads(raw) if raw.strip() else {}
+                    if not isinstance(body, dict):
+                        raise HTTPError(400, "The body must be a JSON object")
+                except HTTPError as e:
+                    status, content_type, payload, extra = e.status, "application/json", json.dumps({'error': str(e)}).encode('utf-8'), {}
+                    keep_alive = False
+                except ValueError as e:
+                    status, content_type, payload, extra = 400, "application/json", json.dumps({'error': repr(e)}).encode('utf-8'), {}
+                    keep_alive = False
+                else:
+                    status, content_type, payload, extra = await self.respond(method, url.path, query, body, peer)
+
+                head = ["HTTP/1.1 {} {}".format(status, STATUS_TEXT.get(status, ""))]
+                head += ["Content-Type: " + content_type, "Content-Length: {}".format(len(payload))]
+                head += ["{}: {}".format(name, value) for name, value in extra.items()]
+                head.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass        # the client went away
+        finally:
+            writer.close()
+
+
+# * Worker processes
+
+async def serve(sock, args, resume=True):
+    """ This function serves the API on a bound socket until SIGINT/SIGTERM. """
+    service = ReaderService(args, resume=resume)
+    server = APIServer(
+        service, max_requests=args.max_requests, max_queue=args.max_queue,
+        max_body_bytes=int(args.max_body_mb * (1 << 20)),
+        )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    listener = await asyncio.start_server(server.handle, sock=sock)
+    service.warm_up()
+    async with listener:
+        await stop.wait()
+
+def run_worker(sock, args, resume=True):
+    """ This function runs one worker process and exits it, leaving running jobs to be resumed from their checkpoints. """
+    asyncio.run(serve(sock, args, resume))
+    sys.stdout.flush()
+    os._exit(0)
+
+def prefork(sock, args):
+    """ This function runs `args.workers` worker processes on one listening socket, restarting the ones that crash. """
+    children, stopping = {}, []
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            run_worker(sock, args, resume=index == 0)
+        children[pid] = (index, time.time())
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(args.workers):
+        spawn(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started = children.pop(pid)
+        if not stopping:
+            print(f"[worker {index}] pid {pid} exited with status {status}, restarting")
+            if time.time() - started < 1.0:
+                time.sleep(1.0)     # do not spin on a worker that fails at startup
+            spawn(index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPT-Book Reader HTTP API (JSON, no UI)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes sharing the port and the db directory")
+    parser.add_argument("--db-dir", default="db")
+    parser.add_argument("--max-requests", type=int, default=32, help="Requests a worker runs at once")
+    parser.add_argument("--max-queue", type=int, default=256, help="Requests a worker lets wait before answering 503")
+    parser.add_argument("--max-body-mb", type=float, default=64, help="Largest request body (uploads are base64)")
+    parser.add_argument("--max-jobs", type=int, default=16, help="Summary jobs queued or running at once, per worker")
+    parser.add_argument("--summarize-workers", type=int, default=2, help="Summaries running at once, per worker")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="LLM calls at once, per worker")
+    parser.add_argument("--embedding-model", default="text-embedding-ada-002", help='OpenAI embedding model, or "local:<model>" to embed on the CPU')
+    parser.add_argument("--store-gb", type=float, default=None, help="Disk quota of the document collections (least recently used evicted first)")
+    parser.add_argument("--trace-file", default=None, help="JSON lines file of the per-stage spans")
+    parser.add_argument("--allow-paths", action="store_true", help="Let requests name files on the server by 'path'")
+    parser.add_argument("--fake-latency", type=float, default=None, help="Answer with backends.FakeBackend at this latency per call (load tests, no OpenAI calls)")
+    args = parser.parse_args()
+
+    # * Bind before anything else, so the port answers (/health) within a fraction of a second
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    sock.set_inheritable(True)
+    print(f"API http://{args.host}:{args.port} ({args.workers} worker{'s' if args.workers > 1 else ''})")
+    sys.stdout.flush()
+
+    if args.workers > 1 and hasattr(os, "fork"):
+        prefork(sock, args)
+    else:
+        run_worker(sock, args)
+
+
+if __name__ == "__main__":
+    main()
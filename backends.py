@@ -0,0 +1,367 @@
+import os, re, time, random, hashlib, threading
+from collections import OrderedDict
+
+import numpy as np
+
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.schema import HumanMessage
+from langchain.callbacks.base import CallbackManager
+from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+
+
+class ChatModel(object):
+    """ A chat model bound to its sampling settings; `complete` returns the completion and passes each token to `on_token`. """
+    def __init__(self, model_name, temperature=0.0, max_tokens=None):
+        self.model_name = model_name
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+    def complete(self, prompt, on_token=None):
+        raise NotImplementedError
+
+
+class Backend(object):
+    """ The model services a `DocumentReader` talks to: a chat model and an embedding model. """
+    model_name = None
+    embedding_model = None
+    context_window = 4096       # prompt + completion tokens the chat model accepts
+
+    def chat(self, temperature=0.0, max_tokens=None):
+        """ Return a `ChatModel` with these sampling settings. """
+        raise NotImplementedError
+
+    def embeddings(self):
+        """ Return a LangChain `Embeddings` object for `embedding_model`. """
+        raise NotImplementedError
+
+
+class ClientRegistry(object):
+    """ Long-lived, thread-safe LRU of built objects (chat models, embeddings, prompts), keyed by everything they are built from. """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.counts = {'hits': 0, 'misses': 0}
+
+    def get(self, key, factory):
+        """ Return the object for `key`, building it with `factory()` on a miss. """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counts['hits'] += 1
+                return self.entries[key]
+            self.counts['misses'] += 1
+        value = factory()
+        with self.lock:
+            # another thread may have built it meanwhile; keep the first one
+            value = self.entries.setdefault(key, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, kind=None):
+        """ Drop every entry whose key starts with `kind`, or all entries. """
+        with self.lock:
+            for key in [key for key in self.entries if kind is None or key[0] == kind]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, size=len(self.entries))
+
+
+# * OpenAI
+
+def make_http_session(pool_connections=4, pool_maxsize=32, max_retries=0):
+    """ A requests session with a keep-alive connection pool of `pool_maxsize` connections per host. """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=max_retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# clients global to the process, such as the HTTP session the `openai` module sends every request through
+PROCESS_CLIENTS = ClientRegistry()
+
+def install_http_session(pool_maxsize=32):
+    """ This function installs one pooled session as `openai.requestssession`, once per process, and returns it. """
+    import openai
+
+    session = PROCESS_CLIENTS.get(('http_session',), lambda: make_http_session(pool_maxsize=pool_maxsize))
+    openai.requestssession = session
+    return session
+
+CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+}
+
+def context_window(model_name, default=4096):
+    """ The context window of an OpenAI chat model, matching dated snapshots (e.g. gpt-4-0314) by prefix. """
+    for name in sorted(CONTEXT_WINDOWS, key=len, reverse=True):
+        if model_name.startswith(name):
+            return CONTEXT_WINDOWS[name]
+    return default
+
+class TokenCallbackHandler(StreamingStdOutCallbackHandler):
+    """ Callback handler that passes streamed tokens to the `on_token` of the calling thread. """
+    def __init__(self):
+        self.local = threading.local()
+
+    @property
+    def always_verbose(self):
+        return True
+
+    def on_llm_new_token(self, token, **kwargs):
+        on_token = getattr(self.local, 'on_token', None)
+        if on_token is not None:
+            on_token(token)
+
+
+class OpenAIChatModel(ChatModel):
+    """ Chat model served by the OpenAI chat completions API; retries are left to the caller. """
+    def __init__(self, model_name, temperature=0.0, max_tokens=None):
+        super().__init__(model_name, temperature, max_tokens)
+        self.llm = self._llm()
+        self.tokens = TokenCallbackHandler()
+        self.streaming_llm = self._llm(self.tokens)
+
+    def _llm(self, callback_handler=None):
+        return ChatOpenAI(
+            model_name=self.model_name,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            max_retries=1,
+            streaming=callback_handler is not None,
+            callback_manager=CallbackManager([callback_handler]) if callback_handler else None,
+            )
+
+    def complete(self, prompt, on_token=None):
+        if on_token is None:
+            result = self.llm.generate([[HumanMessage(content=prompt)]])
+            return result.generations[0][0].text
+
+        self.tokens.local.on_token = on_token
+        try:
+            result = self.streaming_llm.generate([[HumanMessage(content=prompt)]])
+        finally:
+            self.tokens.local.on_token = None
+        return result.generations[0][0].text
+
+
+class OpenAIBackend(Backend):
+    """ OpenAI chat and embedding models, sharing one pooled keep-alive HTTP session per process. """
+    def __init__(self, model_name='gpt-3.5-turbo', embedding_model='text-embedding-ada-002', http_pool_size=32):
+        self.model_name = model_name
+        self.embedding_model = embedding_model
+        self.context_window = context_window(model_name)
+        self.session = install_http_session(pool_maxsize=http_pool_size)
+
+    def chat(self, temperature=0.0, max_tokens=None):
+        return OpenAIChatModel(self.model_name, temperature, max_tokens)
+
+    def embeddings(self):
+        return OpenAIEmbeddings(model=self.embedding_model)
+
+
+# * Local CPU embeddings
+
+LOCAL_PREFIX = "local:"     # embedding model names with this prefix are computed locally, e.g. "local:intfloat/multilingual-e5-small"
+DEFAULT_LOCAL_EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+class LocalEmbeddings(Embeddings):
+    """ Sentence embeddings computed on the CPU with ONNX Runtime or sentence-transformers, in length-bucketed batches. """
+    def __init__(self, model_name=DEFAULT_LOCAL_EMBEDDING_MODEL, batch_size=64, max_batch_tokens=8192, max_length=256, threads=None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_length = max_length
+        self.threads = threads or os.cpu_count() or 1
+        self.lock = threading.Lock()
+        self.tokenizer, self.session, self.model = None, None, None
+
+    def _load(self):
+        with self.lock:
+            if self.tokenizer is not None:
+                return
+            onnx_path = os.path.join(self.model_name, "model.onnx")
+            if os.path.exists(onnx_path):
+                import onnxruntime
+                from transformers import AutoTokenizer
+
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads = self.threads
+                self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            else:
+                import torch
+                from sentence_transformers import SentenceTransformer
+
+                torch.set_num_threads(self.threads)
+                self.model = SentenceTransformer(self.model_name, device="cpu")
+                self.tokenizer = self.model.tokenizer
+                self.max_length = min(self.max_length, self.model.max_seq_length)
+
+    def _batches(self, lengths):
+        """ Cut text positions, shortest first, into batches under the size limits. """
+        batch, longest = [], 0
+        for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+            longest = max(longest, lengths[i])
+            if batch and (len(batch) >= self.batch_size or (len(batch) + 1) * longest > self.max_batch_tokens):
+                yield batch
+                batch, longest = [], lengths[i]
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def _encode(self, ids):
+        """ Embed a batch of token id lists into an (n, dim) float32 array. """
+        width = max(len(row) for row in ids)
+        features = {
+            'input_ids': np.zeros((len(ids), width), dtype=np.int64),
+            'attention_mask': np.zeros((len(ids), width), dtype=np.int64),
+        }
+        for row, token_ids in enumerate(ids):
+            features['input_ids'][row, :len(token_ids)] = token_ids
+            features['attention_mask'][row, :len(token_ids)] = 1
+        if 'token_type_ids' in self.tokenizer.model_input_names:
+            features['token_type_ids'] = np.zeros_like(features['input_ids'])
+
+        if self.session is not None:
+            names = [node.name for node in self.session.get_inputs()]
+            output = self.session.run(None, {name: features[name] for name in names if name in features})[0]
+            if output.ndim == 3:
+                mask = features['attention_mask'][:, :, None].astype(np.float32)
+                output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            return output.astype(np.float32)
+
+        import torch
+        with torch.inference_mode():
+            output = self.model({name: torch.from_numpy(value) for name, value in features.items()})
+        return output['sentence_embedding'].numpy().astype(np.float32)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        self._load()
+        ids = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)['input_ids']
+        vectors = np.zeros((len(texts), 0), dtype=np.float32)
+        for batch in self._batches([len(row) for row in ids]):
+            output = self._encode([ids[i] for i in batch])
+            if vectors.shape[1] == 0:
+                vectors = np.zeros((len(texts), output.shape[1]), dtype=np.float32)
+            vectors[batch] = output / np.maximum(np.linalg.norm(output, axis=1, keepdims=True), 1e-12)
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# * Fake backend for offline tests and benchmarks
+
+class FakeAPIError(Exception):
+    """ Injected error that looks like an HTTP failure of the API (429 by default). """
+    def __init__(self, message="injected error", http_status=429):
+        super().__init__(message)
+        self.http_status = http_status
+
+
+class FakeChatModel(ChatModel):
+    """ Deterministic chat model: the completion only depends on the prompt. """
+    def __init__(self, backend, temperature=0.0, max_tokens=None):
+        super().__init__(backend.model_name, temperature, max_tokens)
+        self.backend = backend
+
+    def complete(self, prompt, on_token=None):
+        backend = self.backend
+        backend.count("chat")
+        if backend.latency:
+            time.sleep(backend.latency)
+        if backend.fail():
+            raise FakeAPIError()
+
+        digest = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        parts = re.split(r'^<<<(\d+)>>>$', prompt, flags=re.MULTILINE)
+        if len(parts) > 1:
+            # a packed prompt (see `DocumentReader._map_packed`): one marked answer per passage
+            tokens = []
+            for number, passage in zip(parts[1::2], parts[2::2]):
+                tokens += ["\n<<<{}>>>\n".format(number), "summary", digest[:8]] + passage.split()[-backend.completion_words:]
+        else:
+            tokens = ["summary", digest[:8]] + prompt.split()[-backend.completion_words:]
+        if self.max_tokens:
+            tokens = tokens[:self.max_tokens]
+
+        for token in tokens:
+            if backend.tokens_per_second:
+                time.sleep(1.0 / backend.tokens_per_second)
+            if on_token is not None:
+                on_token(token + " ")
+        return " ".join(tokens)
+
+
+class FakeEmbeddings(Embeddings):
+    """ Deterministic embeddings: hash-seeded unit vectors of `backend.dim` floats. """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _embed(self, text):
+        rng = random.Random(hashlib.sha1(text.encode('utf-8')).digest())
+        vector = [rng.gauss(0, 1) for _ in range(self.backend.dim)]
+        norm = sum(x * x for x in vector) ** 0.5
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts):
+        self.backend.count("embed")
+        if self.backend.embedding_latency:
+            time.sleep(self.backend.embedding_latency)
+        if self.backend.fail():
+            raise FakeAPIError()
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class FakeBackend(Backend):
+    """ Offline backend with configurable latency, token throughput and error injection. """
+    def __init__(
+            self, latency=0.0, tokens_per_second=None, error_rate=0.0,
+            embedding_latency=0.0, dim=64, completion_words=20, seed=0,
+            model_name='fake-chat', embedding_model='fake-embedding', context_window=4096,
+            ):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.embedding_latency = embedding_latency
+        self.dim = dim
+        self.completion_words = completion_words
+        self.model_name = model_name
+        self.embedding_model = embedding_model
+        self.context_window = context_window
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {"chat": 0, "embed": 0}
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] += 1
+
+    def fail(self):
+        with self.lock:
+            return self.rng.random() < self.error_rate
+
+    def chat(self, temperature=0.0, max_tokens=None):
+        return FakeChatModel(self, temperature, max_tokens)
+
+    def embeddings(self):
+        return FakeEmbeddings(self)
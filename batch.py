@@ -0,0 +1,172 @@
+import os, sys, json, glob, hashlib, argparse, threading, time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from model import DocumentReader, SUMMARY_FILES
+from docstore import load_result
+from ingest import make_splitter, iter_pages
+from prompts import DEFAULT_TEMPLATES
+from jobs import JOB_TEMPLATES
+
+
+def parse_document(doc_path, splitter, chunk_size, chunk_overlap):
+    """ This function parses and splits one document; it runs in a worker process. """
+    text_splitter = make_splitter(splitter, chunk_size, chunk_overlap)
+    return list(text_splitter.split(iter_pages(doc_path)))
+
+
+def collect_paths(inputs):
+    """ This function expands directories and glob patterns into a sorted list of files. """
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*")
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.isfile(path):
+                paths.add(os.path.abspath(path))
+    return sorted(paths)
+
+
+class Manifest(object):
+    """ Checkpoint of the finished documents, rewritten atomically after each one. """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def is_done(self, doc_path, key):
+        entry = self.entries.get(doc_path)
+        return entry is not None and entry["status"] == "done" and entry["key"] == key
+
+    def previous(self, doc_path, settings):
+        """ This function loads the result of an earlier version of a document summarized with the same settings. """
+        entry = self.entries.get(doc_path)
+        if entry is None or entry["status"] != "done" or entry.get("settings") != settings:
+            return None
+        if not os.path.exists(entry["output"]):
+            return None
+        return load_result(entry["output"])
+
+    def update(self, doc_path, **entry):
+        with self.lock:
+            self.entries[doc_path] = entry
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=4, ensure_ascii=False)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def result_settings(doc_reader, chunk_size, args):
+    """ This function lists every setting besides the document content that changes its chunks or summary. """
+    settings = {
+        'splitter': doc_reader.splitter, 'chunk_size': chunk_size, 'chunk_overlap': args.chunk_overlap,
+        'embedding_model': doc_reader.embedding_model, 'model_name': doc_reader.model_name,
+        'summary_option': args.summary_option, 'temperature': args.temperature,
+        'templates': {key: DEFAULT_TEMPLATES[key] for key in JOB_TEMPLATES[args.summary_option]},
+    }
+    if args.summary_option == "segmented_refine":
+        settings.update(refine_segments=args.refine_segments, refine_target_seconds=args.refine_target_seconds)
+        if args.refine_segments is None:
+            settings['max_concurrency'] = args.max_concurrency     # the default segments are one per worker
+    if args.pack and args.summary_option in ("map_reduce", "translate"):
+        settings['pack'] = True
+    return settings
+
+
+def process_document(doc_reader, parse_pool, manifest, doc_path, args):
+    """ This function loads, indexes and summarizes one document. """
+    chunk_size = doc_reader.resolve_chunk_size(args.chunk_size, summary_option=args.summary_option)
+    ingest_key = doc_reader.ingest_key(doc_path, None, chunk_size, args.chunk_overlap)
+    settings = result_settings(doc_reader, chunk_size, args)
+    key = "{}-{}".format(ingest_key, hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16])
+    if manifest.is_done(doc_path, key):
+        print(f"[skip] {doc_path}")
+        return
+
+    name = os.path.splitext(os.path.basename(doc_path))[0]
+    save_path = os.path.join(args.output_dir, "{}-{}-{}".format(name, key[:8], key[-8:]), SUMMARY_FILES[args.summary_option])
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+    start = time.time()
+    try:
+        # Unstructured/pdfminer parsing is CPU-bound, so it runs in the process pool (unless the chunks are stored already)
+        parsed = None
+        if not os.path.exists(doc_reader.store.paths(ingest_key)[1]):
+            parsed = parse_pool.submit(parse_document, doc_path, doc_reader.splitter, chunk_size, args.chunk_overlap).result()
+        chunks, retriever = doc_reader.load(
+            doc_path, chunk_size=chunk_size, chunk_overlap=args.chunk_overlap, chunks=parsed,
+            )
+        doc_reader.summarize(
+            chunks, DEFAULT_TEMPLATES,
+            summary_option=args.summary_option, temperature=args.temperature,
+            refine_segments=args.refine_segments, refine_target_seconds=args.refine_target_seconds,
+            pack=args.pack, save_path=save_path,
+            # an edited document only has its changed chunks summarized again
+            previous=manifest.previous(doc_path, settings),
+            )
+    except Exception as e:
+        manifest.update(doc_path, status="failed", key=key, error=repr(e))
+        print(f"[failed] {doc_path}: {e!r}")
+        return
+
+    manifest.update(doc_path, status="done", key=key, settings=settings, output=save_path, chunks=len(chunks), seconds=time.time() - start)
+    print(f"[done] {doc_path} ({len(chunks)} chunks, {time.time() - start:.1f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize and index a folder of documents.")
+    parser.add_argument("inputs", nargs="+", help="Directories, files or glob patterns")
+    parser.add_argument("--output-dir", default=os.path.join("db", "batch"))
+    parser.add_argument("--db-dir", default="db")
+    parser.add_argument("--summary-option", default="map_reduce", choices=list(SUMMARY_FILES))
+    parser.add_argument("--chunk-size", type=int, default=None, help="Tokens per chunk (default: as large as the model context allows)")
+    parser.add_argument("--splitter", default="structured", choices=["structured", "token"])
+    parser.add_argument("--chunk-overlap", type=int, default=0)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--refine-segments", type=int, default=None, help="Segments of segmented_refine (default: one per LLM worker)")
+    parser.add_argument("--refine-target-seconds", type=float, default=None, help="Pick the segments of segmented_refine to finish in about this time")
+    parser.add_argument("--pack", action="store_true", help="Send consecutive small chunks in one map/translate request")
+    parser.add_argument("--parse-workers", type=int, default=os.cpu_count(), help="Processes for document parsing")
+    parser.add_argument("--docs-in-flight", type=int, default=4, help="Documents processed concurrently")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="Concurrent LLM calls across all documents")
+    parser.add_argument("--requests-per-minute", type=int, default=3500)
+    parser.add_argument("--tokens-per-minute", type=int, default=90000)
+    parser.add_argument("--embedding-model", default="text-embedding-ada-002", help='OpenAI embedding model, or "local:<model>" to embed on the CPU')
+    parser.add_argument("--api-base", default=None, help="OpenAI-compatible endpoint, e.g. a local stub server")
+    args = parser.parse_args()
+
+    if args.api_base:
+        import openai
+        os.environ["OPENAI_API_BASE"] = args.api_base
+        openai.api_base = args.api_base
+
+    paths = collect_paths(args.inputs)
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(args.output_dir, "manifest.json"))
+
+    # * One reader, so every document shares the same rate-limited LLM/embedding pool
+    doc_reader = DocumentReader(
+        db_dir=args.db_dir, splitter=args.splitter, embedding_model=args.embedding_model,
+        max_concurrency=args.max_concurrency,
+        requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute,
+        )
+
+    print(f"{len(paths)} documents")
+    with ProcessPoolExecutor(max_workers=args.parse_workers) as parse_pool, \
+            ThreadPoolExecutor(max_workers=args.docs_in_flight) as doc_pool:
+        futures = [
+            doc_pool.submit(process_document, doc_reader, parse_pool, manifest, doc_path, args)
+            for doc_path in paths
+        ]
+        for future in futures:
+            future.result()
+
+    failed = [path for path, entry in manifest.entries.items() if entry["status"] != "done"]
+    if failed:
+        print(f"{len(failed)} documents failed, re-run to resume")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
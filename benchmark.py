@@ -0,0 +1,183 @@
+import os, sys, json, time, random, argparse, tempfile, resource
+from concurrent.futures import ProcessPoolExecutor
+
+from model import DocumentReader, SUMMARY_FILES
+from backends import FakeBackend
+from prompts import DEFAULT_TEMPLATES
+from tracing import tracer
+
+
+WORDS = (
+    "the reader model summary chapter section result method data value analysis figure table "
+    "experiment baseline proposal project review question answer document page paragraph"
+).split()
+
+# metrics where a larger number is better; every other timing/memory metric is lower-is-better
+HIGHER_IS_BETTER = ('ingest_pages_per_s', 'ingest_chunks_per_s')
+
+
+def make_document(path, num_pages, words_per_page, seed=0):
+    """ This function writes a synthetic text document, pages separated by form feeds. """
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for page_id in range(num_pages):
+            if page_id > 0:
+                f.write("\f")
+            f.write(f"Page {page_id}\n")
+            f.write(" ".join(rng.choice(WORDS) for _ in range(words_per_page)))
+            f.write("\n")
+
+
+def percentile(values, q):
+    """ Nearest-rank percentile of a list of numbers. """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def make_reader(db_dir, backend, args):
+    """ This function creates a reader on the fake backend without rate limits. """
+    doc_reader = DocumentReader(
+        db_dir=db_dir, backend=backend,
+        max_concurrency=args.concurrency,
+        requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12,
+        embedding_requests_per_minute=10 ** 9, embedding_tokens_per_minute=10 ** 12,
+        )
+    doc_reader.executor.backoff_base = 0.01
+    return doc_reader
+
+
+def run_case(num_chunks, args):
+    """ This function benchmarks ingest, summarize and ask on one synthetic document. """
+    with tracer.trace("benchmark"):
+        return measure(num_chunks, args)
+
+
+def measure(num_chunks, args):
+    backend = FakeBackend(
+        latency=args.latency, tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate, embedding_latency=args.embedding_latency,
+        )
+    result = {'num_chunks': num_chunks}
+    with tempfile.TemporaryDirectory() as db_dir:
+        doc_reader = make_reader(db_dir, backend, args)
+
+        # one page per chunk: about 0.75 words per token
+        doc_path = os.path.join(db_dir, "document.txt")
+        make_document(doc_path, num_chunks, int(args.chunk_size * 0.75) - 10, seed=num_chunks)
+
+        # * Ingest
+        start = time.perf_counter()
+        chunks, retriever = doc_reader.load(doc_path, chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - start
+        result.update({
+            'chunks': len(chunks),
+            'ingest_s': elapsed,
+            'ingest_pages_per_s': num_chunks / elapsed,
+            'ingest_chunks_per_s': len(chunks) / elapsed,
+        })
+
+        # * Summarize (each option with a reader of its own, so none is answered from the completions cached by another)
+        for summary_option in args.options:
+            option_reader = make_reader(os.path.join(db_dir, summary_option), backend, args)
+            start = time.perf_counter()
+            option_reader.summarize(chunks, DEFAULT_TEMPLATES, summary_option=summary_option, pack=args.pack)
+            result[f'summarize_{summary_option}_s'] = time.perf_counter() - start
+
+        # * Ask (distinct questions, so every one is a cache miss)
+        latencies = []
+        for query_id in range(args.queries):
+            start = time.perf_counter()
+            doc_reader.ask(f"What does page {query_id} say about the {WORDS[query_id % len(WORDS)]}?", retriever, DEFAULT_TEMPLATES, retrieval=args.retrieval)
+            latencies.append(time.perf_counter() - start)
+        if latencies:
+            result.update({
+                'ask_p50_s': percentile(latencies, 50),
+                'ask_p90_s': percentile(latencies, 90),
+                'ask_p99_s': percentile(latencies, 99),
+            })
+
+        # * Ask again (the same questions, answered from the answer cache)
+        latencies, before = [], doc_reader.ask_cache.stats()
+        for query_id in range(args.queries):
+            start = time.perf_counter()
+            doc_reader.ask(f"what does page {query_id} say about the {WORDS[query_id % len(WORDS)]}", retriever, DEFAULT_TEMPLATES, retrieval=args.retrieval)
+            latencies.append(time.perf_counter() - start)
+        if latencies:
+            result['ask_repeat_p50_s'] = percentile(latencies, 50)
+            # (the hits of this pass only; the first one filled the cache)
+            after = doc_reader.ask_cache.stats()
+            result['ask_cache_hit_rate'] = (after['exact_hits'] - before['exact_hits']) / (after['lookups'] - before['lookups'])
+
+    # * Where the time went: self time of each traced stage (see tracing.Tracer)
+    for name, stage in sorted(tracer.breakdown("benchmark").items()):
+        result[f'stage_{name}_s'] = stage['self_seconds']
+
+    result['chat_calls'] = backend.calls['chat']
+    result['embed_calls'] = backend.calls['embed']
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """ This function lists the metrics that regressed by more than `tolerance` against a baseline. """
+    baseline = {entry['num_chunks']: entry for entry in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline.get(result['num_chunks'])
+        if reference is None:
+            continue
+        for metric, value in result.items():
+            if not (metric.endswith('_s') or metric == 'peak_rss_mb'):
+                continue
+            if metric not in reference or not reference[metric]:
+                continue
+            ratio = value / reference[metric]
+            if metric in HIGHER_IS_BETTER:
+                ratio = 1.0 / ratio if ratio else float('inf')
+            if ratio > 1.0 + tolerance:
+                regressions.append((result['num_chunks'], metric, reference[metric], value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DocumentReader pipeline with a fake LLM backend.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000], help="Document sizes in chunks")
+    parser.add_argument("--options", nargs="+", default=list(SUMMARY_FILES), choices=list(SUMMARY_FILES))
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--pack", action="store_true", help="Pack small chunks into one map/translate request")
+    parser.add_argument("--retrieval", default="hybrid", choices=["hybrid", "lexical", "vector"])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.005, help="Fake LLM latency per call (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=None, help="Fake LLM generation speed")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Fake embedding latency per request (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of an injected 429 per call")
+    parser.add_argument("--output", default="bench_output.txt", help="JSON lines with one result per size")
+    parser.add_argument("--baseline", default=None, help="Earlier --output file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a metric counts as regressed")
+    args = parser.parse_args()
+
+    results = []
+    for num_chunks in args.sizes:
+        # a fresh process per size, so the peak RSS belongs to that size alone
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(run_case, num_chunks, args).result()
+        results.append(result)
+        print(json.dumps({k: round(v, 4) if isinstance(v, float) else v for k, v in result.items()}))
+
+    with open(args.output, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        regressions = compare(results, baseline, args.tolerance)
+        for num_chunks, metric, before, after in regressions:
+            print(f"REGRESSION {num_chunks} chunks {metric}: {before:.4f} -> {after:.4f}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import os, re, json, time, hashlib, sqlite3, threading
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+from langchain.embeddings.base import Embeddings
+
+from ingest import count_tokens
+from tracing import tracer
+
+
+def text_hash(text):
+    """ Hash a piece of text into a cache key. """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache(object):
+    """ Persistent store of embedding vectors keyed by (model name, text hash), evicted least recently used beyond `max_bytes`. """
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT, hash TEXT, vector BLOB, nbytes INTEGER, last_access REAL, "
+            "PRIMARY KEY (model, hash))"
+            )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_access)")
+        self.conn.commit()
+
+    def get_many(self, model, hashes):
+        """ Return a dict of hash -> vector for the hashes found in the cache. """
+        found = {}
+        with self.lock:
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows = self.conn.execute(
+                    "SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN (%s)" % ','.join('?' * len(batch)),
+                    [model] + list(batch),
+                    ).fetchall()
+                for h, blob in rows:
+                    vector = array('f')
+                    vector.frombytes(blob)
+                    found[h] = vector.tolist()
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND hash = ?",
+                    [(now, model, h) for h in found],
+                    )
+                self.conn.commit()
+        return found
+
+    def put_many(self, model, items):
+        """ Store (hash, vector) pairs, then evict down to `max_bytes`. """
+        now = time.time()
+        rows = []
+        for h, vector in items:
+            blob = array('f', vector).tobytes()
+            rows.append((model, h, blob, len(blob), now))
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+            self._evict()
+
+    def _evict(self):
+        """ Drop the least recently used vectors until the store fits `max_bytes`. """
+        total, = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()
+        while total > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT model, hash, nbytes FROM embeddings ORDER BY last_access LIMIT 256"
+                ).fetchall()
+            if not rows:
+                break
+            victims = []
+            for model, h, nbytes in rows:
+                victims.append((model, h))
+                total -= nbytes
+                if total <= self.max_bytes:
+                    break
+            self.conn.executemany("DELETE FROM embeddings WHERE model = ? AND hash = ?", victims)
+        self.conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """ Embeddings wrapper that only sends deduplicated cache misses to the underlying model, in batches of `batch_size`. """
+    def __init__(self, embeddings, cache, model_name, batch_size=1000, executor=None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.executor = executor
+
+    def _embed(self, texts):
+        if self.executor is None:
+            with tracer.span("embed_call", texts=len(texts)):
+                return self.embeddings.embed_documents(texts)
+        cost = sum(count_tokens(text) for text in texts)
+        return self.executor.call(self.embeddings.embed_documents, texts, cost=cost)
+
+    def embed_documents(self, texts):
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model_name, list(set(hashes)))
+
+        # deduplicate the misses, keeping the first text of each hash
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in vectors and h not in missing:
+                missing[h] = text
+        missing = list(missing.items())
+
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            results = self._embed([text for _, text in batch])
+            new_items = [(h, vector) for (h, _), vector in zip(batch, results)]
+            self.cache.put_many(self.model_name, new_items)
+            vectors.update(new_items)
+
+        return [vectors[h] for h in hashes]
+
+    def embed_query(self, text):
+        h = text_hash(text)
+        found = self.cache.get_many(self.model_name, [h])
+        if h in found:
+            return found[h]
+        vector = self._embed([text])[0]
+        self.cache.put_many(self.model_name, [(h, vector)])
+        return vector
+
+
+class LLMCache(object):
+    """ Persistent cache of LLM completions keyed by (model, temperature, max_tokens, prompt), with a `ttl` and an LRU size limit. """
+    def __init__(self, path, ttl=None, max_bytes=256 << 20):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, completion TEXT, nbytes INTEGER, created REAL, last_access REAL)"
+            )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS completions_lru ON completions (last_access)")
+        self.conn.commit()
+
+    @staticmethod
+    def key(model, temperature, max_tokens, prompt):
+        return text_hash(json.dumps([model, temperature, max_tokens, prompt], ensure_ascii=False))
+
+    def get(self, key):
+        """ Return the cached completion for `key`, or None. """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT completion, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            completion, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                self.conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return completion
+
+    def put(self, key, completion):
+        """ Store a completion, then purge expired entries and evict down to `max_bytes`. """
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                (key, completion, len(completion.encode('utf-8')), now, now),
+                )
+            if self.ttl is not None:
+                self.conn.execute("DELETE FROM completions WHERE created < ?", (now - self.ttl,))
+            total, = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM completions").fetchone()
+            while total > self.max_bytes:
+                rows = self.conn.execute(
+                    "SELECT key, nbytes FROM completions ORDER BY last_access LIMIT 256"
+                    ).fetchall()
+                if not rows:
+                    break
+                victims = []
+                for victim, nbytes in rows:
+                    victims.append((victim,))
+                    total -= nbytes
+                    if total <= self.max_bytes:
+                        break
+                self.conn.executemany("DELETE FROM completions WHERE key = ?", victims)
+            self.conn.commit()
+
+
+QUERY_SPACE_PATTERN = re.compile(r'\s+')
+QUERY_NUMBER_PATTERN = re.compile(r'\d+(?:[.,]\d+)*')
+
+def normalize_query(query):
+    """ Fold case, spacing and the final punctuation of a question, so trivially different phrasings share a key. """
+    return QUERY_SPACE_PATTERN.sub(" ", query).strip().rstrip("?？.。!！ ").casefold()
+
+
+class AskCache(object):
+    """ In-memory LRU cache of answers per scope: by normalized question, and by query embedding for a near-identical question with the same numbers. """
+    def __init__(self, max_entries=1024, max_scopes=64, max_per_scope=256, threshold=0.98):
+        self.max_entries = max_entries
+        self.max_scopes = max_scopes
+        self.max_per_scope = max_per_scope
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.exact = OrderedDict()      # (scope, question) -> (answer, source chunks)
+        self.semantic = OrderedDict()   # scope -> OrderedDict(question -> (vector, answer, source chunks))
+        self.matrices = {}              # scope -> (questions, their numbers, stacked vectors), rebuilt after a change
+        self.counts = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0}
+
+    @staticmethod
+    def scope(doc_key, template, temperature, max_tokens, retrieval):
+        return text_hash(json.dumps([doc_key, template, temperature, max_tokens, retrieval], ensure_ascii=False))
+
+    def get(self, scope, query):
+        """ Exact tier: the (answer, source chunks) cached for this question, or None. """
+        key = (scope, normalize_query(query))
+        with self.lock:
+            entry = self.exact.get(key)
+            if entry is not None:
+                self.exact.move_to_end(key)
+                self.counts['exact_hits'] += 1
+        return entry
+
+    def get_similar(self, scope, query, vector):
+        """ Semantic tier: the (answer, source chunks) of the most similar earlier question with the same numbers, or None. """
+        numbers = QUERY_NUMBER_PATTERN.findall(query)
+        with self.lock:
+            entries = self.semantic.get(scope)
+            if not entries:
+                return None
+            if scope not in self.matrices:
+                questions = list(entries)
+                self.matrices[scope] = (
+                    questions, [QUERY_NUMBER_PATTERN.findall(question) for question in questions],
+                    np.stack([entries[question][0] for question in questions]),
+                    )
+            questions, question_numbers, matrix = self.matrices[scope]
+            similarities = np.where([found == numbers for found in question_numbers], matrix @ self._unit(vector), -1.0)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            entries.move_to_end(questions[best])
+            self.semantic.move_to_end(scope)
+            self.counts['semantic_hits'] += 1
+            _, answer, source_chunks = entries[questions[best]]
+        return answer, source_chunks
+
+    def miss(self):
+        with self.lock:
+            self.counts['misses'] += 1
+
+    def put(self, scope, query, answer, source_chunks, vector=None):
+        """ Store an answer in the exact tier and, with its query embedding, in the semantic tier. """
+        question = normalize_query(query)
+        with self.lock:
+            self.exact[(scope, question)] = (answer, source_chunks)
+            self.exact.move_to_end((scope, question))
+            while len(self.exact) > self.max_entries:
+                self.exact.popitem(last=False)
+
+            if vector is None:
+                return
+            entries = self.semantic.setdefault(scope, OrderedDict())
+            entries[question] = (self._unit(vector), answer, source_chunks)
+            entries.move_to_end(question)
+            self.semantic.move_to_end(scope)
+            while len(entries) > self.max_per_scope:
+                entries.popitem(last=False)
+            self.matrices.pop(scope, None)
+            while len(self.semantic) > self.max_scopes:
+                evicted, _ = self.semantic.popitem(last=False)
+                self.matrices.pop(evicted, None)
+
+    def stats(self):
+        """ Hit counts and rates of both tiers, and their current sizes. """
+        with self.lock:
+            lookups = sum(self.counts.values())
+            return dict(
+                self.counts,
+                lookups=lookups,
+                exact_hit_rate=self.counts['exact_hits'] / lookups if lookups else 0.0,
+                semantic_hit_rate=self.counts['semantic_hits'] / lookups if lookups else 0.0,
+                exact_entries=len(self.exact),
+                semantic_entries=sum(len(entries) for entries in self.semantic.values()),
+            )
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
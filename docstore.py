@@ -0,0 +1,290 @@
+import os, json, mmap, shutil, hashlib, threading
+from array import array
+
+from langchain.docstore.document import Document
+
+
+# * Chunks stored once, as offsets into one text file
+
+INDEX_FIELDS = 3        # start, end (byte offsets into the text) and metadata id, per chunk
+HASH_BYTES = 32         # sha256 of each chunk text, the same as `cache.text_hash`
+
+
+class ChunkStore(object):
+    """ Read-only, memory-mapped sequence of the chunks of one document, decoded when they are accessed. """
+    def __init__(self, path):
+        self.path = path
+        self.index = array('q')
+        with open(os.path.join(path, "index"), "rb") as f:
+            self.index.frombytes(f.read())
+        with open(os.path.join(path, "metadata.json"), "r", encoding="utf-8") as f:
+            self.metadatas = json.load(f)
+        with open(os.path.join(path, "text"), "rb") as f:
+            # (an empty file cannot be mapped)
+            self.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    @staticmethod
+    def count(path):
+        """ This function returns the number of chunks of a store without opening it. """
+        return os.path.getsize(os.path.join(path, "index")) // (8 * INDEX_FIELDS)
+
+    def __len__(self):
+        return len(self.index) // INDEX_FIELDS
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Document(page_content=self.content(i), metadata=dict(self.metadata(i), chunk_id=i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def view(self, i):
+        """ This function returns the UTF-8 bytes of a chunk as a zero-copy memoryview. """
+        start, end = self.index[INDEX_FIELDS * i], self.index[INDEX_FIELDS * i + 1]
+        return memoryview(self.text)[start:end]
+
+    def content(self, i):
+        start, end = self.index[INDEX_FIELDS * i], self.index[INDEX_FIELDS * i + 1]
+        return self.text[start:end].decode('utf-8')
+
+    def metadata(self, i):
+        return self.metadatas[self.index[INDEX_FIELDS * i + 2]]
+
+    def hashes(self):
+        """ This function returns the `text_hash` of every chunk, without reading the text. """
+        with open(os.path.join(self.path, "hashes"), "rb") as f:
+            data = f.read()
+        return [data[k:k + HASH_BYTES].hex() for k in range(0, len(data), HASH_BYTES)]
+
+    def close(self):
+        if isinstance(self.text, mmap.mmap):
+            self.text.close()
+
+
+class ChunkStoreWriter(object):
+    """ Writes a chunk store one chunk at a time into `<path>.tmp`; `close` moves it in place. """
+    def __init__(self, path):
+        self.path = path
+        self.tmp = path + ".tmp"
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+        self.text = open(os.path.join(self.tmp, "text"), "wb")
+        # (a handle of its own stays valid once the file is moved in place)
+        self.reader, self.reader_lock = open(os.path.join(self.tmp, "text"), "rb"), threading.Lock()
+        self.hashes = open(os.path.join(self.tmp, "hashes"), "wb")
+        self.index = array('q')
+        self.metadatas, self.metadata_ids = [], {}
+        self.offset = 0
+        self.previous = ""
+
+    def add(self, text, metadata=None):
+        """ This function appends a chunk and returns its position. """
+        metadata = {key: value for key, value in (metadata or {}).items() if key != 'chunk_id'}
+        metadata_key = json.dumps(metadata, sort_keys=True, ensure_ascii=False, default=str)
+        if metadata_key not in self.metadata_ids:
+            self.metadata_ids[metadata_key] = len(self.metadatas)
+            self.metadatas.append(metadata)
+
+        shared = self._overlap(self.previous, text)
+        start = self.offset - len(text[:shared].encode('utf-8'))
+        rest = text[shared:].encode('utf-8')
+        if not shared and self.offset:
+            self.text.write(b"\n\n")        # between chunks, in no chunk
+            self.offset += 2
+            start = self.offset
+        self.text.write(rest)
+        self.offset += len(rest)
+        self.index.extend([start, self.offset, self.metadata_ids[metadata_key]])
+        self.hashes.write(hashlib.sha256(text.encode('utf-8')).digest())
+        self.previous = text
+        return len(self.index) // INDEX_FIELDS - 1
+
+    def content(self, i):
+        """ This function reads back the text of a chunk already added. """
+        start, end = self.index[INDEX_FIELDS * i], self.index[INDEX_FIELDS * i + 1]
+        try:
+            self.text.flush()
+        except ValueError:
+            pass        # closed, hence flushed
+        with self.reader_lock:
+            self.reader.seek(start)
+            return self.reader.read(end - start).decode('utf-8')
+
+    @staticmethod
+    def _overlap(previous, text, probe=32):
+        """ Length of the longest end of `previous` that `text` starts with (ends shorter than `probe` are not looked for). """
+        if len(previous) < probe or len(text) < probe:
+            return 0
+        i = previous.find(text[:probe], max(0, len(previous) - len(text)))
+        while i != -1:
+            if text.startswith(previous[i:]):
+                return len(previous) - i
+            i = previous.find(text[:probe], i + 1)
+        return 0
+
+    def close(self):
+        """ This function finishes the store and moves it in place, replacing an older one. """
+        self.text.close()
+        self.hashes.close()
+        with open(os.path.join(self.tmp, "index"), "wb") as f:
+            self.index.tofile(f)
+        with open(os.path.join(self.tmp, "metadata.json"), "w", encoding="utf-8") as f:
+            json.dump(self.metadatas, f, ensure_ascii=False, default=str)
+        remove_store(self.path)
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.text.close()
+        self.hashes.close()
+        self.reader.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def write_store(path, texts, metadatas=None):
+    """ This function writes a chunk store from lists of texts (and metadata). """
+    writer = ChunkStoreWriter(path)
+    try:
+        for i, text in enumerate(texts):
+            writer.add(text, metadatas[i] if metadatas else None)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+def remove_store(path):
+    """ This function deletes a chunk store through `<path>.old`, so it never looks complete while it goes. """
+    if not os.path.exists(path):
+        return
+    shutil.rmtree(path + ".old", ignore_errors=True)
+    os.replace(path, path + ".old")
+    shutil.rmtree(path + ".old", ignore_errors=True)
+
+def link_store(source, path):
+    """ This function gives a chunk store a second name (hard links, copies across file systems). """
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name in os.listdir(source):
+        try:
+            os.link(os.path.join(source, name), os.path.join(tmp, name))
+        except OSError:
+            shutil.copyfile(os.path.join(source, name), os.path.join(tmp, name))
+    remove_store(path)
+    os.replace(tmp, path)
+
+
+# * Summary results that reference their chunks
+
+class ChunkSummaries(object):
+    """ Lazy list of the {'chunk_content', 'chunk_summary'} rows of a saved result, read from its chunk stores when accessed. """
+    def __init__(self, chunks, summaries):
+        self.chunks = chunks
+        self.summaries = summaries
+
+    def __len__(self):
+        return len(self.summaries)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        row = {'chunk_content': self.chunks.content(i), 'chunk_summary': self.summaries.content(i)}
+        row.update(self.summaries.metadata(i))
+        return row
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def hashes(self):
+        """ This function returns the hashes of the chunks (see `model.align_chunks`). """
+        return self.chunks.hashes()
+
+
+class SummaryRows(object):
+    """ The {'chunk_content', 'chunk_summary'} rows of a summary in progress, reading each chunk text back when the row is accessed. """
+    def __init__(self, chunks):
+        self.chunks = chunks if hasattr(chunks, 'content') or isinstance(chunks, list) else None
+        self.rows = []
+
+    def add(self, chunk_id, chunk, summary, changed=None):
+        row = {'chunk_id': chunk_id, 'chunk_summary': summary}
+        if self.chunks is None:
+            row['chunk_content'] = chunk.page_content
+        if changed is not None:
+            row['changed'] = changed
+        self.rows.append(row)
+
+    def set(self, i, summary):
+        self.rows[i]['chunk_summary'] = summary
+
+    def summaries(self):
+        return [row['chunk_summary'] for row in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        row = self.rows[i]
+        if 'chunk_content' in row:
+            content = row['chunk_content']
+        elif hasattr(self.chunks, 'content'):
+            content = self.chunks.content(row['chunk_id'])
+        else:
+            content = self.chunks[row['chunk_id']].page_content
+        element = {'chunk_content': content, 'chunk_summary': row['chunk_summary']}
+        if 'changed' in row:
+            element['changed'] = row['changed']
+        return element
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def save_result(path, total_summary, chunk_summaries, section_summaries, chunks=None):
+    """ This function saves the total and section summaries to `path` and the chunks and chunk summaries to chunk stores next to it. """
+    base = os.path.splitext(path)[0]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if isinstance(chunks, ChunkStore) and len(chunks) == len(chunk_summaries):
+        link_store(chunks.path, base + ".chunks")
+    else:
+        write_store(base + ".chunks", (element['chunk_content'] for element in chunk_summaries))
+    # (the summaries and markers of `SummaryRows` are read without their chunks)
+    rows = chunk_summaries.rows if isinstance(chunk_summaries, SummaryRows) else chunk_summaries
+    write_store(
+        base + ".summaries", [element['chunk_summary'] for element in rows],
+        [{'changed': element['changed']} if 'changed' in element else {} for element in rows],
+        )
+    data = {
+        "total_summary": total_summary,
+        "section_summaries": section_summaries,
+        "chunks": os.path.basename(base + ".chunks"),
+        "chunk_summaries": os.path.basename(base + ".summaries"),
+    }
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def load_result(path):
+    """ This function loads a result saved by `save_result` (or an older inline one) as (total_summary, chunk_summaries, section_summaries). """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    chunk_summaries = data["chunk_summaries"]
+    if isinstance(chunk_summaries, str):
+        folder = os.path.dirname(path)
+        chunk_summaries = ChunkSummaries(
+            ChunkStore(os.path.join(folder, data["chunks"])), ChunkStore(os.path.join(folder, chunk_summaries)),
+            )
+    return data["total_summary"], chunk_summaries, data.get("section_summaries", [])
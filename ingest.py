@@ -0,0 +1,225 @@
+import os, re
+
+from langchain.docstore.document import Document
+
+
+_encoding = None
+
+def get_encoding():
+    """ The tokenizer `TokenTextSplitter` uses by default, loaded once. """
+    global _encoding
+    if _encoding is None:
+        import tiktoken
+        _encoding = tiktoken.get_encoding("gpt2")
+    return _encoding
+
+def count_tokens(text):
+    """ Count tokens with the same tokenizer `TokenTextSplitter` uses. """
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+TEXT_EXTENSIONS = ['.txt', '.md', '.markdown', '.rst', '.csv', '.log']
+
+def iter_pages(doc_path, block_size=1 << 16):
+    """ This function lazily yields the pages (or blocks) of a document as Documents. """
+    ext = os.path.splitext(doc_path)[1].lower()
+    if ext == '.pdf':
+        from pdfminer.high_level import extract_pages
+        from pdfminer.layout import LTTextContainer
+
+        for page_id, page_layout in enumerate(extract_pages(doc_path)):
+            text = "".join(element.get_text() for element in page_layout if isinstance(element, LTTextContainer))
+            yield Document(page_content=text, metadata={'source': doc_path, 'page': page_id})
+    elif ext in TEXT_EXTENSIONS:
+        # form feeds (as written by pdftotext) end a page, long pages are cut into blocks
+        with open(doc_path, "r", encoding="utf-8", errors="replace") as f:
+            lines, size, page_id = [], 0, 0
+            for line in f:
+                *page_ends, line = line.split("\f")
+                for page_end in page_ends:
+                    lines.append(page_end)
+                    yield Document(page_content="".join(lines), metadata={'source': doc_path, 'page': page_id})
+                    lines, size, page_id = [], 0, page_id + 1
+                lines.append(line)
+                size += len(line)
+                if size >= block_size:
+                    yield Document(page_content="".join(lines), metadata={'source': doc_path, 'page': page_id})
+                    lines, size, page_id = [], 0, page_id + 1
+            if lines:
+                yield Document(page_content="".join(lines), metadata={'source': doc_path, 'page': page_id})
+    else:
+        from langchain.document_loaders import UnstructuredFileLoader
+
+        for element_id, element in enumerate(UnstructuredFileLoader(doc_path, mode="elements").load()):
+            element.metadata['page'] = element.metadata.get('page_number', element_id)
+            yield element
+
+
+class TokenChunker(object):
+    """ Incremental token splitter that works across page boundaries. """
+    def __init__(self, chunk_size=1000, chunk_overlap=0):
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap must be smaller than chunk_size")
+        self.chunk_size = int(chunk_size)
+        self.chunk_overlap = int(chunk_overlap)
+        self.tokens = []
+        self.emitted = 0        # number of leading buffered tokens already in a chunk
+        self.metadata = {}
+
+    def feed(self, text, metadata=None):
+        """ Add text and yield every chunk that is complete. """
+        if metadata is not None and len(self.tokens) <= self.emitted:
+            # the next chunk starts on this page
+            self.metadata = dict(metadata)
+        self.tokens.extend(get_encoding().encode(text, disallowed_special=()))
+        while len(self.tokens) >= self.chunk_size:
+            yield from self._emit(self.chunk_size)
+            self.metadata = dict(metadata or self.metadata)
+
+    def flush(self):
+        """ Yield the last, partial chunk if it holds tokens not emitted yet. """
+        if len(self.tokens) > self.emitted:
+            yield from self._emit(len(self.tokens))
+        self.tokens, self.emitted = [], 0
+
+    def _emit(self, size):
+        """ Cut the next chunk off the buffer; yields it unless it is whitespace only. """
+        chunk = Document(page_content=get_encoding().decode(self.tokens[:size]), metadata=self.metadata)
+        step = size - self.chunk_overlap if size == self.chunk_size else size
+        self.tokens = self.tokens[step:]
+        self.emitted = size - step
+        if chunk.page_content.strip():
+            yield chunk
+
+    def split(self, pages):
+        """ Lazily split an iterable of page Documents into chunks. """
+        for page_id, page in enumerate(pages):
+            if page_id > 0:
+                yield from self.feed("\n\n")
+            yield from self.feed(page.page_content, page.metadata)
+        yield from self.flush()
+
+
+# * Structure-aware splitting
+
+# strength of the boundary in front of a unit of text: chunks are preferably cut at the strongest one
+TOKEN, SENTENCE, LINE, PARAGRAPH, HEADING = 0, 1, 2, 3, 4
+
+HEADING_PATTERN = re.compile(
+    r'^\s*(#{1,6}\s|(chapter|section|part|appendix)\s+[\w.]+|第[0-9一二三四五六七八九十百千零]+[章节部篇回卷])',
+    re.IGNORECASE,
+    )
+SENTENCE_END_PATTERN = re.compile(r'[.!?;。！？；]+["\'”’)\]）」』]*\s*')
+
+
+class StructuredChunker(object):
+    """ Incremental splitter that packs whole headings, paragraphs and sentences into chunks, cut at the strongest boundary. """
+    def __init__(self, chunk_size=1000, chunk_overlap=0, slack=0.25):
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap must be smaller than chunk_size")
+        self.chunk_size = int(chunk_size)
+        self.chunk_overlap = int(chunk_overlap)
+        self.slack = slack
+        self.units = []         # (level, text, tokens, metadata)
+        self.tokens = 0
+        self.carried = 0        # number of leading units already emitted (the overlap)
+        self.lead, self.level = "", PARAGRAPH
+
+    def _units(self, text):
+        """ Cut text into (level, text) units; blank lines are kept in front of the next unit. """
+        for line in text.splitlines(keepends=True):
+            if not line.strip():
+                self.lead += line
+                self.level = max(self.level, PARAGRAPH)
+                continue
+            level = HEADING if HEADING_PATTERN.match(line) else max(self.level, LINE)
+            start = 0
+            ends = [m.end() for m in SENTENCE_END_PATTERN.finditer(line)]
+            for end in ends + [len(line)]:
+                if end > start:
+                    yield level, self.lead + line[start:end]
+                    self.lead, level, start = "", SENTENCE, end
+            self.level = LINE
+
+    def feed(self, text, metadata=None):
+        """ Add text and yield every chunk that is complete. """
+        metadata = dict(metadata or {})
+        for level, unit in self._units(text):
+            tokens = count_tokens(unit)
+            if tokens <= self.chunk_size:
+                self._add(level, unit, tokens, metadata)
+                while self.tokens > self.chunk_size:
+                    yield from self._emit(self._cut())
+                continue
+
+            # a unit longer than a chunk: each piece fills up the current chunk
+            ids = get_encoding().encode(unit, disallowed_special=())
+            while ids:
+                if self.tokens >= self.chunk_size:
+                    yield from self._emit(self._cut(end_level=level))
+                    continue
+                room = self.chunk_size - self.tokens
+                self._add(level, get_encoding().decode(ids[:room]), len(ids[:room]), metadata)
+                ids, level = ids[room:], TOKEN
+
+    def _add(self, level, text, tokens, metadata):
+        self.units.append((level, text, tokens, metadata))
+        self.tokens += tokens
+
+    def flush(self):
+        """ Yield the last, partial chunk if it holds units not emitted yet. """
+        if len(self.units) > self.carried:
+            yield from self._emit(len(self.units), carry=False)
+        self.units, self.tokens, self.carried = [], 0, 0
+        self.lead, self.level = "", PARAGRAPH
+
+    def _cut(self, end_level=None):
+        """ Number of leading units that go into the next chunk. """
+        levels = [unit[0] for unit in self.units[1:]] + ([end_level] if end_level is not None else [])
+        used, fit, best = 0, 1, None
+        for k, level in enumerate(levels, 1):
+            used += self.units[k - 1][2]
+            if used > self.chunk_size:
+                break
+            fit = k
+            if used >= (1 - self.slack) * self.chunk_size and (best is None or level >= levels[best - 1]):
+                best = k
+        return best or fit
+
+    def _emit(self, k, carry=True):
+        """ Cut the first `k` units off the buffer as a chunk; yields it unless it is whitespace only. """
+        emitted = self.units[:k]
+        chunk = Document(page_content="".join(unit[1] for unit in emitted).strip(), metadata=emitted[0][3])
+
+        # the overlap: trailing units of the chunk (never all of them, so the buffer always shrinks)
+        keep, size = 0, 0
+        if carry and self.chunk_overlap:
+            while keep < k - 1 and size + emitted[k - 1 - keep][2] <= self.chunk_overlap:
+                size += emitted[k - 1 - keep][2]
+                keep += 1
+        self.units = self.units[k - keep:]
+        self.tokens = sum(unit[2] for unit in self.units)
+        self.carried = keep
+        if chunk.page_content:
+            yield chunk
+
+    def split(self, pages):
+        """ Lazily split an iterable of page Documents into chunks; a page break counts as a paragraph break. """
+        for page_id, page in enumerate(pages):
+            if page_id > 0:
+                self.lead += "\n\n"
+                self.level = max(self.level, PARAGRAPH)
+            yield from self.feed(page.page_content, page.metadata)
+        yield from self.flush()
+
+
+SPLITTERS = {
+    'structured': StructuredChunker,
+    'token': TokenChunker,
+}
+
+def make_splitter(splitter, chunk_size, chunk_overlap=0):
+    """ This function builds a splitter by name (see `SPLITTERS`). """
+    if splitter not in SPLITTERS:
+        raise ValueError("Invalid splitter: {}".format(splitter))
+    return SPLITTERS[splitter](chunk_size=chunk_size, chunk_overlap=chunk_overlap)
@@ -0,0 +1,394 @@
+import os, json, time, shutil, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from model import SUMMARY_FILES, align_chunks, chunk_hashes
+from docstore import load_result
+from tracing import tracer
+from store import file_lock
+
+
+class JobCancelled(Exception):
+    """ Raised inside a running job once it has been cancelled. """
+
+
+# templates each summary option actually uses, so editing another one does not start a new job
+JOB_TEMPLATES = {
+    "map_reduce": ["map_prompt_template", "combine_prompt_template"],
+    "refine": ["refine_initial_prompt_template", "refine_prompt_template"],
+    "segmented_refine": ["refine_initial_prompt_template", "refine_prompt_template", "refine_merge_prompt_template"],
+    "translate": ["translate_prompt_template", "translate_context_prompt_template"],
+}
+
+ACTIVE = ("queued", "running")
+
+
+class Job(object):
+    """ A persisted summarize/translate job: `job.json` with its settings, status and progress, and one `checkpoint.jsonl` line per finished chunk. """
+    def __init__(self, job_dir, spec=None):
+        self.job_dir = job_dir
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.result = None          # latest (total_summary, chunk_summaries, section_summaries)
+        self.future = None          # set while the job is scheduled in this process
+
+        if spec is not None:
+            self.spec = spec
+            self.status, self.error = "queued", None
+            self.progress = {'chunks_done': 0, 'chunks_total': None, 'tokens': 0}
+            self.restore_checkpoint()
+        else:
+            self.reload()
+        self.started, self.done_at_start = None, len(self.done)
+
+    def reload(self):
+        """ This function reads the job back from disk, e.g. after another process worked on it. """
+        with open(os.path.join(self.job_dir, "job.json"), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.spec, self.status, self.error, self.progress = data['spec'], data['status'], data['error'], data['progress']
+        self.restore_checkpoint()
+
+    def restore_checkpoint(self):
+        """ This function reads the finished chunks from the checkpoint. """
+        self.done = {}
+        tokens = 0
+        checkpoint_path = os.path.join(self.job_dir, "checkpoint.jsonl")
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break       # a line cut short by a crash
+                    self.done[entry['chunk_id']] = entry['summary']
+                    tokens += entry['tokens']
+        self.progress.update(chunks_done=len(self.done), tokens=tokens)
+
+    @property
+    def job_id(self):
+        return os.path.basename(self.job_dir)
+
+    @property
+    def save_path(self):
+        return os.path.join(self.job_dir, SUMMARY_FILES[self.spec['summary_option']])
+
+    def save(self):
+        """ This function writes the settings, status and progress of the job atomically. """
+        with self.lock:
+            data = {'spec': self.spec, 'status': self.status, 'error': self.error, 'progress': self.progress}
+            # (a temporary file per process, as another process may save the same job, see `JobManager`)
+            tmp_path = os.path.join(self.job_dir, "job.json.{}.tmp".format(os.getpid()))
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, os.path.join(self.job_dir, "job.json"))
+
+    # * Checkpoint interface used by `DocumentReader.summarize_stream`
+
+    def record(self, chunk_id, summary, tokens=0):
+        """ This function checkpoints one finished chunk. """
+        with self.lock:
+            with open(os.path.join(self.job_dir, "checkpoint.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps({'chunk_id': chunk_id, 'summary': summary, 'tokens': tokens}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.done[chunk_id] = summary
+            self.progress['chunks_done'] = len(self.done)
+            self.progress['tokens'] += tokens
+        self.save()
+
+    def check(self):
+        """ This function stops the job if it has been cancelled. """
+        if self.cancel_event.is_set() or os.path.exists(os.path.join(self.job_dir, "cancel")):
+            raise JobCancelled(self.job_id)
+
+    def cancel(self):
+        self.cancel_event.set()
+        open(os.path.join(self.job_dir, "cancel"), "w").close()
+
+    def is_scheduled(self):
+        return self.future is not None and not self.future.done()
+
+    def eta(self):
+        """ Seconds left, estimated from the chunks finished since the job (re)started. """
+        total, done = self.progress['chunks_total'], self.progress['chunks_done']
+        if self.spec['summary_option'] in ("map_reduce", "translate") and self.progress.get('chunks_changed') is not None:
+            total = self.progress['chunks_changed']      # unchanged chunks are reused, not sent
+        finished = done - self.done_at_start
+        # (not known here for a job another process runs)
+        if self.status != "running" or self.started is None or total is None or finished <= 0:
+            return None
+        return (time.time() - self.started) / finished * max(total - done, 0)
+
+    def describe(self):
+        """ This function returns a one-line progress report of the job. """
+        total = self.progress['chunks_total']
+        text = "{}: {}/{} chunks, {} tokens".format(
+            self.status, self.progress['chunks_done'], "?" if total is None else total, self.progress['tokens'],
+            )
+        if total is None and self.progress.get('chunks_read'):
+            text += ", {} chunks read so far".format(self.progress['chunks_read'])
+        if self.progress.get('segments'):
+            text += " in {} segments".format(self.progress['segments'])
+        if self.progress.get('chunks_changed') is not None:
+            text += ", {} changed since the last version".format(self.progress['chunks_changed'])
+        estimate = self.progress.get('estimate')
+        if estimate is not None:
+            text += " (of about {} calls, {} tokens at most)".format(estimate['calls'], estimate['total_tokens'])
+        eta = self.eta()
+        if eta is not None:
+            text += ", about {:.0f}s left".format(eta)
+        if self.error:
+            text += ", error: " + self.error
+        return text
+
+
+class JobManager(object):
+    """ Runs summarize/translate jobs in the background, keeps them on disk and resumes or updates them from earlier runs. """
+    def __init__(self, doc_reader, jobs_dir=None, max_jobs=4, lane=None):
+        self.doc_reader = doc_reader
+        self.jobs_dir = jobs_dir or os.path.join(doc_reader.db_dir, "jobs")
+        self.lane = lane                # optional `FairLane` shared with other summaries
+        self.pool = ThreadPoolExecutor(max_workers=max_jobs)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self.versions_path = os.path.join(self.jobs_dir, "versions.json")
+        self.versions = {}              # lineage key -> latest finished job
+        if os.path.exists(self.versions_path):
+            with open(self.versions_path, "r", encoding="utf-8") as f:
+                self.versions = json.load(f)
+
+    def job_key(
+            self, doc_path, text, summary_option, chunk_size, chunk_overlap, temperature, max_tokens, templates,
+            translate_context_tokens=0, refine_segments=None, refine_target_seconds=None, pack=False,
+            document_name=None,
+            ):
+        """ This function computes the id of a job from everything that changes its result, and the lineage key of its document name. """
+        ingest_key = self.doc_reader.ingest_key(doc_path, text, chunk_size, chunk_overlap)
+        used = {key: templates[key] for key in JOB_TEMPLATES[summary_option]}
+        settings = [summary_option, temperature, max_tokens, self.doc_reader.model_name, used]
+        if summary_option == "translate":
+            settings.append(translate_context_tokens)
+        if summary_option == "segmented_refine":
+            settings.append([refine_segments, refine_target_seconds])
+        if pack and summary_option in ("map_reduce", "translate"):
+            settings.append("pack")
+        job_id = hashlib.sha256(json.dumps([ingest_key] + settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        if document_name is None:
+            return job_id, None
+        lineage = [document_name, self.doc_reader.splitter, chunk_size, chunk_overlap] + settings
+        return job_id, hashlib.sha256(json.dumps(lineage, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def submit(
+            self, doc_path, text, templates,
+            summary_option="map_reduce", chunk_size=None, chunk_overlap=0,
+            temperature=0.0, max_tokens=1000, translate_context_tokens=0,
+            refine_segments=None, refine_target_seconds=None, pack=False, user=None,
+            document_name=None,
+            ):
+        """ This function starts a job (or attaches to the same one) and returns it. """
+        if summary_option not in SUMMARY_FILES:
+            raise ValueError("Invalid summary option: {}".format(summary_option))
+        chunk_size = self.doc_reader.resolve_chunk_size(
+            chunk_size, summary_option=summary_option, templates=templates, max_tokens=max_tokens,
+            )
+        if document_name is None and doc_path is not None and not (text is not None and len(text) > 0):
+            document_name = os.path.basename(doc_path)
+        job_id, lineage = self.job_key(
+            doc_path, text, summary_option, chunk_size, chunk_overlap, temperature, max_tokens, templates,
+            translate_context_tokens, refine_segments, refine_target_seconds, pack, document_name,
+            )
+        job_dir = os.path.join(self.jobs_dir, job_id)
+
+        with self.lock:
+            job = self.get(job_id)
+            if job is not None and (job.status == "done" or job.is_scheduled()):
+                return job
+
+            if job is None:
+                # * New job: keep a copy of the input, so the job survives temporary uploads
+                os.makedirs(job_dir, exist_ok=True)
+                if text is not None and len(text) > 0:
+                    with open(os.path.join(job_dir, "input.txt"), "w", encoding="utf-8") as f:
+                        f.write(text)
+                    document = "input.txt"
+                else:
+                    document = "input" + os.path.splitext(doc_path)[1]
+                    shutil.copyfile(doc_path, os.path.join(job_dir, document))
+                job = Job(job_dir, spec={
+                    'document': document,
+                    'is_text': text is not None and len(text) > 0,
+                    'summary_option': summary_option,
+                    'chunk_size': chunk_size,
+                    'chunk_overlap': chunk_overlap,
+                    'temperature': temperature,
+                    'max_tokens': max_tokens,
+                    'translate_context_tokens': translate_context_tokens,
+                    'refine_segments': refine_segments,
+                    'refine_target_seconds': refine_target_seconds,
+                    'pack': pack,
+                    'templates': templates,
+                    'user': user,
+                    'document_name': document_name,
+                    'lineage': lineage,
+                    'previous_job': self.versions.get(lineage) if lineage is not None else None,
+                })
+
+            # new, cancelled, failed or left over from a previous process: (re)start from the checkpoint
+            job.status, job.error = "queued", None
+            job.cancel_event.clear()
+            if os.path.exists(os.path.join(job_dir, "cancel")):
+                os.remove(os.path.join(job_dir, "cancel"))
+            job.save()
+            self.jobs[job_id] = job
+            job.future = self.pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        """ This function returns a job by id, loading it from disk if needed. """
+        job = self.jobs.get(job_id)
+        if job is not None and job.status in ACTIVE and not job.is_scheduled():
+            job.reload()        # queued or running in another process
+        if job is None and os.path.exists(os.path.join(self.jobs_dir, job_id, "job.json")):
+            job = self.jobs[job_id] = Job(os.path.join(self.jobs_dir, job_id))
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def resume(self):
+        """ This function restarts the jobs a previous process left queued or running (and no other process runs). """
+        resumed = []
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            with self.lock:
+                job = self.get(job_id)
+                if job is None or job.status not in ACTIVE or job.is_scheduled() or self.running_elsewhere(job):
+                    continue
+                job.status = "queued"
+                job.save()
+                job.future = self.pool.submit(self._run, job)
+            resumed.append(job)
+        return resumed
+
+    @staticmethod
+    def running_elsewhere(job):
+        """ This function tells whether another process holds the lock of a job, i.e. runs it. """
+        try:
+            with file_lock(os.path.join(job.job_dir, "lock"), blocking=False):
+                return False
+        except BlockingIOError:
+            return True
+
+    def _run(self, job):
+        # one process at a time runs a job; another one may have finished it while this one waited
+        with file_lock(os.path.join(job.job_dir, "lock")):
+            job.reload()
+            if job.status == "done":
+                return
+            # every span of the job (parsing, embedding, LLM calls, reduce) goes into its breakdown
+            with tracer.trace(job.job_id):
+                if self.lane is not None:
+                    with self.lane.slot(job.spec['user']):
+                        self._execute(job)
+                else:
+                    self._execute(job)
+
+    def _execute(self, job):
+        spec, doc_reader = job.spec, self.doc_reader
+        document = os.path.join(job.job_dir, spec['document'])
+        try:
+            job.check()
+            job.status, job.started, job.done_at_start = "running", time.time(), len(job.done)
+            job.save()
+
+            if spec['is_text']:
+                with open(document, "r", encoding="utf-8") as f:
+                    doc_path, text = None, f.read()
+            else:
+                doc_path, text = document, None
+            # the summary starts on the first chunks while later pages are still parsed and embedded
+            chunks = doc_reader.chunk_stream(
+                doc_path, text, chunk_size=spec['chunk_size'], chunk_overlap=spec['chunk_overlap'],
+                )
+            previous = self.previous_result(job)
+            if previous is not None or spec['summary_option'] == "segmented_refine":
+                # (except for an update or segments, which need every chunk before the first call)
+                chunks = chunks.store()
+                self.plan(job, chunks, previous)
+
+            for result in doc_reader.summarize_stream(
+                    chunks, spec['templates'],
+                    summary_option=spec['summary_option'],
+                    temperature=spec['temperature'], max_tokens=spec['max_tokens'],
+                    translate_context_tokens=spec.get('translate_context_tokens', 0),
+                    refine_segments=job.progress.get('segments'),
+                    pack=spec.get('pack', False), previous=previous,
+                    save_path=job.save_path, checkpoint=job,
+                    ):
+                job.result = result
+                if job.progress.get('estimate') is None:
+                    if chunks.finished:
+                        self.plan(job, chunks.store(), None)
+                    else:
+                        job.progress['chunks_read'] = len(chunks)
+            job.status = "done"
+            if spec.get('lineage') is not None:
+                self.record_version(spec['lineage'], job.job_id)
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status, job.error = "failed", repr(e)
+        job.save()
+
+    def plan(self, job, chunks, previous):
+        """ This function records the number of chunks, the changed chunks, the segments and the estimate of a job. """
+        spec = job.spec
+        job.progress['chunks_total'] = len(chunks)
+        job.progress.pop('chunks_read', None)
+        aligned = None
+        if previous is not None:
+            aligned = align_chunks(chunk_hashes(previous[1]), chunk_hashes(chunks))
+            job.progress['chunks_changed'] = sum(1 for old_id in aligned if old_id is None)
+        if spec['summary_option'] == "segmented_refine" and 'segments' not in job.progress:
+            job.progress['segments'] = self.doc_reader.refine_segments(
+                len(chunks), spec.get('refine_segments'), spec.get('refine_target_seconds'),
+                )
+        job.progress['estimate'] = self.doc_reader.estimate(
+            chunks, spec['templates'], spec['summary_option'], spec['max_tokens'], segments=job.progress.get('segments'),
+            pack=spec.get('pack', False), changed=aligned,
+            )
+        job.save()
+
+    def previous_result(self, job):
+        """ This function returns the result of the earlier version a job updates, or None. """
+        previous_id = job.spec.get('previous_job')
+        if previous_id is None or previous_id == job.job_id:
+            return None
+        previous = self.get(previous_id)
+        if previous is None or previous.status != "done":
+            return None
+        result = self.load_result(previous)
+        return result if len(result[1]) else None
+
+    def record_version(self, lineage, job_id):
+        """ This function makes a finished job the latest version of its document. """
+        with self.lock, file_lock(self.versions_path + ".lock"):
+            if os.path.exists(self.versions_path):
+                with open(self.versions_path, "r", encoding="utf-8") as f:
+                    self.versions = json.load(f)
+            self.versions[lineage] = job_id
+            with open(self.versions_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.versions, f, indent=4)
+            os.replace(self.versions_path + ".tmp", self.versions_path)
+
+    def breakdown(self, job):
+        """ This function returns the time and tokens per stage this process spent on a job (see `Tracer.breakdown`). """
+        return tracer.breakdown(job.job_id)
+
+    def load_result(self, job):
+        """ This function returns the latest (total_summary, chunk_summaries, section_summaries) of a job. """
+        if job.result is None and job.status == "done" and os.path.exists(job.save_path):
+            job.result = load_result(job.save_path)
+        return job.result or ("", [], [])
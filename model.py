@@ -1,208 +1,1166 @@
-import os, json 
+import os, re, json, math, queue, shutil, difflib, hashlib, threading
+from collections import OrderedDict
+from concurrent.futures import wait, FIRST_COMPLETED
 
 from langchain.prompts import PromptTemplate
 
-from langchain.chat_models import ChatOpenAI
-from langchain.chains.summarize import load_summarize_chain
-from langchain.chains import RetrievalQA
-
-from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.vectorstores import Chroma
-from langchain.text_splitter import CharacterTextSplitter, TokenTextSplitter
-from langchain.document_loaders import * 
 from langchain.docstore.document import Document
 
 from prompts import * 
+from cache import EmbeddingCache, CachedEmbeddings, LLMCache, AskCache, text_hash
+from scheduler import RateLimitedExecutor
+from ingest import SPLITTERS, make_splitter, iter_pages, count_tokens, get_encoding
+from backends import OpenAIBackend, ClientRegistry, LocalEmbeddings, LOCAL_PREFIX
+from retrieval import BM25Index, HybridRetriever, RETRIEVAL_MODES
+from tracing import tracer
+from store import CollectionManager, detach_chroma, file_lock
+from docstore import ChunkStore, ChunkStoreWriter, SummaryRows, save_result, load_result
+
+SUMMARY_FILES = {
+    "map_reduce": "total_summary.json",
+    "refine": "total_refine.json",
+    "segmented_refine": "total_segmented_refine.json",
+    "translate": "total_translate.json",
+}
+
+TRANSLATION_EXPANSION = 1.5     # translation tokens per source token, to keep translations within max_tokens
+
+MIN_SEGMENT_CHUNKS = 4          # shorter refine segments lose what refine is for: context carried across chunks
+DEFAULT_CALL_SECONDS = 15.0     # assumed LLM call latency until calls have been timed
+
+# * Packing several chunks into one request
+PACK_MAX_CHUNKS = 8             # chunks per packed request
+PACK_SUMMARY_TOKENS = 150       # output tokens assumed per chunk summary, so a pack's summaries fit in max_tokens
+PACK_MARKER_PATTERN = re.compile(r'^[ \t]*<<<(\d+)>>>[ \t]*$', re.MULTILINE)
+
+def pack_groups(items, budget, max_tokens=None, expansion=None, max_chunks=PACK_MAX_CHUNKS):
+    """ This function lazily groups consecutive (item, tokens) pairs into packs of at most `max_chunks` items and `budget` tokens. """
+    group, used = [], 0
+    for item, tokens in items:
+        tokens += 4     # the marker line
+        output = (used + tokens) * expansion if expansion else (len(group) + 1) * PACK_SUMMARY_TOKENS
+        if group and (used + tokens > budget or len(group) >= max_chunks or (max_tokens and output > max_tokens)):
+            yield group
+            group, used = [], 0
+        group.append(item)
+        used += tokens
+    if group:
+        yield group
+
+def split_packed(completion, count):
+    """ This function cuts the answer to a packed request into its `count` per-passage outputs, None where a passage is missing or may be cut short. """
+    outputs = [None] * count
+    marks = list(PACK_MARKER_PATTERN.finditer(completion))
+    for k, mark in enumerate(marks):
+        number = int(mark.group(1))
+        end = marks[k + 1].start() if k + 1 < len(marks) else len(completion)
+        text = completion[mark.end():end].strip()
+        if 1 <= number <= count and text and outputs[number - 1] is None:
+            outputs[number - 1] = text
+    if None in outputs and marks:
+        number = int(marks[-1].group(1))
+        if 1 <= number <= count:
+            outputs[number - 1] = None
+    return outputs
+
+# * Versions of a document
+
+def chunk_hashes(chunks):
+    """ This function returns the content hashes of chunks, or of the chunks of summary rows. """
+    if hasattr(chunks, 'hashes'):
+        return chunks.hashes()      # stored (see `docstore.ChunkStore`)
+    return [text_hash(chunk['chunk_content'] if isinstance(chunk, dict) else chunk.page_content) for chunk in chunks]
+
+def align_chunks(old_hashes, new_hashes):
+    """ This function returns, per chunk of a new version of a document, the index of the identical chunk of the previous version, or None if it changed. """
+    aligned = [None] * len(new_hashes)
+    matcher = difflib.SequenceMatcher(None, old_hashes, new_hashes, autojunk=False)
+    for old_start, new_start, size in matcher.get_matching_blocks():
+        for k in range(size):
+            aligned[new_start + k] = old_start + k
+    return aligned
+
+def previous_groups(num_chunks, section_summaries, total_summary):
+    """ This function rebuilds the reduce tree of a previous map_reduce result as one (groups, summaries) pair per level. """
+    ranges = [(i, i + 1) for i in range(num_chunks)]
+    levels = []
+    for level in section_summaries + [[{'chunk_range': [0, num_chunks], 'summary': total_summary}]]:
+        starts = {start: i for i, (start, _) in enumerate(ranges)}
+        ends = {end: i for i, (_, end) in enumerate(ranges)}
+        groups = []
+        for section in level:
+            start, end = section['chunk_range']
+            if start not in starts or end not in ends:
+                return levels
+            groups.append(list(range(starts[start], ends[end] + 1)))
+        levels.append((groups, [section['summary'] for section in level]))
+        ranges = [tuple(section['chunk_range']) for section in level]
+    return levels
+
+# * Chunks of a document that is still being ingested
+
+def settle(chunks):
+    """ This function returns chunks as a sequence: a `ChunkStream` as its chunk store, a lazy iterable as a list. """
+    if isinstance(chunks, ChunkStream):
+        return chunks.store()
+    return chunks if isinstance(chunks, (list, ChunkStore)) else list(chunks)
+
+class ChunkStream(object):
+    """ This class counts the chunks of a `DocumentReader.load_stream` run as they arrive and reads them back from its chunk store. """
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.source = None
+        self.count = 0
+        self.finished = False
+        self.retriever = None
+
+    def content(self, i):
+        return self.source.content(i)
+
+    def __len__(self):
+        return len(self.retriever.chunks) if self.finished else self.count
+
+    def __iter__(self):
+        if self.finished:
+            yield from self.retriever.chunks
+            return
+        stream, self.stream = self.stream, None
+        if stream is None:
+            raise RuntimeError("the chunk stream is already being iterated")
+        while True:
+            try:
+                chunk = next(stream)
+            except StopIteration as stop:
+                self.retriever, self.finished = stop.value, True
+                return
+            self.count += 1
+            yield chunk
+
+    def store(self):
+        """ This function runs the rest of the ingestion and returns the chunks as a `docstore.ChunkStore`. """
+        if not self.finished:
+            for _ in self:
+                pass
+        return self.retriever.chunks
 
 class DocumentReader(object):
     """ This class loads a document. """
-    def __init__(self, db_dir='db', chunk_size=1000, chunk_overlap=0):
+    def __init__(
+            self, db_dir='db', chunk_size=None, chunk_overlap=0, splitter='structured',
+            model_name='gpt-3.5-turbo', embedding_model='text-embedding-ada-002',
+            max_concurrency=8, requests_per_minute=3500, tokens_per_minute=90000,
+            embedding_requests_per_minute=3000, embedding_tokens_per_minute=1000000,
+            llm_cache_ttl=None, cache_nonzero_temperature=False,
+            backend=None, max_open_collections=32,
+            retrieval="hybrid", rrf_k=60, fusion_weights=(1.0, 1.0), fetch_k=20,
+            ask_cache_size=1024, ask_cache_threshold=0.98,
+            http_pool_size=None,
+            trace_path=None,
+            max_store_bytes=None,
+            ):
         self.db_dir = db_dir
-        self.chunk_size = chunk_size
+        self.chunk_size = chunk_size            # None: the largest chunk that fits the model context
         self.chunk_overlap = chunk_overlap
+        self.splitter = splitter
+
+        # * Model services (OpenAI unless another backend, e.g. backends.FakeBackend, is given)
+        # (by default the HTTP pool has a connection for every concurrent call)
+        self.backend = backend or OpenAIBackend(model_name, embedding_model, http_pool_size=http_pool_size or max_concurrency + 1)
+        self.registry = ClientRegistry()        # chat models, embeddings and prompts, reused across calls
+        self.model_name = self.backend.model_name
+        # ("local:<model>" embeds on the CPU, see backends.LocalEmbeddings)
+        self.embedding_model = embedding_model if embedding_model.startswith(LOCAL_PREFIX) else self.backend.embedding_model
+        self.context_window = self.backend.context_window
+
+        # * Shared, rate-limited pool for concurrent LLM calls
+        self.executor = RateLimitedExecutor(
+            max_workers=max_concurrency,
+            requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+            )
+        # embedding requests have their own limits and only run in the loading thread
+        self.embedding_executor = RateLimitedExecutor(
+            max_workers=1,
+            requests_per_minute=embedding_requests_per_minute, tokens_per_minute=embedding_tokens_per_minute,
+            name="embed",
+            )
 
         self.summary_dir = os.path.join(self.db_dir, "summaries")
         os.makedirs(self.summary_dir, exist_ok=True)
-        
-    def load(
-            self, doc_path, text=None,
-            collection_name='langchain',
-            db_dir='db', chunk_size=1000, chunk_overlap=0,
-            debug=False,
-            ):
-        """ This function loads a document. """
-        # text_splitter = CharacterTextSplitter.from_tiktoken_encoder(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        text_splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
 
+        # * Per-chunk embedding cache shared by all documents
+        self.embedding_cache = EmbeddingCache(os.path.join(self.db_dir, "embeddings.sqlite"))
+
+        # * Recently opened collections, shared by all sessions
+        self.collections = OrderedDict()
+        self.collections_lock = threading.Lock()
+        self.max_open_collections = max_open_collections
+        self.ingest_locks = {}
+
+        # * One collection per document version, evicted least recently used first beyond `max_store_bytes`
+        self.store = CollectionManager(self.db_dir, quota_bytes=max_store_bytes)
+
+        # * Retrieval for ask: BM25 and/or vector search, fused by reciprocal rank
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError("Invalid retrieval mode: {}".format(retrieval))
+        self.retrieval = retrieval
+        self.rrf_k = rrf_k
+        self.fusion_weights = fusion_weights
+        self.fetch_k = fetch_k
+
+        # * Answers to earlier (or near-identical) questions, per document
+        self.ask_cache = AskCache(max_entries=ask_cache_size, threshold=ask_cache_threshold)
+
+        # * Completion cache shared by summarize, ask and translate
+        self.llm_cache = LLMCache(os.path.join(self.db_dir, "llm_cache.sqlite"), ttl=llm_cache_ttl)
+        self.cache_nonzero_temperature = cache_nonzero_temperature
+
+        # * Per-stage spans (see `tracing.Tracer`), also appended to `trace_path` if given
+        if trace_path is not None:
+            tracer.open(trace_path)
+
+    def metrics(self):
+        """ This function returns gauges of the queues and caches, for `Tracer.add_collector`. """
+        gauges = {
+            'llm_queued_calls': self.executor.queued,
+            'embed_queued_calls': self.embedding_executor.queued,
+            'open_collections': len(self.collections),
+        }
+        for key, value in self.ask_cache.stats().items():
+            gauges['ask_cache_' + key] = value
+        for key, value in self.registry.stats().items():
+            gauges['client_registry_' + key] = value
+        return gauges
+
+    def ingest_key(self, doc_path, text=None, chunk_size=None, chunk_overlap=None, splitter=None, embedding_model=None):
+        """ This function computes the key of an ingestion from the document content and every setting that changes its chunks or vectors. """
+        chunk_size = self.resolve_chunk_size(chunk_size)
+        chunk_overlap = self.chunk_overlap if chunk_overlap is None else chunk_overlap
+        splitter = SPLITTERS[splitter or self.splitter].__name__
+        h = hashlib.sha256()
+        h.update(json.dumps([chunk_size, chunk_overlap, splitter, embedding_model or self.embedding_model]).encode('utf-8'))
         if text is not None and len(text) > 0:
-            # convert the text into a Document object
-            # text_doc = Document(page_content=text)
-      
-            texts = text_splitter.split_text(text)
-            chunks = [Document(page_content=chunk) for chunk in texts]
+            h.update(b'text:' + text.encode('utf-8'))
         else:
-            loader = UnstructuredFileLoader(doc_path)
-            # if os.path.splitext(doc_path)[1] in ['.doc', '.docx']:
-            #     loader = UnstructuredWordDocumentLoader(doc_path)
-            # elif os.path.splitext(doc_path)[1] in ['.pdf']:
-            #     loader = UnstructuredPDFLoader(doc_path)
-            # else:
-            #     raise ValueError("Invalid document type: {}".format(os.path.splitext(doc_path)[1]))
-            documents = loader.load()
-            
-            chunks = text_splitter.split_documents(documents)
-
-        embedding = OpenAIEmbeddings(model='text-embedding-ada-002')
-
-        # create the vector store (if it doesn't exist)
-        if debug:
-            vectordb = Chroma(persist_directory=db_dir, embedding_function=embedding, collection_name=collection_name)
+            h.update(b'file:')
+            with open(doc_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+        return h.hexdigest()[:32]
+
+    def chunk_budget(self, summary_option="map_reduce", templates=None, max_tokens=1000):
+        """ This function computes the largest chunk (in tokens) one call of a summary option can take next to its template and output. """
+        templates = templates or DEFAULT_TEMPLATES
+        if summary_option in ("refine", "segmented_refine"):
+            overhead = max(
+                count_tokens(templates['refine_initial_prompt_template'].format(text="")),
+                count_tokens(templates['refine_prompt_template'].format(existing_answer="", text="")) + max_tokens,
+                )
+        elif summary_option == "translate":
+            overhead = count_tokens(templates['translate_prompt_template'].format(text=""))
         else:
-            vectordb  = Chroma.from_documents(
-                documents=chunks, embedding=embedding, persist_directory=db_dir, collection_name=collection_name
+            overhead = count_tokens(templates['map_prompt_template'].format(text=""))
+        budget = self.context_window - max_tokens - overhead
+        if summary_option == "translate":
+            budget = min(budget, int(max_tokens / TRANSLATION_EXPANSION))
+        return max(budget, 100)
+
+    def resolve_chunk_size(self, chunk_size=None, **budget_kwargs):
+        """ This function returns `chunk_size`, else the reader's default, else the `chunk_budget`. """
+        return int(chunk_size or self.chunk_size or self.chunk_budget(**budget_kwargs))
+
+    def ask_chunk_size(self, doc_path, text=None, chunk_size=None, chunk_overlap=None, templates=None, max_tokens=1000):
+        """ This function returns the chunk size of the newest collection the document has at a default size, else the `chunk_budget`. """
+        if chunk_size or self.chunk_size:
+            return self.resolve_chunk_size(chunk_size)
+        found = []
+        for summary_option in SUMMARY_FILES:
+            size = self.chunk_budget(summary_option, templates, max_tokens)
+            _, chunks_path = self.store.paths(self.ingest_key(doc_path, text, size, chunk_overlap))
+            if os.path.exists(chunks_path):
+                found.append((os.path.getmtime(chunks_path), size))
+        if found:
+            return max(found)[1]
+        return self.chunk_budget(templates=templates, max_tokens=max_tokens)
+
+    def split(self, doc_path, text=None, chunk_size=None, chunk_overlap=None):
+        """ This function lazily parses and splits a document, without embedding it. """
+        chunk_size = self.resolve_chunk_size(chunk_size)
+        chunk_overlap = self.chunk_overlap if chunk_overlap is None else chunk_overlap
+        text_splitter = make_splitter(self.splitter, chunk_size, chunk_overlap)
+        if text is not None and len(text) > 0:
+            pages = [Document(page_content=text)]
+        else:
+            pages = iter_pages(doc_path)
+        # (the split span does not count the parsing, which happens inside it)
+        return tracer.timed("split", text_splitter.split(tracer.timed("parse", pages)), splitter=self.splitter)
+
+    def estimate(self, chunks, templates, summary_option="map_reduce", max_tokens=1000, reduce_token_budget=None, segments=None, pack=False, changed=None):
+        """ This function estimates the LLM calls and tokens (upper bounds for reduce and merge) a summary of these chunks will take. """
+        texts = [chunk.page_content for chunk in chunks]
+        sent = texts
+        if changed is not None and summary_option in ("map_reduce", "translate"):
+            sent = [text for text, old_id in zip(texts, changed) if old_id is None]
+        elif changed is not None and summary_option == "refine":
+            prefix = 0
+            while prefix < len(changed) and changed[prefix] == prefix:
+                prefix += 1
+            sent = texts[prefix:]
+        if summary_option in ("refine", "segmented_refine"):
+            template = templates['refine_prompt_template'].format(existing_answer="", text="")
+            prompt_tokens = sum(count_tokens(text) for text in sent) + len(sent) * (count_tokens(template) + max_tokens)
+        else:
+            key = 'translate_prompt_template' if summary_option == "translate" else 'map_prompt_template'
+            template = templates[key].format(text="")
+            prompt_tokens = sum(count_tokens(text) for text in sent) + len(sent) * count_tokens(template)
+        calls = len(sent)
+        if pack and summary_option in ("map_reduce", "translate"):
+            expansion = TRANSLATION_EXPANSION if summary_option == "translate" else None
+            instruction = count_tokens(PACK_INSTRUCTION_TEMPLATE.format(count=PACK_MAX_CHUNKS))
+            budget = self.chunk_budget(summary_option, templates, max_tokens) - instruction
+            groups = list(pack_groups(((None, count_tokens(text)) for text in sent), budget, max_tokens, expansion))
+            calls = len(groups)
+            prompt_tokens += sum(instruction + 4 * len(group) for group in groups if len(group) > 1) - (len(sent) - calls) * count_tokens(template)
+
+        if summary_option in ("map_reduce", "segmented_refine") and texts:
+            key = 'combine_prompt_template' if summary_option == "map_reduce" else 'refine_merge_prompt_template'
+            combine = count_tokens(templates[key].format(text=""))
+            budget = (reduce_token_budget or self.context_window - max_tokens) - combine
+            per_group = max(2, budget // (max_tokens + 2))
+            summaries = len(texts) if summary_option == "map_reduce" else self.refine_segments(len(texts), segments)
+            while summary_option == "map_reduce" or summaries > 1:
+                groups = -(-summaries // per_group)
+                calls += groups
+                prompt_tokens += groups * combine + summaries * (max_tokens + 2)
+                if groups == 1:
+                    break
+                summaries = groups
+
+        return {
+            'chunks': len(texts),
+            'calls': calls,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': calls * max_tokens,
+            'total_tokens': prompt_tokens + calls * max_tokens,
+        }
+
+    def refine_segments(self, num_chunks, segments=None, target_seconds=None):
+        """ This function decides into how many segments a segmented refine cuts the chunks. """
+        if segments:
+            return max(1, min(int(segments), num_chunks))
+        if target_seconds:
+            latency = tracer.mean("llm_call") or DEFAULT_CALL_SECONDS
+            segments = math.ceil(num_chunks * latency / max(target_seconds - latency, latency))
+        else:
+            segments = num_chunks // MIN_SEGMENT_CHUNKS
+        return max(1, min(segments, num_chunks, self.executor.max_workers))
+
+    def plan(self, doc_path, text, templates, summary_option="map_reduce", chunk_size=None, max_tokens=1000):
+        """ This function splits a document (without embedding it) and estimates its summary, see `estimate`. """
+        chunk_size = self.resolve_chunk_size(chunk_size, summary_option=summary_option, templates=templates, max_tokens=max_tokens)
+        chunks = list(self.split(doc_path, text, chunk_size))
+        return dict(self.estimate(chunks, templates, summary_option, max_tokens), chunk_size=chunk_size)
+
+    def load(self, doc_path, text=None, **kwargs):
+        """ This function loads a document; returns its chunk store and its retriever. """
+        stream = self.load_stream(doc_path, text, **kwargs)
+        while True:
+            try:
+                next(stream)
+            except StopIteration as stop:
+                return stop.value.chunks, stop.value
+
+    def chunk_stream(self, doc_path, text=None, **kwargs):
+        """ This function starts loading a document; returns a `ChunkStream` over `load_stream`. """
+        chunks = ChunkStream()
+        chunks.stream = self.load_stream(doc_path, text, sink=chunks, **kwargs)
+        return chunks
+
+    def load_stream(
+            self, doc_path, text=None,
+            collection_name=None,
+            db_dir=None, chunk_size=None, chunk_overlap=None,
+            embed_batch_size=256, chunks=None,
+            embedding_model=None,
+            sink=None,
+            ):
+        """ This function loads a document through the ingestion cache, yielding chunks as they are produced; returns the retriever. """
+        db_dir = db_dir or self.db_dir
+        store = self.store if db_dir == self.db_dir else None      # only the reader's own db_dir is managed
+        chunk_size = self.resolve_chunk_size(chunk_size)
+        chunk_overlap = self.chunk_overlap if chunk_overlap is None else chunk_overlap
+        embedding_model = embedding_model or self.embedding_model
+        key = self.ingest_key(doc_path, text, chunk_size, chunk_overlap, embedding_model=embedding_model)
+        collection_name = collection_name or key
+        persist_dir = os.path.join(db_dir, "collections", key)
+        chunks_path = os.path.join(db_dir, "chunks", key)
+
+        embedding = self._embeddings(embedding_model)
+
+        # * Cache hit: reopen the chunks and the persisted collection
+        # (a session that finds another one ingesting the same document waits for it)
+        lock = self._ingest_lock(persist_dir)
+        with lock:
+            hit = os.path.exists(chunks_path)
+        if hit:
+            if store is not None:
+                store.touch(key)
+            retriever = yield from self._read_collection(persist_dir, chunks_path, embedding, collection_name, sink)
+            return retriever
+
+        # (the file lock makes other processes sharing the db_dir, e.g. the workers of api.py, wait as well)
+        with lock, file_lock(os.path.join(db_dir, "locks", key)):
+            retriever = yield from self._build_collection(
+                doc_path, text, persist_dir, chunks_path, embedding, collection_name,
+                chunk_size, chunk_overlap, embed_batch_size, chunks, sink,
                 )
+        if store is not None:
+            store.add(key, source=os.path.basename(doc_path) if doc_path and not text else None,
+                      collection_name=collection_name, chunks=len(retriever.chunks), embedding_model=embedding_model)
+            self.evict()
+        return retriever
 
-        return chunks, vectordb
+    def _read_collection(self, persist_dir, chunks_path, embedding, collection_name, sink=None):
+        """ This function yields the persisted chunks of a collection and returns its retriever. """
+        chunks = ChunkStore(chunks_path)
+        if sink is not None:
+            sink.source = chunks
+        yield from chunks
+        return self._open_collection(persist_dir, embedding, collection_name, chunks)
+
+    def _build_collection(
+            self, doc_path, text, persist_dir, chunks_path, embedding, collection_name,
+            chunk_size, chunk_overlap, embed_batch_size, chunks, sink=None,
+            ):
+        """ This function splits a document and builds its collection, yielding the chunks. """
+        # another session may have finished the same document while this one waited
+        if os.path.exists(chunks_path):
+            retriever = yield from self._read_collection(persist_dir, chunks_path, embedding, collection_name, sink)
+            return retriever
+
+        # * Cache miss: split page by page and build a fresh collection under the key
+        # (dropping what an interrupted earlier ingestion may have left behind)
+        with self.collections_lock:
+            self.collections.pop((persist_dir, collection_name), None)
+        shutil.rmtree(persist_dir, ignore_errors=True)
+        vectordb = self._chroma(persist_dir, embedding, collection_name)
+        if chunks is None:
+            chunks = self.split(doc_path, text, chunk_size, chunk_overlap)
+
+        os.makedirs(os.path.dirname(chunks_path), exist_ok=True)
+        index, writer = BM25Index(), ChunkStoreWriter(chunks_path)
+        if sink is not None:
+            sink.source = writer
+        try:
+            batch = []
+            for chunk in chunks:
+                writer.add(chunk.page_content, chunk.metadata)
+                index.add(chunk.page_content)
+                batch.append(chunk)
+                yield chunk
+                if len(batch) >= embed_batch_size:
+                    self._write_vectors(vectordb, batch)
+                    batch = []
+            if batch:
+                self._write_vectors(vectordb, batch)
+            with tracer.span("vector_write", chunks=0):
+                vectordb.persist()
+                index.save(os.path.join(persist_dir, "bm25.json"))
+        except BaseException:
+            writer.abort()
+            raise
+
+        # the chunk store is moved in place last, so a half-built collection is never a hit
+        writer.close()
+        chunks = ChunkStore(chunks_path)
+        if sink is not None:
+            sink.source = chunks
+
+        retriever = self._retriever(persist_dir, vectordb, index, chunks, embedding)
+        with self.collections_lock:
+            self.collections[(persist_dir, collection_name)] = retriever
+            while len(self.collections) > self.max_open_collections:
+                self.collections.popitem(last=False)
+        return retriever
+
+    def _write_vectors(self, vectordb, batch):
+        """ This function embeds and writes a batch of chunks to the vector store (the embedding has its own spans). """
+        with tracer.span("vector_write", chunks=len(batch)):
+            vectordb.add_documents(batch)
+
+    def _ingest_lock(self, persist_dir):
+        """ This function returns the lock that serializes ingestions of one collection. """
+        with self.collections_lock:
+            return self.ingest_locks.setdefault(persist_dir, threading.Lock())
     
-    def summarize(
+    def _open_collection(self, persist_dir, embedding, collection_name, chunks):
+        """ This function opens the retriever of a persisted collection, reusing the ones opened recently. """
+        key = (persist_dir, collection_name)
+        with self.collections_lock:
+            retriever = self.collections.get(key)
+            if retriever is None:
+                vectordb = self._chroma(persist_dir, embedding, collection_name)
+                index_path = os.path.join(persist_dir, "bm25.json")
+                if os.path.exists(index_path):
+                    index = BM25Index.load(index_path)
+                else:
+                    index = BM25Index()
+                    for chunk in chunks:
+                        index.add(chunk.page_content)
+                    index.save(index_path)
+                retriever = self.collections[key] = self._retriever(persist_dir, vectordb, index, chunks, embedding)
+            self.collections.move_to_end(key)
+            while len(self.collections) > self.max_open_collections:
+                self.collections.popitem(last=False)
+        return retriever
+
+    def _chroma(self, persist_dir, embedding, collection_name):
+        """ This function opens a Chroma collection that is only written to disk by explicit `persist` calls. """
+        return detach_chroma(Chroma(persist_directory=persist_dir, embedding_function=embedding, collection_name=collection_name))
+
+    def evict(self):
+        """ This function evicts least recently used collections beyond `max_store_bytes`, except open ones; returns their keys. """
+        with self.collections_lock:
+            protect = set(os.path.basename(persist_dir) for persist_dir, _ in self.collections)
+            protect.update(os.path.basename(persist_dir) for persist_dir, lock in self.ingest_locks.items() if lock.locked())
+        evicted = self.store.evict(protect=protect)
+        with self.collections_lock:
+            for key in evicted:
+                persist_dir = self.store.paths(key)[0]
+                if key not in protect and not self.ingest_locks.get(persist_dir, threading.Lock()).locked():
+                    self.ingest_locks.pop(persist_dir, None)
+        return evicted
+
+    def compact(self, key):
+        """ This function rebuilds the collection and BM25 index of an ingestion from its chunk store; returns False when its embedding model is unknown. """
+        persist_dir, chunks_path = self.store.paths(key)
+        entry = self.store.entries.get(key) or {}
+        collection_name = entry.get('collection_name') or key
+        if not entry.get('embedding_model'):
+            return False
+        try:
+            embedding = self._embeddings(entry['embedding_model'])
+        except ValueError:
+            return False
+        with self._ingest_lock(persist_dir):
+            with self.collections_lock:
+                for open_key in [open_key for open_key in self.collections if open_key[0] == persist_dir]:
+                    del self.collections[open_key]
+            chunks = ChunkStore(chunks_path)
+
+            staging = persist_dir + ".compact"
+            shutil.rmtree(staging, ignore_errors=True)
+            vectordb = self._chroma(staging, embedding, collection_name)
+            index = BM25Index()
+            for start in range(0, len(chunks), 256):
+                self._write_vectors(vectordb, chunks[start:start + 256])
+            for chunk in chunks:
+                index.add(chunk.page_content)
+            vectordb.persist()
+            index.save(os.path.join(staging, "bm25.json"))
+
+            # swap only once the new collection is complete, so an interrupted compaction keeps the old one
+            shutil.rmtree(persist_dir + ".old", ignore_errors=True)
+            if os.path.exists(persist_dir):
+                os.rename(persist_dir, persist_dir + ".old")
+            os.rename(staging, persist_dir)
+            shutil.rmtree(persist_dir + ".old", ignore_errors=True)
+        self.store.resize(key)
+        return True
+
+    def _retriever(self, persist_dir, vectordb, index, chunks, embedding):
+        return HybridRetriever(
+            vectordb, index, chunks,
+            rrf_k=self.rrf_k, weights=self.fusion_weights, fetch_k=self.fetch_k,
+            key=os.path.basename(persist_dir), embedding=embedding,
+            )
+
+    def summarize(self, chunks, templates, **kwargs):
+        """ This function summarizes a document; the section summaries are in the saved result (see `section_summaries`). """
+        for total_summary, chunk_summaries, _ in self.summarize_stream(chunks, templates, **kwargs):
+            pass
+        return total_summary, chunk_summaries
+
+    def section_summaries(self, summary_option="map_reduce", save_path=None):
+        """ This function returns the section summaries of each reduce level of the last saved summary. """
+        return load_result(save_path or os.path.join(self.summary_dir, SUMMARY_FILES[summary_option]))[2]
+
+    def summarize_stream(
             self, chunks, 
             # map_prompt_template=MAP_PROMPT_TEMPLATE,
             # combine_prompt_template=COMBINE_PROMPT_TEMPLATE,
             templates,
             summary_option="map_reduce",
             temperature=0.0, max_tokens=1000,
+            reduce_token_budget=None,
+            save_path=None,
+            translate_context_tokens=0,
+            refine_segments=None, refine_target_seconds=None,
+            pack=False,             # several consecutive small chunks per map request
+            previous=None,          # the result of an earlier version, reused where its chunks did not change
+            checkpoint=None,        # a `jobs.Job`: its finished chunks are skipped, new ones recorded
             debug=False,
             ):
-        """ This function summarizes a document. """
+        """ This function summarizes a document, yielding (total_summary, chunk_summaries, section_summaries) as results arrive. """
         # save the summaries
-        if summary_option == "map_reduce":
-            save_path = os.path.join(self.summary_dir, "total_summary.json")
-        elif summary_option == "refine":
-            save_path = os.path.join(self.summary_dir, "total_refine.json")
-        elif summary_option == "translate":
-            save_path = os.path.join(self.summary_dir, "total_translate.json")
-        else:
+        if summary_option not in SUMMARY_FILES:
             raise ValueError("Invalid summary option: {}".format(summary_option))
+        if save_path is None:
+            save_path = os.path.join(self.summary_dir, SUMMARY_FILES[summary_option])
         
         if debug and os.path.exists(save_path):
-            with open(save_path, "r") as f:
-                data = json.load(f)
-            return data["total_summary"], data["chunk_summaries"]
+            yield load_result(save_path)
+            return
         
         # Setup the LLM
-        llm = ChatOpenAI(
-            model_name='gpt-3.5-turbo',
-            temperature=temperature,
-            max_tokens=max_tokens,
-            )
+        llm = self._llm(temperature, max_tokens)
+
+        total_summary, section_summaries = "", []
+
+        # * Previous version: the summaries of unchanged chunks are reused (translate aligns in `translate_stream`)
+        aligned, reused = None, {}
+        if previous is not None and summary_option != "translate":
+            chunks = settle(chunks)
+            aligned, reused = self._reusable(chunks, previous, summary_option)
+        if summary_option == "segmented_refine":
+            chunks = settle(chunks)     # (the segments need the full chunk list)
+        done = dict(reused)
+        done.update(checkpoint.done if checkpoint is not None else {})
+
+        # (rows hold positions, not chunk texts: those are read back from `chunks` when a row is shown or saved)
+        chunk_summaries = SummaryRows(chunks)
+
+        def entry(chunk_id, chunk, summary):
+            chunk_summaries.add(chunk_id, chunk, summary, None if aligned is None else aligned[chunk_id] is None)
         
         if summary_option == "map_reduce":
             map_prompt_template = templates['map_prompt_template']
-            map_prompt = PromptTemplate(template=map_prompt_template, input_variables=["text"])
+            map_prompt = self._prompt(map_prompt_template, ["text"])
 
             combine_prompt_template = templates['combine_prompt_template']
-            combine_prompt = PromptTemplate(template=combine_prompt_template, input_variables=["text"])
-
-            chain = load_summarize_chain(
-                llm=llm, chain_type="map_reduce",
-                map_prompt=map_prompt,
-                combine_prompt=combine_prompt,
-                verbose=True, 
-                return_intermediate_steps=True,
-            )
+            combine_prompt = self._prompt(combine_prompt_template, ["text"])
+
+            # * Map: one concurrent call per chunk (or per pack of chunks), streamed as each call finishes
+            def map_chunks():
+                for chunk_id, chunk in enumerate(chunks):
+                    entry(chunk_id, chunk, done.get(chunk_id, ""))
+                    if chunk_id in done:
+                        continue
+                    if checkpoint is not None:
+                        checkpoint.check()
+                    yield chunk_id, chunk.page_content
+
+            if pack:
+                results = self._map_packed(
+                    llm, map_prompt, map_chunks(), max_tokens, self.chunk_budget("map_reduce", templates, max_tokens),
+                    )
+            else:
+                results = self._map_chunks(
+                    llm, ((chunk_id, map_prompt.format(text=text)) for chunk_id, text in map_chunks()), max_tokens,
+                    )
+            for chunk_id, chunk_summary, tokens in results:
+                chunk_summaries.set(chunk_id, chunk_summary)
+                if checkpoint is not None:
+                    checkpoint.record(chunk_id, chunk_summary, tokens)
+                    checkpoint.check()
+                yield total_summary, chunk_summaries, section_summaries
+
+            # * Combine: reduce the chunk summaries level by level within the token budget
+            # (by default, whatever the context leaves next to the output)
+            tree = None
+            if previous is not None:
+                tree = (
+                    [aligned[chunk_id] if chunk_id in reused else None for chunk_id in range(len(chunks))],
+                    previous_groups(len(previous[1]), previous[2], previous[0]),
+                    )
+            total_summary, section_summaries = self._reduce(
+                llm, chunk_summaries.summaries(), combine_prompt, max_tokens,
+                reduce_token_budget or self.context_window - max_tokens, previous=tree,
+                )
+        elif summary_option == "translate":
+            # * Translate: chunks are translated concurrently and kept in order, there is no combine step
+            for chunk_summaries, ready in self.translate_stream(
+                    chunks, templates,
+                    temperature=temperature, max_tokens=max_tokens,
+                    context_tokens=translate_context_tokens,
+                    output_path=os.path.splitext(save_path)[0] + ".txt",
+                    pack=pack,
+                    previous=previous,
+                    checkpoint=checkpoint,
+                    ):
+                yield total_summary, chunk_summaries, section_summaries
+            total_summary = "\n\n".join(chunk_summaries.summaries())
         elif summary_option == "refine":
             initial_prompt_template = templates['refine_initial_prompt_template']
-            initial_prompt = PromptTemplate(template=initial_prompt_template, input_variables=["text"])
+            initial_prompt = self._prompt(initial_prompt_template, ["text"])
 
             refine_prompt_template = templates['refine_prompt_template']
-            refine_prompt = PromptTemplate(template=refine_prompt_template, input_variables=["existing_answer", "text"])
-
-            chain = load_summarize_chain(
-                llm=llm, chain_type="refine",
-                question_prompt=initial_prompt,
-                refine_prompt=refine_prompt,
-                verbose=True, 
-                return_intermediate_steps=True,
+            refine_prompt = self._prompt(refine_prompt_template, ["existing_answer", "text"])
+
+            # * Refine: the running summary is updated with one chunk at a time
+            # (a checkpoint holds the running summary after each chunk, so a resumed run picks up from the last one)
+            for chunk_id, chunk in enumerate(chunks):
+                if chunk_id in done:
+                    total_summary = done[chunk_id]
+                    entry(chunk_id, chunk, total_summary)
+                    continue
+                if checkpoint is not None:
+                    checkpoint.check()
+                if chunk_id == 0:
+                    prompt = initial_prompt.format(text=chunk.page_content)
+                else:
+                    prompt = refine_prompt.format(existing_answer=total_summary, text=chunk.page_content)
+                total_summary = self._call(llm, prompt, max_tokens)
+                entry(chunk_id, chunk, total_summary)
+                if checkpoint is not None:
+                    checkpoint.record(chunk_id, total_summary, count_tokens(prompt) + count_tokens(total_summary))
+                yield total_summary, chunk_summaries, section_summaries
+        elif summary_option == "segmented_refine":
+            initial_prompt = self._prompt(templates['refine_initial_prompt_template'], ["text"])
+            refine_prompt = self._prompt(templates['refine_prompt_template'], ["existing_answer", "text"])
+            merge_prompt = self._prompt(templates['refine_merge_prompt_template'], ["text"])
+
+            # * Refine each segment concurrently
+            for chunk_id, chunk in enumerate(chunks):
+                entry(chunk_id, chunk, done.get(chunk_id, ""))
+            k = self.refine_segments(len(chunks), refine_segments, refine_target_seconds)
+            bounds = [(len(chunks) * i // k, len(chunks) * (i + 1) // k) for i in range(k)]
+            passes = self._refine_segments(llm, chunks, bounds, initial_prompt, refine_prompt, max_tokens, chunk_summaries, checkpoint)
+            while True:
+                try:
+                    next(passes)
+                except StopIteration as stop:
+                    drafts = stop.value
+                    break
+                yield total_summary, chunk_summaries, section_summaries
+
+            # * Merge the drafts, level by level if they do not fit in one prompt
+            section_summaries = [[{'chunk_range': list(bound), 'summary': draft} for bound, draft in zip(bounds, drafts)]]
+            if len(drafts) == 1:
+                total_summary = drafts[0]
+            else:
+                total_summary, levels = self._reduce(
+                    llm, drafts, merge_prompt, max_tokens,
+                    reduce_token_budget or self.context_window - max_tokens, separator="\n\n--------------\n\n",
+                    )
+                section_summaries += levels
+
+        # (the chunks are linked from their chunk store, not written out again)
+        save_result(save_path, total_summary, chunk_summaries, section_summaries, settle(chunks))
+
+        yield total_summary, chunk_summaries, section_summaries
+    
+    def _reusable(self, chunks, previous, summary_option, context=False):
+        """ This function aligns the chunks with a previous version; returns the alignment and the reusable summaries. """
+        old = previous[1]
+        aligned = align_chunks(chunk_hashes(old), chunk_hashes(chunks))
+        if summary_option == "segmented_refine":
+            return aligned, {}
+        if summary_option == "refine":
+            prefix = 0
+            while prefix < len(aligned) and aligned[prefix] == prefix and old[prefix]['chunk_summary']:
+                prefix += 1
+            return aligned, {chunk_id: old[chunk_id]['chunk_summary'] for chunk_id in range(prefix)}
+
+        reused = {}
+        for chunk_id, old_id in enumerate(aligned):
+            if old_id is None or not old[old_id]['chunk_summary']:
+                continue
+            if context and (aligned[chunk_id - 1] if chunk_id else None) != (old_id - 1 if old_id else None):
+                continue
+            reused[chunk_id] = old[old_id]['chunk_summary']
+        return aligned, reused
+
+    def _llm(self, temperature=0.0, max_tokens=None):
+        """ This function returns the chat model for these settings, built once; retries are left to the executor. """
+        return self.registry.get(
+            ('chat', self.model_name, temperature, max_tokens),
+            lambda: self.backend.chat(temperature, max_tokens),
             )
-        elif summary_option == "translate":
-            translate_prompt_template = templates['translate_prompt_template']
-            translate_prompt = PromptTemplate(template=translate_prompt_template, input_variables=["text"])
 
-            combine_prompt_template = templates['combine_prompt_template']
-            combine_prompt = PromptTemplate(template=combine_prompt_template, input_variables=["text"])
-
-            chain = load_summarize_chain(
-                llm=llm, chain_type="map_reduce",
-                map_prompt=translate_prompt,
-                combine_prompt=combine_prompt,
-                verbose=True, 
-                return_intermediate_steps=True,
+    def _prompt(self, template, input_variables):
+        """ This function returns the compiled prompt of a template text, built once per text. """
+        return self.registry.get(
+            ('prompt', template, tuple(input_variables)),
+            lambda: PromptTemplate(template=template, input_variables=list(input_variables)),
             )
+
+    def _embeddings(self, embedding_model=None):
+        """ This function returns the cached embedding function of a model, built once. """
+        embedding_model = embedding_model or self.embedding_model
+        if embedding_model.startswith(LOCAL_PREFIX):
+            factory = lambda: CachedEmbeddings(
+                LocalEmbeddings(embedding_model[len(LOCAL_PREFIX):]), self.embedding_cache, embedding_model,
+                )
+        elif embedding_model == self.backend.embedding_model:
+            factory = lambda: CachedEmbeddings(
+                self.backend.embeddings(), self.embedding_cache, embedding_model, executor=self.embedding_executor,
+                )
         else:
-            raise ValueError("Invalid summary option: {}".format(summary_option))
+            raise ValueError("Unknown embedding model: {}".format(embedding_model))
+        return self.registry.get(('embeddings', embedding_model), factory)
 
-        result = chain({"input_documents": chunks})
-        
-        total_summary = result["output_text"]
+    def _predict(self, llm, prompt, on_token=None):
+        """ This function sends one rendered prompt to the chat model, through the completion cache. """
+        cacheable = llm.temperature == 0 or self.cache_nonzero_temperature
+        if cacheable:
+            key = LLMCache.key(llm.model_name, llm.temperature, llm.max_tokens, prompt)
+            completion = self.llm_cache.get(key)
+            if completion is not None:
+                tracer.annotate(cached=1)
+                return completion
 
-        chunk_summaries = []
-        for chunk_doc, chunk_summary in zip(chunks, result["intermediate_steps"]):
-            chunk_summaries.append({'chunk_content': chunk_doc.page_content, 'chunk_summary': chunk_summary})
+        completion = llm.complete(prompt, on_token)
+        tracer.annotate(prompt_tokens=count_tokens(prompt), completion_tokens=count_tokens(completion))
 
-        with open(save_path, "w") as f:
-            data = {
-                "total_summary": total_summary,
-                "chunk_summaries": chunk_summaries,
-            }
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        if cacheable:
+            self.llm_cache.put(key, completion)
+        return completion
+
+    def _call(self, llm, prompt, max_tokens=None):
+        """ This function runs a single LLM call in the calling thread under the rate limits. """
+        return self.executor.call(self._predict, llm, prompt, cost=count_tokens(prompt) + (max_tokens or 0))
+
+    def _predict_stream(self, prompt, temperature=0.0, max_tokens=None):
+        """ This function streams one LLM call, yielding the completion accumulated so far. """
+        tokens = queue.Queue()
+        llm = self._llm(temperature, max_tokens)
+        future = self.executor.submit(self._predict, llm, prompt, tokens.put, cost=count_tokens(prompt) + (max_tokens or 0))
+        future.add_done_callback(lambda f: tokens.put(None))
+
+        completion = ""
+        for token in iter(tokens.get, None):
+            completion += token
+            yield completion
+        # the final completion also covers cache hits and retried attempts
+        yield future.result()
+
+    def _map_as_completed(self, llm, prompts, max_tokens=None, max_in_flight=None):
+        """ This function runs one LLM call per prompt concurrently, yielding (index, result) as each finishes. """
+        items = ((prompt, count_tokens(prompt) + (max_tokens or 0)) for prompt in prompts)
+        return self.executor.as_completed(lambda prompt: self._predict(llm, prompt), items, max_in_flight=max_in_flight)
+
+    def _map_chunks(self, llm, items, max_tokens=None, max_in_flight=None):
+        """ This function runs one LLM call per (chunk_id, prompt) concurrently, yielding (chunk_id, result, tokens) as each finishes. """
+        chunk_ids, prompts = [], []      # chunks actually sent, in submission order
+
+        def chunk_prompts():
+            for chunk_id, prompt in items:
+                chunk_ids.append(chunk_id)
+                prompts.append(prompt)
+                yield prompt
+
+        for i, result in self._map_as_completed(llm, chunk_prompts(), max_tokens, max_in_flight=max_in_flight):
+            yield chunk_ids[i], result, count_tokens(prompts[i]) + count_tokens(result)
+
+    def _map_packed(self, llm, prompt, items, max_tokens=None, budget=3000, max_in_flight=None, expansion=None):
+        """ This function runs a prompt over (chunk_id, text) items, several consecutive chunks per request. """
+        budget -= count_tokens(PACK_INSTRUCTION_TEMPLATE.format(count=PACK_MAX_CHUNKS))
+        packs = []      # chunk ids and prompt of each pack, in submission order
+
+        def packed_items():
+            sized = (((chunk_id, text), count_tokens(text)) for chunk_id, text in items)
+            for group in pack_groups(sized, budget, max_tokens, expansion):
+                texts = [text for _, text in group]
+                packed = self._packed_prompt(prompt, texts)
+                packs.append(([chunk_id for chunk_id, _ in group], packed))
+                yield (packed, texts), count_tokens(packed) + (max_tokens or 0)
+
+        run = lambda item: self._predict_packed(llm, prompt, item[0], item[1], max_tokens)
+        for i, results in self.executor.as_completed(run, packed_items(), max_in_flight=max_in_flight):
+            chunk_ids, packed = packs[i]
+            prompt_tokens = count_tokens(packed) // len(chunk_ids)      # each chunk's share of the request
+            for chunk_id, result in zip(chunk_ids, results):
+                yield chunk_id, result, prompt_tokens + count_tokens(result)
+
+    def _packed_prompt(self, prompt, texts):
+        """ This function renders a prompt over several marked passages; a single text gets the plain prompt. """
+        if len(texts) == 1:
+            return prompt.format(text=texts[0])
+        # (the first marker starts a new line too, as templates may quote the text)
+        passages = "".join("\n<<<{}>>>\n{}\n".format(i + 1, text) for i, text in enumerate(texts))
+        return PACK_INSTRUCTION_TEMPLATE.format(count=len(texts)) + prompt.format(text=passages)
+
+    def _predict_packed(self, llm, prompt, packed, texts, max_tokens=None):
+        """ This function sends a packed prompt and returns one output per text, resending the ones it lacks. """
+        if len(texts) == 1:
+            return [self._predict(llm, packed)]
+        outputs = split_packed(self._predict(llm, packed), len(texts))
+        tracer.annotate(packed_chunks=len(texts), unpacked_chunks=outputs.count(None))
+        for i, output in enumerate(outputs):
+            if output is None:
+                single = prompt.format(text=texts[i])
+                outputs[i] = self.executor.call(self._predict, llm, single, cost=count_tokens(single) + (max_tokens or 0))
+        return outputs
+
+    def _map(self, llm, prompts, max_tokens=None):
+        """ This function runs one LLM call per prompt concurrently, in prompt order. """
+        costs = [count_tokens(prompt) + (max_tokens or 0) for prompt in prompts]
+        return self.executor.map(lambda prompt: self._predict(llm, prompt), prompts, costs)
+
+    def _refine_segments(self, llm, chunks, bounds, initial_prompt, refine_prompt, max_tokens, chunk_summaries, checkpoint=None):
+        """ This function runs one refine pass per segment of chunks concurrently; returns the drafts. """
+        done = checkpoint.done if checkpoint is not None else {}
+        drafts, positions = [], []
+        for start, end in bounds:
+            chunk_id, draft = start, ""
+            while chunk_id < end and chunk_id in done:
+                draft = done[chunk_id]
+                chunk_id += 1
+            drafts.append(draft)
+            positions.append(chunk_id)
+
+        pending = {}
+        def submit(segment):
+            chunk_id = positions[segment]
+            if checkpoint is not None:
+                checkpoint.check()
+            if chunk_id == bounds[segment][0]:
+                prompt = initial_prompt.format(text=chunks[chunk_id].page_content)
+            else:
+                prompt = refine_prompt.format(existing_answer=drafts[segment], text=chunks[chunk_id].page_content)
+            prompt_tokens = count_tokens(prompt)
+            future = self.executor.submit(self._predict, llm, prompt, cost=prompt_tokens + (max_tokens or 0))
+            pending[future] = (segment, chunk_id, prompt_tokens)
+
+        try:
+            for segment, (start, end) in enumerate(bounds):
+                if positions[segment] < end:
+                    submit(segment)
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    segment, chunk_id, prompt_tokens = pending.pop(future)
+                    drafts[segment] = future.result()
+                    chunk_summaries.set(chunk_id, drafts[segment])
+                    if checkpoint is not None:
+                        checkpoint.record(chunk_id, drafts[segment], prompt_tokens + count_tokens(drafts[segment]))
+                    positions[segment] = chunk_id + 1
+                    if positions[segment] < bounds[segment][1]:
+                        submit(segment)
+                yield
+        finally:
+            self.executor.cancel(pending)
+        return drafts
+
+    def _pack(self, texts, budget, separator_tokens=2):
+        """ This function greedily packs consecutive texts into groups of at least two under a token budget. """
+        groups, group, used = [], [], 0
+        for i, text in enumerate(texts):
+            tokens = count_tokens(text) + separator_tokens
+            if len(group) >= 2 and used + tokens > budget:
+                groups.append(group)
+                group, used = [], 0
+            group.append(i)
+            used += tokens
+        if group:
+            groups.append(group)
+        return groups
+
+    def _pack_anchored(self, texts, budget, separator_tokens, aligned, old_groups):
+        """ This function packs texts like `_pack`, but keeps the groups of a previous version that are still whole. """
+        where = {old: new for new, old in enumerate(aligned) if old is not None}
+        kept = {}       # first position -> (positions, previous group)
+        for g, members in enumerate(old_groups):
+            positions = [where.get(old) for old in members]
+            if None not in positions and positions == list(range(positions[0], positions[0] + len(positions))):
+                kept[positions[0]] = (positions, g)
+
+        groups, reused, run = [], {}, []
+        def flush():
+            groups.extend([run[i] for i in group] for group in self._pack([texts[i] for i in run], budget, separator_tokens))
+            del run[:]
+        i = 0
+        while i < len(texts):
+            if i in kept:
+                flush()
+                positions, g = kept[i]
+                reused[len(groups)] = g
+                groups.append(positions)
+                i += len(positions)
+            else:
+                run.append(i)
+                i += 1
+        flush()
+        if len(texts) > 1 and len(groups) == len(texts):
+            # only single-text groups left: the level would not get smaller
+            return self._pack(texts, budget, separator_tokens), {}
+        return groups, reused
+
+    def _reduce(self, llm, summaries, combine_prompt, max_tokens=None, token_budget=3000, separator="\n\n", previous=None):
+        """ This function reduces summaries as a tree until one summary remains; returns it and the intermediate levels. """
+        if not summaries:
+            return "", []
+        budget = token_budget - count_tokens(combine_prompt.format(text=""))
+        aligned, old_levels = previous if previous is not None else (None, [])
+        ranges = [(i, i + 1) for i in range(len(summaries))]
+        levels = []
+        while True:
+            if len(levels) < len(old_levels):
+                old_groups, old_summaries = old_levels[len(levels)]
+                groups, reused = self._pack_anchored(summaries, budget, count_tokens(separator), aligned, old_groups)
+            else:
+                groups, reused = self._pack(summaries, budget, count_tokens(separator)), {}
+            prompts = [
+                combine_prompt.format(text=separator.join(summaries[i] for i in group))
+                for g, group in enumerate(groups) if g not in reused
+                ]
+            with tracer.span("reduce", level=str(len(levels)), inputs=len(summaries), groups=len(groups), reused=len(reused)):
+                results = iter(self._map(llm, prompts, max_tokens))
+            results = [old_summaries[reused[g]] if g in reused else next(results) for g in range(len(groups))]
+            if len(groups) == 1:
+                return results[0], levels
+
+            summaries = results
+            aligned = [reused.get(g) for g in range(len(groups))]
+            ranges = [(ranges[group[0]][0], ranges[group[-1]][1]) for group in groups]
+            levels.append([
+                {'chunk_range': list(chunk_range), 'summary': summary} for chunk_range, summary in zip(ranges, summaries)
+                ])
 
-        return total_summary, chunk_summaries
-    
     def ask(
-            self, query, vectordb, templates,
+            self, query, retriever, templates,
             temperature=0.0, max_tokens=1000,
+            retrieval=None,
             debug=False,
             ):
         """ This function asks a question and returns the answer from the document. """
-        llm = ChatOpenAI(
-            model_name='gpt-3.5-turbo',
-            temperature=temperature,
-            max_tokens=max_tokens,
-            )
-        
+        for answer, source_chunks in self.ask_stream(query, retriever, templates, temperature, max_tokens, retrieval, debug):
+            pass
+        return answer, source_chunks
+
+    def ask_stream(
+            self, query, retriever, templates,
+            temperature=0.0, max_tokens=1000,
+            retrieval=None,
+            debug=False,
+            ):
+        """ This function asks a question, yielding the answer so far and the source chunks as tokens arrive. """
         query_prompt_template = templates['query_prompt_template']
-        query_prompt = PromptTemplate(
-            template=query_prompt_template, input_variables=["context", "question"]
-        )
-        
-        chain = RetrievalQA.from_chain_type(
-            llm=llm, chain_type="stuff", 
-            retriever=vectordb.as_retriever(),
-            # memory=memory,
-            chain_type_kwargs={"prompt": query_prompt},
-            verbose=True,
-            return_source_documents=True,
-            )
+        query_prompt = self._prompt(query_prompt_template, ["context", "question"])
 
-        result = chain({"query": query})
+        # * Answer cache: exact question first, then a near-identical one
+        retrieval = retrieval or self.retrieval
+        cacheable = isinstance(retriever, HybridRetriever) and (temperature == 0 or self.cache_nonzero_temperature)
+        vector = None
+        if cacheable:
+            scope = AskCache.scope(retriever.key, query_prompt_template, temperature, max_tokens, retrieval)
+            cached = self.ask_cache.get(scope, query)
+            if cached is None and retrieval != "lexical":
+                # the query embedding is cached, so the vector search below reuses it
+                vector = retriever.embed_query(query)
+                cached = self.ask_cache.get_similar(scope, query, vector)
+            if cached is not None:
+                yield cached
+                return
+            self.ask_cache.miss()
 
-        answer = result["result"]
-        source_chunks = result["source_documents"]
+        # * Retrieve the source chunks and stuff as many as fit into the query prompt
+        with tracer.span("retrieve", mode=retrieval):
+            if isinstance(retriever, HybridRetriever):
+                source_chunks = retriever.search(query, k=4, mode=retrieval)
+            else:
+                source_chunks = retriever.similarity_search(query, k=4)
+        budget = self.context_window - max_tokens - count_tokens(query_prompt.format(context="", question=query))
+        for i in range(1, len(source_chunks)):
+            budget -= count_tokens(source_chunks[i - 1].page_content) + 2
+            if count_tokens(source_chunks[i].page_content) > budget:
+                source_chunks = source_chunks[:i]
+                break
+        context = "\n\n".join(chunk.page_content for chunk in source_chunks)
 
-        return answer, source_chunks
+        for answer in self._predict_stream(query_prompt.format(context=context, question=query), temperature, max_tokens):
+            yield answer, source_chunks
 
-    def translate(
-            self, chunks,
-            templates,
-            temperature=0.0, max_tokens=None,
-            debug=False
-            ):  
-        """ This function translates a document. """
+        if cacheable:
+            self.ask_cache.put(scope, query, answer, source_chunks, vector)
 
-        # Setup the LLM
-        llm = ChatOpenAI(
-            model_name='gpt-3.5-turbo',
-            temperature=temperature,
-            max_tokens=max_tokens,
-            )
-        
+    def translate(self, chunks, templates, **kwargs):
+        """ This function translates a document; returns the full translation and the per-chunk translations. """
+        for chunk_translations, ready in self.translate_stream(chunks, templates, **kwargs):
+            pass
+        return "\n\n".join(chunk_translations.summaries()), chunk_translations
+
+    def translate_stream(
+            self, chunks, templates,
+            temperature=0.0, max_tokens=1000,
+            context_tokens=0,
+            output_path=None,
+            max_in_flight=None,
+            pack=False,
+            previous=None,
+            checkpoint=None,
+            debug=False,
+            ):
+        """ This function translates a document chunk by chunk, yielding (chunk_translations, ready) as results arrive. """
+        llm = self._llm(temperature, max_tokens)
+        translate_prompt = self._prompt(templates['translate_prompt_template'], ["text"])
+        context_prompt = self._prompt(templates['translate_context_prompt_template'], ["context", "text"])
+        max_in_flight = max_in_flight or 2 * self.executor.max_workers
+
+        aligned, reused = None, {}
+        if previous is not None:
+            chunks = settle(chunks)
+            aligned, reused = self._reusable(chunks, previous, "translate", context=bool(context_tokens) and not pack)
+        chunk_translations = SummaryRows(chunks)
+        done = dict(reused)
+        done.update(checkpoint.done if checkpoint is not None else {})
+
+        def translate_chunks():
+            last = None
+            for chunk_id, chunk in enumerate(chunks):
+                chunk_translations.add(chunk_id, chunk, done.get(chunk_id, ""), None if aligned is None else aligned[chunk_id] is None)
+                context, last = last, chunk.page_content
+                if chunk_id in done:
+                    continue
+                if checkpoint is not None:
+                    checkpoint.check()
+                yield chunk_id, chunk.page_content, context
+
+        def translate_prompts():
+            for chunk_id, text, context in translate_chunks():
+                if context_tokens and context:
+                    tail = get_encoding().decode(get_encoding().encode(context, disallowed_special=())[-context_tokens:])
+                    yield chunk_id, context_prompt.format(context=tail, text=text)
+                else:
+                    yield chunk_id, translate_prompt.format(text=text)
+
+        finished = set(done)
+        ready = 0
+        output = None
+        if output_path is not None:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            output = open(output_path, "w", encoding="utf-8")
+        try:
+            if pack:
+                results = self._map_packed(
+                    llm, translate_prompt, ((chunk_id, text) for chunk_id, text, _ in translate_chunks()), max_tokens,
+                    self.chunk_budget("translate", templates, max_tokens), max_in_flight=max_in_flight, expansion=TRANSLATION_EXPANSION,
+                    )
+            else:
+                results = self._map_chunks(llm, translate_prompts(), max_tokens, max_in_flight=max_in_flight)
+            for chunk_id, translation, tokens in results:
+                chunk_translations.set(chunk_id, translation)
+                finished.add(chunk_id)
+                if checkpoint is not None:
+                    checkpoint.record(chunk_id, translation, tokens)
+                    checkpoint.check()
+
+                # * Write the contiguous prefix of finished chunks
+                while ready in finished and ready < len(chunk_translations):
+                    if output is not None:
+                        output.write(chunk_translations.rows[ready]['chunk_summary'] + "\n\n")
+                    ready += 1
+                if output is not None:
+                    output.flush()
+                yield chunk_translations, ready
+
+            # chunks restored from a checkpoint after the last call (or a fully restored job)
+            while ready < len(chunk_translations):
+                if output is not None:
+                    output.write(chunk_translations.rows[ready]['chunk_summary'] + "\n\n")
+                ready += 1
+        finally:
+            if output is not None:
+                output.close()
+        yield chunk_translations, ready
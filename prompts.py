@@ -90,8 +90,58 @@ We have the opportunity to refine the existing summary (only if needed) with som
 Given the new context, refine the original summary. If the context is not useful, you must copy the original summary (very important!).
 """
 
+PROPOSAL_MERGE_TEMPLATE = """You are acting as a project reviewer. Several reviewers have each summarized one consecutive part of the same presentation, in order. Merge their drafts into one final summary of the whole presentation with a clear Markdown format with the following template (report N/A only if no draft mentions it):
+
+## Title
+### Abstract 
+    Supervised/Unsupervised, Model description (regression/classification/other), Main results, etc.
+### Introduction 
+    Background, Goal/Motivation, Data resource, Existing work & state of the art, What's new against baseline/SOTA?, etc.
+### Data 
+    Data description, data size, show examples, show distributions by class, data augmentation details if any, justification for data set size, etc.
+### Method 
+    Describe the ML approach in detail, training/testing sizes, split ratio, # of splits for cross-validation, state loss/evaluation/optimization function used, show a flowchart, etc.
+### Quantitative Evaluation 
+    Quantitative comparison results against the baseline, mean and standard deviation of the overall (from multiple data splits) and PER CLASS classification/regression results, report Train/Validation/Test Results, provide one (or more) SAMPLE (representative) confusion matrix, and illustrate the most confused class-pairs, visualization of the most discriminative features/statistics, visualize class separations if applicable, etc.
+### Discussion and Future work 
+
+Here are the drafts, in the order of the parts they cover:
+
+--------------
+{text}
+--------------
+
+Keep every detail the drafts report, resolve repeated items once, and prefer the later part when drafts disagree.
+"""
+
 TRANSLATE_PROMPT_TEMPLATE = """请用中文通顺准确地翻译以下内容:
 
 "{text}"
 
-翻译:"""
\ No newline at end of file
+翻译:"""
+
+TRANSLATE_CONTEXT_PROMPT_TEMPLATE = """以下是前文的结尾，仅供参考，以保持术语和人名译法一致，不要翻译:
+
+"{context}"
+
+请用中文通顺准确地翻译以下内容:
+
+"{text}"
+
+翻译:"""
+
+# put in front of a prompt whose text holds several numbered passages (see DocumentReader.summarize_stream, `pack`)
+PACK_INSTRUCTION_TEMPLATE = """The text below consists of {count} passages, each starting with a marker line <<<1>>>, <<<2>>>, ... up to <<<{count}>>>. Follow the instructions for every passage separately. Answer with the same marker line on its own line before the answer for each passage, in order, and write nothing before the first marker.
+
+"""
+
+DEFAULT_TEMPLATES = {
+    "map_prompt_template": MAP_PROMPT_TEMPLATE,
+    "combine_prompt_template": COMBINE_PROMPT_TEMPLATE,
+    "refine_initial_prompt_template": PROPOSAL_REFINE_INITIAL_TEMPLATE,
+    "refine_prompt_template": PROPOSAL_REFINE_TEMPLATE,
+    "refine_merge_prompt_template": PROPOSAL_MERGE_TEMPLATE,
+    "translate_prompt_template": TRANSLATE_PROMPT_TEMPLATE,
+    "translate_context_prompt_template": TRANSLATE_CONTEXT_PROMPT_TEMPLATE,
+    "query_prompt_template": QUERY_PROMPT_TEMPLATE,
+}
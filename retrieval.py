@@ -0,0 +1,123 @@
+import os, re, json, math, heapq, threading
+from collections import Counter
+
+from cache import text_hash
+
+
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'     # kana, CJK ideographs, hangul
+TOKEN_PATTERN = re.compile(r'([{0}]+)|((?:(?![{0}])[^\W_])+(?:[.\-](?:(?![{0}])[^\W_])+)*)'.format(CJK))
+
+def tokenize(text):
+    """ This function splits text into lowercased words and numbers, and CJK runs into characters and bigrams. """
+    terms = []
+    for match in TOKEN_PATTERN.finditer(text):
+        run, word = match.groups()
+        if word:
+            terms.append(word.lower())
+        else:
+            terms.extend(run)
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+class BM25Index(object):
+    """ Inverted index over the chunks of one document, scored with Okapi BM25. """
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_lens = []
+        self.postings = {}
+
+    def add(self, text):
+        """ This function indexes the next chunk and returns its position. """
+        doc_id = len(self.doc_lens)
+        terms = tokenize(text)
+        self.doc_lens.append(len(terms))
+        for term, tf in Counter(terms).items():
+            self.postings.setdefault(term, []).append([doc_id, tf])
+        return doc_id
+
+    def search(self, query, k=20):
+        """ This function returns up to `k` (chunk, score) pairs, best first. """
+        n = len(self.doc_lens)
+        if n == 0:
+            return []
+        avg_len = sum(self.doc_lens) / float(n) or 1.0
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_lens[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self, path):
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({'k1': self.k1, 'b': self.b, 'doc_lens': self.doc_lens, 'postings': self.postings}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(data['k1'], data['b'])
+        index.doc_lens, index.postings = data['doc_lens'], data['postings']
+        return index
+
+
+def reciprocal_rank_fusion(rankings, k=60, weights=None):
+    """ This function fuses ranked lists of ids: each id scores sum(weight / (k + rank)) over the lists. """
+    weights = weights or [1.0] * len(rankings)
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking, 1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (k + rank)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])
+
+
+RETRIEVAL_MODES = ("hybrid", "lexical", "vector")
+
+class HybridRetriever(object):
+    """ Lexical (BM25), vector or hybrid (reciprocal rank fusion) search over the chunks of one document. """
+    def __init__(self, vectordb, index, chunks, rrf_k=60, weights=(1.0, 1.0), fetch_k=20, key=None, embedding=None):
+        self.vectordb = vectordb
+        self.key = key
+        self.embedding = embedding
+        self.index = index
+        self.chunks = chunks
+        self.rrf_k = rrf_k
+        self.weights = weights
+        self.fetch_k = fetch_k
+        self.vector_lock = threading.Lock()
+        self.positions = {}     # chunk hash -> position, to map vector hits back to chunks
+        hashes = chunks.hashes() if hasattr(chunks, 'hashes') else [text_hash(chunk.page_content) for chunk in chunks]
+        for doc_id, h in enumerate(hashes):
+            self.positions.setdefault(h, doc_id)
+
+    def search(self, query, k=4, mode="hybrid"):
+        """ This function returns the `k` chunks that best match the query. """
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError("Invalid retrieval mode: {}".format(mode))
+        if mode == "vector":
+            with self.vector_lock:
+                return self.vectordb.similarity_search(query, k=k)
+
+        lexical = [doc_id for doc_id, score in self.index.search(query, self.fetch_k)]
+        if mode == "lexical":
+            return [self.chunks[doc_id] for doc_id in lexical[:k]]
+
+        with self.vector_lock:
+            hits = [text_hash(chunk.page_content) for chunk in self.vectordb.similarity_search(query, k=min(self.fetch_k, len(self.chunks)) or 1)]
+        vector = [self.positions[h] for h in hits if h in self.positions]
+        fused = reciprocal_rank_fusion([lexical, vector], k=self.rrf_k, weights=self.weights)
+        return [self.chunks[doc_id] for doc_id in fused[:k]]
+
+    def embed_query(self, query):
+        return self.embedding.embed_query(query)
+
+    def similarity_search(self, query, k=4):
+        """ Same as the vector store's search, so a retriever can stand in for it. """
+        return self.search(query, k=k)
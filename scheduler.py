@@ -0,0 +1,174 @@
+import time, random, threading, contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+from tracing import tracer
+
+
+RETRYABLE_ERRORS = ('RateLimitError', 'ServiceUnavailableError', 'APIConnectionError', 'Timeout', 'TryAgain')
+
+def is_retryable(error):
+    """ Whether an LLM/embedding error is worth retrying (429, 5xx, timeouts). """
+    status = getattr(error, 'http_status', None) or getattr(error, 'status_code', None)
+    if status is not None:
+        return status == 429 or 500 <= status < 600
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+def retry_after(error):
+    """ The server-requested delay in seconds, if the error carries one. """
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket refilled continuously at `rate_per_minute`. """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """ Block until `amount` tokens are available, then take them. """
+        # a single request larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimitedExecutor(object):
+    """ Thread pool that runs LLM calls under request and token rate limits, retrying retryable errors with jittered backoff. """
+    def __init__(
+            self, max_workers=8,
+            requests_per_minute=3500, tokens_per_minute=90000,
+            max_retries=6, backoff_base=1.0, backoff_max=60.0,
+            name="llm",
+            ):
+        self.name = name
+        self.max_workers = max_workers
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.queued = 0         # submitted calls waiting for a worker
+        self.queued_lock = threading.Lock()
+
+    def backoff(self, attempt, error=None):
+        """ Delay before retry number `attempt` (full jitter, capped). """
+        delay = retry_after(error) if error is not None else None
+        if delay is not None:
+            return min(delay, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, fn, *args, cost=1, submitted=None):
+        """ Run `fn(*args)` in the calling thread under the rate limits. """
+        with tracer.span(self.name + "_call", cost=cost) as span:
+            if submitted is not None:
+                span.attrs['queue_wait'] = time.perf_counter() - submitted
+                with self.queued_lock:
+                    self.queued -= 1
+            rate_wait = 0.0
+            for attempt in range(self.max_retries + 1):
+                start = time.perf_counter()
+                self.requests.acquire(1)
+                self.tokens.acquire(cost)
+                rate_wait += time.perf_counter() - start
+                span.attrs.update(rate_wait=rate_wait, attempts=attempt + 1)
+                try:
+                    return fn(*args)
+                except Exception as e:
+                    if attempt == self.max_retries or not is_retryable(e):
+                        raise
+                    time.sleep(self.backoff(attempt, e))
+
+    def submit(self, fn, *args, cost=1):
+        """ Schedule `fn(*args)` on the pool and return its future. """
+        with self.queued_lock:
+            self.queued += 1
+        context = contextvars.copy_context()
+        return self.pool.submit(context.run, self.call, fn, *args, cost=cost, submitted=time.perf_counter())
+
+    def map(self, fn, items, costs=None):
+        """ Apply `fn` to every item concurrently; results keep the order of `items`. """
+        costs = costs or [1] * len(items)
+        futures = [self.submit(fn, item, cost=cost) for item, cost in zip(items, costs)]
+        return [future.result() for future in futures]
+
+    def as_completed(self, fn, items, max_in_flight=None):
+        """ Apply `fn` to (item, cost) pairs concurrently, yielding (index, result) as each call finishes. """
+        pending = {}
+        try:
+            for i, (item, cost) in enumerate(items):
+                pending[self.submit(fn, item, cost=cost)] = i
+                if max_in_flight is not None and len(pending) >= max_in_flight:
+                    wait(pending, return_when=FIRST_COMPLETED)
+                for future in [future for future in pending if future.done()]:
+                    yield pending.pop(future), future.result()
+            for future in as_completed(pending):
+                yield pending[future], future.result()
+        finally:
+            self.cancel(pending)
+
+    def cancel(self, futures):
+        """ Cancel the submitted calls that have not started yet. """
+        for future in futures:
+            if future.cancel():
+                with self.queued_lock:
+                    self.queued -= 1
+
+
+class FairLane(object):
+    """ A pool of `workers` slots shared round-robin between users. """
+    def __init__(self, workers):
+        self.free = workers
+        self.cond = threading.Condition()
+        self.waiting = OrderedDict()    # user -> queue of tickets, in turn order
+
+    @contextmanager
+    def slot(self, user):
+        """ Hold one slot of the lane for `user` while the block runs. """
+        self.acquire(user)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, user):
+        ticket = object()
+        with self.cond:
+            self.waiting.setdefault(user, deque()).append(ticket)
+            while not (self.free > 0 and self._next_ticket() is ticket):
+                self.cond.wait()
+
+            # served: the user moves to the back of the turn order
+            tickets = self.waiting.pop(user)
+            tickets.popleft()
+            if tickets:
+                self.waiting[user] = tickets
+            self.free -= 1
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.free += 1
+            self.cond.notify_all()
+
+    def _next_ticket(self):
+        for tickets in self.waiting.values():
+            return tickets[0]
+        return None
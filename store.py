@@ -0,0 +1,263 @@
+import os, json, time, shutil, atexit, argparse, threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:     # Windows: locks only hold within the process
+    fcntl = None
+
+from docstore import ChunkStore, write_store, remove_store
+
+
+def dir_size(path):
+    """ This function returns the bytes of the files under a directory (or of a file). """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass        # removed meanwhile
+    return size
+
+
+def detach_chroma(vectordb):
+    """ This function stops a Chroma 0.3 store from writing itself back to disk when the process exits. """
+    db = getattr(getattr(vectordb, '_client', None), '_db', None)
+    persist = getattr(db, 'persist', None)
+    if persist is not None:
+        atexit.unregister(persist)
+    return vectordb
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """ Hold an exclusive lock on `path`, shared by every process on the machine, while the block runs. """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# files of the single shared collection ("langchain" in db_dir itself) that earlier versions wrote into
+LEGACY_FILES = ["chroma-collections.parquet", "chroma-embeddings.parquet", "index"]
+
+
+class CollectionManager(object):
+    """ Manifest of the collections under a db_dir, evicted least recently used first under a disk quota. """
+    def __init__(self, db_dir, quota_bytes=None, touch_interval=60):
+        self.db_dir = db_dir
+        self.quota_bytes = quota_bytes
+        self.touch_interval = touch_interval
+        self.path = os.path.join(db_dir, "manifest.json")
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.saved = 0.0
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        self.reconcile()
+
+    def paths(self, key):
+        """ This function returns the collection directory and the chunk store of a key. """
+        return os.path.join(self.db_dir, "collections", key), os.path.join(self.db_dir, "chunks", key)
+
+    def reconcile(self):
+        """ This function adds the finished collections missing from the manifest and drops the ones gone from disk. """
+        chunks_dir = os.path.join(self.db_dir, "chunks")
+        names = os.listdir(chunks_dir) if os.path.isdir(chunks_dir) else []
+        for name in names:
+            if name.endswith((".jsonl", ".json")):
+                self._migrate(os.path.join(chunks_dir, name))
+        names = os.listdir(chunks_dir) if os.path.isdir(chunks_dir) else []
+        on_disk = set(name for name in names if not name.endswith((".tmp", ".old")) and os.path.isdir(os.path.join(chunks_dir, name)))
+        with self.lock:
+            changed = False
+            for key in list(self.entries):
+                if key not in on_disk:
+                    del self.entries[key]
+                    changed = True
+            for key in on_disk - set(self.entries):
+                persist_dir, chunks_path = self.paths(key)
+                num_chunks = ChunkStore.count(chunks_path)
+                modified = os.path.getmtime(chunks_path)
+                self.entries[key] = {
+                    'source': None, 'collection_name': key, 'embedding_model': None, 'chunks': num_chunks,
+                    'size': dir_size(persist_dir) + dir_size(chunks_path),
+                    'created': modified, 'last_access': modified,
+                }
+                changed = True
+            if changed:
+                self._save()
+
+    @staticmethod
+    def _migrate(list_path):
+        """ This function turns a chunk list of an earlier version (a JSON list, or one JSON document per line) into a chunk store. """
+        with open(list_path, "r", encoding="utf-8") as f:
+            if list_path.endswith(".jsonl"):
+                chunks = [json.loads(line) for line in f]
+            else:
+                chunks = json.load(f)
+        modified = os.path.getmtime(list_path)
+        store_path = os.path.splitext(list_path)[0]
+        write_store(store_path, [chunk['page_content'] for chunk in chunks], [chunk.get('metadata') or {} for chunk in chunks])
+        os.utime(store_path, (modified, modified))
+        os.remove(list_path)
+
+    def add(self, key, source=None, collection_name=None, chunks=0, embedding_model=None):
+        """ This function records a freshly built collection. """
+        persist_dir, chunks_path = self.paths(key)
+        now = time.time()
+        with self.lock:
+            self.entries[key] = {
+                'source': source, 'collection_name': collection_name or key, 'embedding_model': embedding_model, 'chunks': chunks,
+                'size': dir_size(persist_dir) + dir_size(chunks_path),
+                'created': now, 'last_access': now,
+            }
+            self._save()
+
+    def touch(self, key):
+        """ This function marks a collection as just used. """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry['last_access'] = now
+            if now - self.saved >= self.touch_interval:
+                self._save()
+
+    def resize(self, key):
+        """ This function measures a collection again, e.g. after compaction. """
+        persist_dir, chunks_path = self.paths(key)
+        with self.lock:
+            if key in self.entries:
+                self.entries[key]['size'] = dir_size(persist_dir) + dir_size(chunks_path)
+                self._save()
+
+    def total_size(self):
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def evict(self, quota_bytes=None, protect=()):
+        """ This function removes the least recently used collections, except the `protect`ed ones, until the store fits the quota. """
+        quota_bytes = self.quota_bytes if quota_bytes is None else quota_bytes
+        if quota_bytes is None:
+            return []
+        self.reconcile()
+        with self.lock:
+            total = sum(entry['size'] for entry in self.entries.values())
+            victims = []
+            for key, entry in sorted(self.entries.items(), key=lambda item: item[1]['last_access']):
+                if total <= quota_bytes:
+                    break
+                if key in protect:
+                    continue
+                victims.append(key)
+                total -= entry['size']
+        for key in victims:
+            self.remove(key)
+        return victims
+
+    def remove(self, key):
+        """ This function deletes a collection and its chunk store; the chunk store goes first, so it is never a hit again. """
+        persist_dir, chunks_path = self.paths(key)
+        remove_store(chunks_path)
+        shutil.rmtree(persist_dir, ignore_errors=True)
+        with self.lock:
+            self.entries.pop(key, None)
+            self._save()
+
+    def orphans(self):
+        """ This function lists what interrupted ingestions and compactions left behind. """
+        found = []
+        chunks_dir, collections_dir = os.path.join(self.db_dir, "chunks"), os.path.join(self.db_dir, "collections")
+        if os.path.isdir(chunks_dir):
+            found += [os.path.join(chunks_dir, name) for name in os.listdir(chunks_dir) if name.endswith((".tmp", ".old"))]
+        if os.path.isdir(collections_dir):
+            found += [
+                os.path.join(collections_dir, name) for name in os.listdir(collections_dir)
+                if name not in self.entries
+                ]
+        return found
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        with file_lock(self.path + ".lock"):
+            # * Entries other processes added meanwhile (removed ones have no chunk store left)
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as f:
+                    on_disk = json.load(f)
+                for key, entry in on_disk.items():
+                    if key not in self.entries and os.path.isdir(self.paths(key)[1]):
+                        self.entries[key] = entry
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=4, ensure_ascii=False)
+            os.replace(self.path + ".tmp", self.path)
+        self.saved = time.time()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect, evict and compact the collections of a db directory (offline).")
+    parser.add_argument("--db-dir", default="db")
+    parser.add_argument("--quota-gb", type=float, default=None, help="Evict least recently used collections down to this size")
+    parser.add_argument("--compact", action="store_true", help="Rebuild every collection and its BM25 index from its chunks")
+    parser.add_argument("--drop-legacy", action="store_true", help="Delete the shared collection earlier versions kept in the db directory itself")
+    parser.add_argument("--list", action="store_true", help="Print the manifest")
+    args = parser.parse_args()
+
+    store = CollectionManager(args.db_dir)
+
+    # * Leftovers of interrupted runs
+    for path in store.orphans():
+        print(f"[orphan] {path}")
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+    if args.drop_legacy:
+        for name in LEGACY_FILES:
+            path = os.path.join(args.db_dir, name)
+            if os.path.exists(path):
+                print(f"[legacy] {path}")
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+    if args.quota_gb is not None:
+        for key in store.evict(quota_bytes=int(args.quota_gb * (1 << 30))):
+            print(f"[evicted] {key}")
+
+    if args.compact:
+        # vectors come from the embedding cache, so compaction makes no embedding call for cached chunks
+        from model import DocumentReader
+
+        doc_reader = DocumentReader(db_dir=args.db_dir)
+        store = doc_reader.store
+        for key in sorted(store.entries):
+            before = store.entries[key]['size']
+            if doc_reader.compact(key):
+                print(f"[compacted] {key}: {before} -> {store.entries[key]['size']} bytes")
+            else:
+                print(f"[skipped] {key}: unknown embedding model {store.entries[key]['embedding_model']}")
+
+    if args.list:
+        for key, entry in sorted(store.entries.items(), key=lambda item: -item[1]['last_access']):
+            print(key, json.dumps(entry, ensure_ascii=False))
+    print(f"{len(store.entries)} collections, {store.total_size() / (1 << 20):.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import json, asyncio, threading, unittest
+
+from api import APIServer
+
+
+class BlockingService(object):
+    """ Answers /load once `release` is set, counting the calls that started. """
+    def __init__(self):
+        self.ready = threading.Event()
+        self.release = threading.Event()
+        self.started = 0
+
+    def load(self, body):
+        self.started += 1
+        self.release.wait(5)
+        return {'key': body.get('text')}
+
+
+class RemoteJob(object):
+    """ A job another worker runs: no future here, only the status in its job file. """
+    def __init__(self, status):
+        self.job_id, self.status, self.future = "job", status, None
+
+class RemoteJobService(object):
+    """ Reports the job as running for `polls` more polls, then as `final`. """
+    def __init__(self, polls, final):
+        self.polls, self.final = polls, final
+
+    def submit(self, body, user):
+        return RemoteJob("queued")
+
+    def job(self, job_id):
+        self.polls -= 1
+        return RemoteJob("running" if self.polls > 0 else self.final)
+
+    def describe(self, job, result=False):
+        return {'job_id': job.job_id, 'status': job.status}
+
+
+class AdmissionTest(unittest.TestCase):
+    """ Requests beyond the running and queued ones are refused with 503, not piled up. """
+    def test_admission_control(self):
+        service = BlockingService()
+
+        async def run():
+            server = APIServer(service, max_requests=1, max_queue=1)
+            requests = [
+                asyncio.ensure_future(server.respond("POST", "/load", {}, {'text': str(i)}, "peer"))
+                for i in range(2)
+                ]
+            while server.admitted < 2:
+                await asyncio.sleep(0.001)
+            # one running and one queued: the next request is refused at once
+            refused = await server.respond("POST", "/load", {}, {'text': "2"}, "peer")
+            health = await server.respond("GET", "/health", {}, {}, "peer")
+            self.assertEqual(service.started, 1)
+            service.release.set()
+            return refused, health, await asyncio.gather(*requests), server.admitted
+
+        refused, health, answered, admitted = asyncio.run(run())
+        self.assertEqual(refused[0], 503)
+        self.assertEqual(refused[3], {'Retry-After': "1"})
+        # /health is never queued
+        self.assertEqual(health[0], 200)
+        self.assertEqual([(status, json.loads(payload)) for status, _, payload, _ in answered], [(200, {'key': "0"}), (200, {'key': "1"})])
+        self.assertEqual(admitted, 0)
+
+
+class WaitTest(unittest.TestCase):
+    """ `"wait": true` follows a job another worker runs until it ends. """
+    def test_wait_for_remote_job(self):
+        for final in ("done", "cancelled"):
+            service = RemoteJobService(3, final)
+            server = APIServer(service, poll_interval=0.001)
+            status, _, payload, _ = asyncio.run(server.respond("POST", "/summarize", {}, {'text': "text", 'wait': True}, "peer"))
+            self.assertEqual((status, json.loads(payload)), (200, {'job_id': "job", 'status': final}))
+            self.assertEqual(service.polls, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os, shutil, tempfile, unittest
+
+from langchain.docstore.document import Document
+
+from model import DocumentReader
+from backends import FakeBackend, FakeAPIError, ClientRegistry, PROCESS_CLIENTS, install_http_session
+from scheduler import is_retryable
+from prompts import DEFAULT_TEMPLATES
+
+
+class FakeBackendTest(unittest.TestCase):
+    """ The fake backend is deterministic, and its injected errors are retried like real ones. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def reader(self, name, backend):
+        doc_reader = DocumentReader(
+            db_dir=os.path.join(self.dir, name), backend=backend,
+            requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12,
+            embedding_requests_per_minute=10 ** 9, embedding_tokens_per_minute=10 ** 12,
+            )
+        doc_reader.executor.backoff_base = 0.001
+        return doc_reader
+
+    def test_deterministic(self):
+        tokens = []
+        completion = FakeBackend().chat().complete("one two three", on_token=tokens.append)
+        self.assertEqual(completion, FakeBackend(seed=1).chat().complete("one two three"))
+        self.assertEqual("".join(tokens).strip(), completion)
+        self.assertTrue(completion.endswith("one two three"))
+        embeddings = FakeBackend().embeddings()
+        self.assertEqual(embeddings.embed_query("text"), embeddings.embed_documents(["other", "text"])[1])
+        self.assertTrue(is_retryable(FakeAPIError()))
+
+    def test_retry_injected_errors(self):
+        chunks = [Document(page_content="Chunk {} of the document.".format(i)) for i in range(10)]
+        save_path = os.path.join(self.dir, "clean.json")
+        clean = self.reader("clean", FakeBackend()).summarize(chunks, DEFAULT_TEMPLATES, save_path=save_path)
+
+        backend = FakeBackend(error_rate=0.3, seed=1)
+        save_path = os.path.join(self.dir, "flaky.json")
+        result = self.reader("flaky", backend).summarize(chunks, DEFAULT_TEMPLATES, save_path=save_path)
+        self.assertEqual(result[0], clean[0])
+        self.assertEqual(list(result[1]), list(clean[1]))
+        self.assertGreater(backend.calls['chat'], len(chunks) + 1)
+
+
+class ClientRegistryTest(unittest.TestCase):
+    """ Built clients are reused until their key changes or they are dropped. """
+    def test_reuse(self):
+        registry = ClientRegistry(max_size=2)
+        built = []
+
+        def factory(name):
+            return lambda: built.append(name) or object()
+        chat = registry.get(("chat", "model", 0.0), factory("chat"))
+        self.assertIs(registry.get(("chat", "model", 0.0), factory("chat")), chat)
+        self.assertIsNot(registry.get(("chat", "model", 0.7), factory("sampled")), chat)
+        registry.invalidate("chat")
+        self.assertIsNot(registry.get(("chat", "model", 0.0), factory("chat")), chat)
+        self.assertEqual(built, ["chat", "sampled", "chat"])
+        self.assertEqual(registry.stats(), {'hits': 1, 'misses': 3, 'size': 1})
+
+    def test_http_session_per_process(self):
+        import openai
+
+        saved = openai.requestssession
+        PROCESS_CLIENTS.invalidate('http_session')
+        try:
+            session = install_http_session(pool_maxsize=4)
+            # another reader shares the installed session instead of replacing it
+            self.assertIs(install_http_session(pool_maxsize=8), session)
+            self.assertIs(openai.requestssession, session)
+        finally:
+            # (the next reader installs a session of its own pool size)
+            PROCESS_CLIENTS.invalidate('http_session')
+            openai.requestssession = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import os, shutil, tempfile, unittest
+
+from batch import Manifest
+from docstore import save_result
+
+
+class ManifestTest(unittest.TestCase):
+    """ The batch checkpoint hands out earlier results only for the same settings. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_previous(self):
+        settings = {'chunk_size': 100, 'summary_option': "map_reduce"}
+        output = os.path.join(self.dir, "doc.json")
+        save_result(output, "total", [{'chunk_content': "text", 'chunk_summary': "summary"}], [])
+        manifest = Manifest(os.path.join(self.dir, "manifest.json"))
+        manifest.update("doc.txt", status="done", key="old", settings=settings, output=output)
+
+        # a new process reads the checkpoint back
+        manifest = Manifest(os.path.join(self.dir, "manifest.json"))
+        self.assertTrue(manifest.is_done("doc.txt", "old"))
+        self.assertFalse(manifest.is_done("doc.txt", "new"))
+        self.assertEqual(manifest.previous("doc.txt", dict(settings))[0], "total")
+        self.assertIsNone(manifest.previous("doc.txt", dict(settings, chunk_size=200)))
+        self.assertIsNone(manifest.previous("other.txt", settings))
+
+        manifest.update("doc.txt", status="failed", key="new", error="error")
+        self.assertIsNone(manifest.previous("doc.txt", settings))
+
+
+if __name__ == "__main__":
+    unittest.main()
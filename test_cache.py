@@ -0,0 +1,151 @@
+import os, shutil, tempfile, unittest
+from unittest import mock
+
+from cache import EmbeddingCache, CachedEmbeddings, LLMCache, AskCache, text_hash
+
+
+class ListEmbeddings(object):
+    """ Embeds a text as [length, index of the call], recording each batch it is sent. """
+    def __init__(self):
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text)), float(len(self.batches))] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    """ Persistence, eviction and deduplication of cached embeddings. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "embeddings.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_round_trip(self):
+        cache = EmbeddingCache(self.path)
+        cache.put_many("model", [(text_hash("a"), [0.5, 1.5]), (text_hash("b"), [2.0, 3.0])])
+        # vectors are kept per model, and survive reopening the file
+        found = EmbeddingCache(self.path).get_many("model", [text_hash("a"), text_hash("b"), text_hash("c")])
+        self.assertEqual(found, {text_hash("a"): [0.5, 1.5], text_hash("b"): [2.0, 3.0]})
+        self.assertEqual(cache.get_many("other", [text_hash("a")]), {})
+
+    def test_evicts_least_recently_used(self):
+        # room for two vectors of two float32 each
+        cache = EmbeddingCache(self.path, max_bytes=16)
+        cache.put_many("model", [("a", [1.0, 1.0])])
+        cache.put_many("model", [("b", [2.0, 2.0])])
+        cache.get_many("model", ["a"])
+        cache.put_many("model", [("c", [3.0, 3.0])])
+        self.assertEqual(sorted(cache.get_many("model", ["a", "b", "c"])), ["a", "c"])
+
+    def test_only_misses_are_embedded(self):
+        embeddings = ListEmbeddings()
+        cached = CachedEmbeddings(embeddings, EmbeddingCache(self.path), "model", batch_size=2)
+        vectors = cached.embed_documents(["header", "one", "header", "two", "three"])
+        # the repeated text is sent once, in batches of two
+        self.assertEqual(embeddings.batches, [["header", "one"], ["two", "three"]])
+        self.assertEqual(vectors[0], vectors[2])
+
+        again = cached.embed_documents(["three", "header", "four"])
+        self.assertEqual(embeddings.batches[2:], [["four"]])
+        self.assertEqual(again[:2], [vectors[4], vectors[0]])
+        self.assertEqual(cached.embed_query("one"), vectors[1])
+        self.assertEqual(len(embeddings.batches), 3)
+
+
+class LLMCacheTest(unittest.TestCase):
+    """ Expiry and eviction of cached completions. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "llm_cache.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_key(self):
+        key = LLMCache.key("model", 0.0, 100, "prompt")
+        self.assertEqual(key, LLMCache.key("model", 0.0, 100, "prompt"))
+        self.assertNotEqual(key, LLMCache.key("model", 0.0, 200, "prompt"))
+        self.assertNotEqual(key, LLMCache.key("model", 0.7, 100, "prompt"))
+
+    def test_ttl(self):
+        now = 1000.0
+        with mock.patch("cache.time.time", lambda: now):
+            cache = LLMCache(self.path, ttl=60)
+            cache.put("old", "old completion")
+            now += 30
+            cache.put("new", "new completion")
+            self.assertEqual(cache.get("old"), "old completion")
+            now += 40
+            # expired entries are ignored and dropped
+            self.assertIsNone(cache.get("old"))
+            self.assertEqual(cache.get("new"), "new completion")
+            self.assertEqual(cache.conn.execute("SELECT COUNT(*) FROM completions").fetchone(), (1,))
+            # and purged on the next write
+            now += 40
+            cache.put("newest", "newest completion")
+            self.assertEqual(cache.conn.execute("SELECT key FROM completions").fetchall(), [("newest",)])
+        # without a ttl nothing expires, and entries survive reopening the file
+        self.assertEqual(LLMCache(self.path).get("newest"), "newest completion")
+
+    def test_evicts_least_recently_used(self):
+        now = 1000.0
+        with mock.patch("cache.time.time", lambda: now):
+            cache = LLMCache(self.path, max_bytes=20)
+            for key in ("a", "b"):
+                cache.put(key, "ten bytes!")
+                now += 1
+            cache.get("a")
+            now += 1
+            cache.put("c", "ten bytes!")
+        self.assertEqual(cache.get("a"), "ten bytes!")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "ten bytes!")
+
+
+class AskCacheTest(unittest.TestCase):
+    """ Exact and semantic tiers of the answer cache. """
+    def setUp(self):
+        self.cache = AskCache(max_per_scope=2)
+        self.scope = AskCache.scope("doc", "template", 0.0, 1000, "hybrid")
+
+    def test_exact(self):
+        self.cache.put(self.scope, "What is it?", "answer", ["chunk"])
+        # case, spacing and the final punctuation do not matter
+        self.assertEqual(self.cache.get(self.scope, "  what  is IT"), ("answer", ["chunk"]))
+        self.assertIsNone(self.cache.get(self.scope, "What is that?"))
+        self.assertIsNone(self.cache.get(AskCache.scope("doc", "template", 0.7, 1000, "hybrid"), "What is it?"))
+        self.cache.miss()
+        self.assertEqual(self.cache.stats()['exact_hit_rate'], 0.5)
+
+    def test_semantic(self):
+        self.cache.put(self.scope, "first", "first answer", [], vector=[2.0, 0.0, 0.0])
+        self.cache.put(self.scope, "second", "second answer", [], vector=[0.0, 1.0, 0.0])
+        # the closest earlier question above the threshold answers
+        self.assertEqual(self.cache.get_similar(self.scope, "question", [1.0, 0.05, 0.0]), ("first answer", []))
+        self.assertIsNone(self.cache.get_similar(self.scope, "question", [1.0, 1.0, 0.0]))
+        self.assertIsNone(self.cache.get_similar(AskCache.scope("other", "template", 0.0, 1000, "hybrid"), "question", [1.0, 0.0, 0.0]))
+
+        # "first" was used last, so "second" is evicted from the scope
+        self.cache.put(self.scope, "third", "third answer", [], vector=[0.0, 0.0, 1.0])
+        self.assertIsNone(self.cache.get_similar(self.scope, "question", [0.0, 1.0, 0.0]))
+        self.assertEqual(self.cache.get_similar(self.scope, "question", [0.0, 0.0, 3.0]), ("third answer", []))
+        stats = self.cache.stats()
+        self.assertEqual((stats['semantic_hits'], stats['semantic_entries']), (2, 2))
+
+    def test_near_identical_questions(self):
+        # the same embedding, but another page
+        vector = [1.0, 0.0, 0.0]
+        self.cache.put(self.scope, "What does page 3 say?", "page 3 answer", [], vector=vector)
+        self.assertIsNone(self.cache.get_similar(self.scope, "What does page 4 say?", vector))
+        self.assertIsNone(self.cache.get_similar(self.scope, "What does page 3.5 say?", vector))
+        self.assertEqual(self.cache.get_similar(self.scope, "And what is on page 3", vector), ("page 3 answer", []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os, json, shutil, tempfile, unittest
+
+from docstore import ChunkStore, ChunkStoreWriter, SummaryRows, write_store, remove_store, save_result, load_result
+
+
+class ChunkStoreTest(unittest.TestCase):
+    """ Round trip and overwrite of chunk stores and saved results. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_round_trip_with_overlap(self):
+        path = os.path.join(self.dir, "store")
+        head = "The first chunk ends with a sentence that the next one repeats. "
+        texts = [head + "Shared tail of the first chunk, long enough to be probed.", "Shared tail of the first chunk, long enough to be probed. Then more.", "ünïcode"]
+        write_store(path, texts, [{'page': 1}, {'page': 1}, {'page': 2}])
+        store = ChunkStore(path)
+        self.assertEqual([chunk.page_content for chunk in store], texts)
+        self.assertEqual([chunk.metadata for chunk in store], [{'page': 1, 'chunk_id': 0}, {'page': 1, 'chunk_id': 1}, {'page': 2, 'chunk_id': 2}])
+        self.assertEqual(bytes(store.view(2)).decode('utf-8'), "ünïcode")
+        self.assertEqual(ChunkStore.count(path), 3)
+        # the overlap is stored once
+        self.assertLess(os.path.getsize(os.path.join(path, "text")), sum(len(text.encode('utf-8')) for text in texts))
+        store.close()
+
+    def test_overwrite_store(self):
+        path = os.path.join(self.dir, "store")
+        write_store(path, ["a"])
+        write_store(path, ["c", "d"])
+        self.assertEqual([chunk.page_content for chunk in ChunkStore(path)], ["c", "d"])
+        self.assertEqual(sorted(os.listdir(self.dir)), ["store"])
+
+    def test_remove_store(self):
+        path = os.path.join(self.dir, "store")
+        write_store(path, ["a"])
+        remove_store(path)
+        remove_store(path)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_overwrite_result(self):
+        chunks_path = os.path.join(self.dir, "chunks")
+        write_store(chunks_path, ["first", "second"])
+        chunks = ChunkStore(chunks_path)
+        save_path = os.path.join(self.dir, "summaries", "total_summary.json")
+        for run in range(2):
+            rows = [{'chunk_content': chunk.page_content, 'chunk_summary': "{} {}".format(chunk.page_content, run)} for chunk in chunks]
+            save_result(save_path, "total {}".format(run), rows, [["section"]], chunks)
+            total, chunk_summaries, sections = load_result(save_path)
+            self.assertEqual(total, "total {}".format(run))
+            self.assertEqual([row['chunk_summary'] for row in chunk_summaries], ["first {}".format(run), "second {}".format(run)])
+            self.assertEqual([row['chunk_content'] for row in chunk_summaries], ["first", "second"])
+            self.assertEqual(sections, [["section"]])
+
+    def test_writer_reads_back(self):
+        path = os.path.join(self.dir, "store")
+        writer = ChunkStoreWriter(path)
+        writer.add("first chunk")
+        self.assertEqual(writer.content(0), "first chunk")
+        writer.add("second chunk")
+        self.assertEqual([writer.content(0), writer.content(1)], ["first chunk", "second chunk"])
+        writer.close()
+        self.assertEqual(writer.content(1), "second chunk")
+        self.assertEqual(os.listdir(self.dir), ["store"])
+
+    def test_summary_rows(self):
+        chunks_path = os.path.join(self.dir, "chunks")
+        write_store(chunks_path, ["first", "second"])
+        chunks = ChunkStore(chunks_path)
+        rows = SummaryRows(chunks)
+        for chunk_id, chunk in enumerate(chunks):
+            rows.add(chunk_id, chunk, "", changed=chunk_id == 1)
+        rows.set(1, "summary")
+        self.assertEqual(rows.rows[1], {'chunk_id': 1, 'chunk_summary': "summary", 'changed': True})
+        self.assertEqual(rows[1], {'chunk_content': "second", 'chunk_summary': "summary", 'changed': True})
+        save_path = os.path.join(self.dir, "summaries", "total_summary.json")
+        save_result(save_path, "total", rows, [], chunks)
+        self.assertEqual(list(load_result(save_path)[1]), list(rows))
+        # rows of chunks that cannot be read back keep their text
+        rows = SummaryRows(iter(chunks))
+        rows.add(0, chunks[0], "summary")
+        self.assertEqual(rows[0]['chunk_content'], "first")
+
+    def test_legacy_result(self):
+        save_path = os.path.join(self.dir, "total_summary.json")
+        rows = [{'chunk_content': "text", 'chunk_summary': "summary"}]
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump({'total_summary': "total", 'chunk_summaries': rows, 'section_summaries': []}, f)
+        self.assertEqual(load_result(save_path), ("total", rows, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
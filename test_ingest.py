@@ -0,0 +1,45 @@
+import unittest
+
+from langchain.docstore.document import Document
+
+from ingest import TokenChunker, StructuredChunker, count_tokens, get_encoding
+
+
+class ChunkerTest(unittest.TestCase):
+    """ Chunk sizes, overlap and blank text of the incremental splitters. """
+    def test_token_chunks(self):
+        pages = [Document(page_content="Hello world. " * 30, metadata={'page': 0}), Document(page_content="More text.", metadata={'page': 1})]
+        chunks = list(TokenChunker(chunk_size=20, chunk_overlap=5).split(pages))
+        self.assertTrue(all(count_tokens(chunk.page_content) <= 20 for chunk in chunks))
+        self.assertTrue(chunks[-1].page_content.endswith("More text."))
+        self.assertEqual(chunks[-1].metadata, {'page': 1})
+
+    def test_no_overlap_only_chunk(self):
+        # 30 tokens with a window of 20 and an overlap of 10: the window starting at 20 would only repeat the overlap
+        text = get_encoding().decode(get_encoding().encode("word " * 100)[:30])
+        self.assertEqual(count_tokens(text), 30)
+        chunks = list(TokenChunker(chunk_size=20, chunk_overlap=10).split([Document(page_content=text)]))
+        self.assertEqual(len(chunks), 2)
+
+    def test_token_blank_pages(self):
+        pages = [Document(page_content="Hello world. " * 30), Document(page_content="   \n\n  \n"), Document(page_content=" \n")]
+        chunks = list(TokenChunker(chunk_size=20, chunk_overlap=5).split(pages))
+        self.assertTrue(all(chunk.page_content.strip() for chunk in chunks))
+
+    def test_structured_blank_units(self):
+        chunks = list(StructuredChunker(chunk_size=10).split([Document(page_content="start" + " \t" * 200 + "end")]))
+        self.assertEqual([chunk.page_content for chunk in chunks], ["start", "end"])
+
+    def test_structured_paragraphs(self):
+        paragraphs = ["Paragraph {}. ".format(i) + " ".join(["word"] * 8) for i in range(6)]
+        text = "\n\n".join(paragraphs)
+        # two paragraphs per chunk
+        chunk_size = 2 * max(count_tokens(paragraph) for paragraph in paragraphs) + 8
+        chunks = list(StructuredChunker(chunk_size=chunk_size).split([Document(page_content=text)]))
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(all(chunk.page_content.startswith("Paragraph") for chunk in chunks))
+        self.assertEqual("\n\n".join(chunk.page_content for chunk in chunks), text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import os, time, shutil, tempfile, unittest
+
+from model import DocumentReader
+from backends import FakeBackend, FakeChatModel, FakeAPIError
+from jobs import JobManager
+from prompts import DEFAULT_TEMPLATES
+
+
+class LimitedChatModel(FakeChatModel):
+    """ Fails for good (HTTP 400, not retried) once the backend's `budget` of calls is used up. """
+    def complete(self, prompt, on_token=None):
+        with self.backend.lock:
+            self.backend.budget -= 1
+            exhausted = self.backend.budget < 0
+        if exhausted:
+            raise FakeAPIError("out of budget", http_status=400)
+        return super().complete(prompt, on_token)
+
+class LimitedBackend(FakeBackend):
+    def __init__(self, budget, **kwargs):
+        super().__init__(**kwargs)
+        self.budget = budget
+
+    def chat(self, temperature=0.0, max_tokens=None):
+        return LimitedChatModel(self, temperature, max_tokens)
+
+
+class JobTest(unittest.TestCase):
+    """ Background jobs: checkpoints, resuming and summarizing while ingesting. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.text = "\n\n".join("Paragraph {}. ".format(i) + " ".join(["word{}".format(i)] * 10) for i in range(20))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def manager(self, name, backend, jobs_dir=None, **kwargs):
+        doc_reader = DocumentReader(
+            db_dir=os.path.join(self.dir, name), backend=backend,
+            requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12,
+            embedding_requests_per_minute=10 ** 9, embedding_tokens_per_minute=10 ** 12,
+            **kwargs
+            )
+        doc_reader.executor.backoff_base = 0.001
+        return JobManager(doc_reader, jobs_dir=jobs_dir)
+
+    def test_resume(self):
+        clean = self.manager("clean", FakeBackend(), max_concurrency=1)
+        job = clean.submit(None, self.text, DEFAULT_TEMPLATES, chunk_size=100)
+        job.future.result()
+        clean_calls, clean_total = clean.doc_reader.backend.calls['chat'], clean.load_result(job)[0]
+
+        # the first run fails after 5 calls, with the chunks finished by then checkpointed
+        jobs_dir = os.path.join(self.dir, "jobs")
+        jobs = self.manager("db", LimitedBackend(5, latency=0.01), jobs_dir, max_concurrency=1)
+        job = jobs.submit(None, self.text, DEFAULT_TEMPLATES, chunk_size=100)
+        job.future.result()
+        self.assertEqual(job.status, "failed")
+        with open(os.path.join(job.job_dir, "checkpoint.jsonl"), "r", encoding="utf-8") as f:
+            checkpointed = len(f.readlines())
+        self.assertTrue(0 < checkpointed <= 5)
+
+        # a restarted process resumes the same job from its checkpoint
+        backend = FakeBackend()
+        jobs = self.manager("db", backend, jobs_dir, max_concurrency=1)
+        resumed = jobs.submit(None, self.text, DEFAULT_TEMPLATES, chunk_size=100)
+        self.assertEqual(resumed.job_id, job.job_id)
+        resumed.future.result()
+        self.assertEqual(resumed.status, "done")
+        self.assertEqual(backend.calls['chat'], clean_calls - checkpointed)
+        self.assertEqual(jobs.load_result(resumed)[0], clean_total)
+
+    def test_summarize_while_ingesting(self):
+        # long enough for several embedding batches
+        text = self.text * 20
+        jobs = self.manager("db", FakeBackend(latency=0.001, embedding_latency=0.05))
+        job = jobs.submit(None, text, DEFAULT_TEMPLATES, chunk_size=60)
+        snapshots, reports = [], []
+        while not job.future.done():
+            if job.result is not None:
+                rows = job.result[1]
+                snapshots.append([row['chunk_content'] for row in rows[:len(rows)]])
+                reports.append(job.describe())
+            time.sleep(0.005)
+        self.assertEqual(job.status, "done")
+        # rows showed up before the document was read to its end
+        self.assertTrue(any("chunks read so far" in report for report in reports))
+        contents = [row['chunk_content'] for row in jobs.load_result(job)[1]]
+        self.assertEqual(job.progress['chunks_total'], len(contents))
+        for snapshot in snapshots:
+            self.assertEqual(snapshot, contents[:len(snapshot)])
+
+    def test_translate(self):
+        jobs = self.manager("db", FakeBackend(latency=0.001))
+        job = jobs.submit(None, self.text, DEFAULT_TEMPLATES, summary_option="translate", chunk_size=60)
+        job.future.result()
+        self.assertEqual(job.status, "done")
+        total, rows = jobs.load_result(job)[:2]
+        self.assertEqual(total, "\n\n".join(row['chunk_summary'] for row in rows))
+        # each translation is of its own chunk
+        for row in rows:
+            self.assertIn(row['chunk_content'].split()[-1], row['chunk_summary'])
+
+    def test_ask_reuses_summary_collection(self):
+        # refine chunks are smaller than the map_reduce ones asking would default to
+        jobs = self.manager("db", FakeBackend())
+        job = jobs.submit(None, self.text, DEFAULT_TEMPLATES, summary_option="refine")
+        job.future.result()
+        doc_reader = jobs.doc_reader
+        collections = os.listdir(os.path.join(self.dir, "db", "collections"))
+        chunk_size = doc_reader.ask_chunk_size(None, self.text, templates=DEFAULT_TEMPLATES)
+        self.assertEqual(chunk_size, doc_reader.chunk_budget("refine", DEFAULT_TEMPLATES))
+        self.assertNotEqual(chunk_size, doc_reader.chunk_budget("map_reduce", DEFAULT_TEMPLATES))
+        doc_reader.load(None, self.text, chunk_size=chunk_size)
+        self.assertEqual(os.listdir(os.path.join(self.dir, "db", "collections")), collections)
+
+    def test_incremental_update(self):
+        backend = FakeBackend()
+        jobs = self.manager("db", backend)
+        first = jobs.submit(None, self.text, DEFAULT_TEMPLATES, chunk_size=100, document_name="doc.txt")
+        first.future.result()
+        self.assertEqual(first.status, "done")
+        first_rows, first_calls = list(jobs.load_result(first)[1]), backend.calls['chat']
+
+        # the same document with one paragraph rewritten
+        edited = self.text.replace("Paragraph 5. ", "Paragraph 5. This one was rewritten. ")
+        second = jobs.submit(None, edited, DEFAULT_TEMPLATES, chunk_size=100, document_name="doc.txt")
+        second.future.result()
+        self.assertEqual(second.status, "done")
+        self.assertEqual(second.progress['chunks_changed'], 1)
+        rows = list(jobs.load_result(second)[1])
+        changed = [i for i, row in enumerate(rows) if "rewritten" in row['chunk_content']]
+        self.assertEqual(len(changed), 1)
+        self.assertEqual([row['changed'] for row in rows], [i in changed for i in range(len(rows))])
+        self.assertEqual(
+            [row['chunk_summary'] for i, row in enumerate(rows) if i not in changed],
+            [row['chunk_summary'] for i, row in enumerate(first_rows) if i not in changed],
+            )
+        self.assertLess(backend.calls['chat'] - first_calls, first_calls / 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os, re, shutil, tempfile, unittest
+
+from langchain.docstore.document import Document
+
+from model import DocumentReader, pack_groups, split_packed
+from backends import FakeBackend, FakeChatModel
+from prompts import DEFAULT_TEMPLATES
+
+
+class IngestCacheTest(unittest.TestCase):
+    """ Ingestion is cached by content and settings. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_cache_hit(self):
+        text = "\n\n".join("Paragraph {}. ".format(i) + "word " * 30 for i in range(8))
+        backend = FakeBackend()
+        doc_reader = DocumentReader(db_dir=self.dir, backend=backend)
+        chunks, _ = doc_reader.load(None, text, chunk_size=50)
+        embedded = backend.calls['embed']
+        self.assertGreater(embedded, 0)
+
+        # the same text with the same settings, from another reader on the same directory
+        again, _ = DocumentReader(db_dir=self.dir, backend=backend).load(None, text, chunk_size=50)
+        self.assertEqual([chunk.page_content for chunk in again], [chunk.page_content for chunk in chunks])
+        self.assertEqual(backend.calls['embed'], embedded)
+
+        # other settings are another ingestion
+        doc_reader.load(None, text, chunk_size=80)
+        self.assertGreater(backend.calls['embed'], embedded)
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, "collections"))), 2)
+
+
+class SkippingChatModel(FakeChatModel):
+    """ Leaves out the answer to the second passage of packed prompts, like a model that skipped it. """
+    def complete(self, prompt, on_token=None):
+        return re.sub(r'<<<2>>>.*?(?=<<<3>>>|$)', '', super().complete(prompt, on_token), flags=re.DOTALL)
+
+class SkippingBackend(FakeBackend):
+    def chat(self, temperature=0.0, max_tokens=None):
+        return SkippingChatModel(self, temperature, max_tokens)
+
+
+class PackTest(unittest.TestCase):
+    """ Packing small chunks into one request, and the fallback for passages a model skipped. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def summarize(self, name, backend, chunks, **kwargs):
+        doc_reader = DocumentReader(db_dir=os.path.join(self.dir, name), backend=backend, chunk_size=100)
+        doc_reader.executor.backoff_base = 0.001
+        return doc_reader.summarize(chunks, DEFAULT_TEMPLATES, save_path=os.path.join(self.dir, name + ".json"), **kwargs)
+
+    def test_pack_groups(self):
+        items = [(i, 10) for i in range(5)]
+        # 14 tokens per item with its marker line
+        self.assertEqual(list(pack_groups(items, 30)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(pack_groups(items, 100, max_chunks=3)), [[0, 1, 2], [3, 4]])
+        self.assertEqual(list(pack_groups(items, 100, max_tokens=20, expansion=1.0)), [[0], [1], [2], [3], [4]])
+
+    def test_split_packed(self):
+        self.assertEqual(split_packed("<<<1>>>\none\n<<<2>>>\ntwo", 2), ["one", "two"])
+        # the passage after a gap may have been cut short, so it is dropped as well
+        self.assertEqual(split_packed("<<<1>>>\none\n<<<3>>>\nthree", 3), ["one", None, None])
+        self.assertEqual(split_packed("no markers", 2), [None, None])
+
+    def test_pack_fallback(self):
+        chunks = [Document(page_content="Passage {}: ".format(i) + " ".join(["text"] * 5)) for i in range(6)]
+        unpacked = self.summarize("plain", FakeBackend(), chunks)
+        packed = self.summarize("packed", SkippingBackend(), chunks, pack=True)
+        rows = list(packed[1])
+        self.assertTrue(all(row['chunk_summary'] for row in rows))
+        # the skipped passage, and the last one answered before the gap, were sent again on their own
+        self.assertEqual(rows[1]['chunk_summary'], unpacked[1][1]['chunk_summary'])
+        self.assertEqual(rows[-1]['chunk_summary'], unpacked[1][len(rows) - 1]['chunk_summary'])
+        self.assertNotEqual(rows[0]['chunk_summary'], unpacked[1][0]['chunk_summary'])
+
+    def test_section_summaries(self):
+        chunks = [Document(page_content="Passage {}: ".format(i) + " ".join(["text"] * 5)) for i in range(8)]
+        total, rows = self.summarize("tree", FakeBackend(), chunks, reduce_token_budget=150)
+        self.assertEqual(len(rows), len(chunks))
+        # a budget too small for every summary at once reduces them in levels
+        sections = DocumentReader(db_dir=os.path.join(self.dir, "tree")).section_summaries(save_path=os.path.join(self.dir, "tree.json"))
+        self.assertTrue(sections)
+        self.assertEqual(sections[0][0]['chunk_range'][0], 0)
+        self.assertEqual(sections[-1][-1]['chunk_range'][1], len(chunks))
+
+
+if __name__ == "__main__":
+    unittest.main()
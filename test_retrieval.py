@@ -0,0 +1,72 @@
+import os, shutil, tempfile, unittest
+
+from langchain.docstore.document import Document
+
+from retrieval import tokenize, BM25Index, reciprocal_rank_fusion, HybridRetriever
+
+
+class ListVectorStore(object):
+    """ Returns its chunks in a fixed order, whatever the query. """
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def similarity_search(self, query, k=4):
+        return self.chunks[:k]
+
+
+class RetrievalTest(unittest.TestCase):
+    """ Tokenizing, BM25 scoring and rank fusion of the lexical index. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.texts = [
+            "The model gpt-3.5 answers in version 3.2 of the API.",
+            "Rate limits apply to every request.",
+            "Embeddings are cached per chunk; cached embeddings are reused.",
+            "机器学习模型的训练",
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("Use GPT-3.5, version 3.2!"), ["use", "gpt-3.5", "version", "3.2"])
+        # CJK runs give characters and bigrams
+        self.assertEqual(tokenize("模型训练"), ["模", "型", "训", "练", "模型", "型训", "训练"])
+
+    def test_bm25(self):
+        index = BM25Index()
+        for text in self.texts:
+            index.add(text)
+        self.assertEqual(index.search("gpt-3.5")[0][0], 0)
+        self.assertEqual(index.search("cached embeddings")[0][0], 2)
+        self.assertEqual(index.search("模型")[0][0], 3)
+        self.assertEqual(index.search("unknown"), [])
+        # more matching terms score higher
+        index.add("Rate of change.")
+        self.assertEqual([doc_id for doc_id, score in index.search("rate limits request")], [1, 4])
+
+        path = os.path.join(self.dir, "bm25.json")
+        index.save(path)
+        self.assertEqual(BM25Index.load(path).search("cached embeddings"), index.search("cached embeddings"))
+
+    def test_reciprocal_rank_fusion(self):
+        # an id ranked well in both lists beats one ranked first in only one
+        self.assertEqual(reciprocal_rank_fusion([["a", "b", "c"], ["b", "c", "a"]]), ["b", "a", "c"])
+        self.assertEqual(reciprocal_rank_fusion([["a", "b"], ["b", "a"]], weights=[2.0, 1.0])[0], "a")
+
+    def test_hybrid_retriever(self):
+        chunks = [Document(page_content=text) for text in self.texts]
+        index = BM25Index()
+        for chunk in chunks:
+            index.add(chunk.page_content)
+        # the vector store ranks the chunks in reverse
+        retriever = HybridRetriever(ListVectorStore(chunks[::-1]), index, chunks)
+        self.assertEqual(retriever.search("rate limits", k=1, mode="lexical"), [chunks[1]])
+        self.assertEqual(retriever.search("rate limits", k=1, mode="vector"), [chunks[3]])
+        self.assertEqual(retriever.search("rate limits", k=2), [chunks[1], chunks[3]])
+        with self.assertRaises(ValueError):
+            retriever.search("rate limits", mode="other")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+import os, re, json, time, shutil, tempfile, threading, unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from langchain.docstore.document import Document
+
+from model import DocumentReader
+from prompts import MAP_PROMPT_TEMPLATE, COMBINE_PROMPT_TEMPLATE, DEFAULT_TEMPLATES
+from scheduler import TokenBucket, RateLimitedExecutor, is_retryable, retry_after
+
+
+class HTTPError(Exception):
+    def __init__(self, http_status, headers=None):
+        super().__init__("HTTP {}".format(http_status))
+        self.http_status = http_status
+        self.headers = headers or {}
+
+
+class SchedulerTest(unittest.TestCase):
+    """ Token buckets, retries and ordering of the rate-limited executor. """
+    def test_token_bucket(self):
+        bucket = TokenBucket(600)     # 10 per second
+        start = time.monotonic()
+        bucket.acquire(600)
+        self.assertLess(time.monotonic() - start, 0.05)
+        # an empty bucket waits for the refill
+        bucket.acquire(2)
+        self.assertGreater(time.monotonic() - start, 0.15)
+        # a request larger than the bucket takes the whole bucket instead of waiting forever
+        bucket = TokenBucket(60000, capacity=10)
+        bucket.acquire(100)
+        self.assertLess(bucket.tokens, 1)
+
+    def test_retryable_errors(self):
+        self.assertTrue(is_retryable(HTTPError(429)))
+        self.assertTrue(is_retryable(HTTPError(503)))
+        self.assertFalse(is_retryable(HTTPError(400)))
+        self.assertFalse(is_retryable(ValueError()))
+        self.assertEqual(retry_after(HTTPError(429, {'retry-after': "1.5"})), 1.5)
+        self.assertIsNone(retry_after(HTTPError(429, {'retry-after': "soon"})))
+        self.assertIsNone(retry_after(HTTPError(429)))
+
+    def test_retry_after(self):
+        executor = RateLimitedExecutor(max_workers=2, backoff_base=10.0)
+        attempts = []
+
+        def call(x):
+            attempts.append(time.monotonic())
+            if len(attempts) < 3:
+                raise HTTPError(429, {'retry-after': "0.05"})
+            return x * 2
+
+        # the server's delay is used instead of the (much longer) backoff
+        self.assertEqual(executor.call(call, 21), 42)
+        self.assertEqual(len(attempts), 3)
+        self.assertGreater(attempts[2] - attempts[0], 0.09)
+        self.assertLess(attempts[2] - attempts[0], 1.0)
+
+        def fail(x):
+            raise HTTPError(400)
+        with self.assertRaises(HTTPError):
+            executor.call(fail, 1)
+
+    def test_map_order(self):
+        executor = RateLimitedExecutor(max_workers=4)
+
+        def call(x):
+            time.sleep((5 - x) * 0.01)
+            return x
+        self.assertEqual(executor.map(call, list(range(6))), list(range(6)))
+
+
+# * A stand-in for the chat completions API, for the OpenAI client path
+
+class FakeChatHandler(BaseHTTPRequestHandler):
+    """ Answers with the first "Paragraph <n>" of the prompt, later paragraphs faster; the first `fail_first` requests get a 429. """
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.fail_first > 0
+            server.fail_first -= 1
+        if fail:
+            data = json.dumps({'error': {'message': "Rate limit reached", 'type': "requests"}}).encode('utf-8')
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+        else:
+            match = re.search(r'Paragraph (\d+)', body['messages'][-1]['content'])
+            if match:
+                time.sleep(max(0, 10 - int(match.group(1))) * 0.01)
+            data = json.dumps({
+                'id': "fake", 'object': "chat.completion", 'created': 0, 'model': body['model'],
+                'choices': [{'index': 0, 'message': {'role': "assistant", 'content': "answer " + (match.group(0) if match else "")}, 'finish_reason': "stop"}],
+                'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+            }).encode('utf-8')
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class OpenAIClientTest(unittest.TestCase):
+    """ Ordering and retries through the OpenAI client, against a local fake server. """
+    @classmethod
+    def setUpClass(cls):
+        import openai
+
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeChatHandler)
+        cls.server.lock, cls.server.requests, cls.server.fail_first = threading.Lock(), 0, 0
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.saved = openai.api_base, openai.api_key, os.environ.get("OPENAI_API_KEY")
+        openai.api_base = "http://127.0.0.1:{}/v1".format(cls.server.server_address[1])
+        openai.api_key = os.environ["OPENAI_API_KEY"] = "test"
+
+    @classmethod
+    def tearDownClass(cls):
+        import openai
+
+        cls.server.shutdown()
+        cls.server.server_close()
+        openai.api_base, openai.api_key, key = cls.saved
+        if key is None:
+            os.environ.pop("OPENAI_API_KEY", None)
+        else:
+            os.environ["OPENAI_API_KEY"] = key
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.doc_reader = DocumentReader(db_dir=self.dir)
+        self.doc_reader.executor.backoff_base = 0.001
+        self.templates = {'map_prompt_template': MAP_PROMPT_TEMPLATE, 'combine_prompt_template': COMBINE_PROMPT_TEMPLATE}
+        self.chunks = [Document(page_content="Paragraph {}. Some text.".format(i)) for i in range(10)]
+        with self.server.lock:
+            self.server.requests, self.server.fail_first = 0, 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_results_in_order(self):
+        # later chunks are answered first
+        total_summary, chunk_summaries = self.doc_reader.summarize(self.chunks, self.templates)
+        self.assertEqual([row['chunk_summary'] for row in chunk_summaries], ["answer Paragraph {}".format(i) for i in range(10)])
+        self.assertEqual(self.server.requests, 10 + 1)
+
+    def test_retry_on_429(self):
+        with self.server.lock:
+            self.server.fail_first = 2
+        total_summary, chunk_summaries = self.doc_reader.summarize(self.chunks[:3], self.templates)
+        self.assertEqual([row['chunk_summary'] for row in chunk_summaries], ["answer Paragraph {}".format(i) for i in range(3)])
+        self.assertEqual(self.server.requests, 3 + 1 + 2)
+
+    def test_completion_cache(self):
+        first = self.doc_reader.summarize(self.chunks, self.templates)
+        # a second reader on the same directory is answered from the completion cache
+        doc_reader = DocumentReader(db_dir=self.dir)
+        again = doc_reader.summarize(self.chunks, self.templates)
+        self.assertEqual(again[0], first[0])
+        self.assertEqual(list(again[1]), list(first[1]))
+        self.assertEqual(self.server.requests, 10 + 1)
+
+    def test_translate_in_order(self):
+        # later chunks are answered first, and nothing combines the translations
+        templates = DEFAULT_TEMPLATES
+        output_path = os.path.join(self.dir, "translation.txt")
+        total, rows = self.doc_reader.translate(self.chunks, templates, output_path=output_path)
+        expected = ["answer Paragraph {}".format(i) for i in range(10)]
+        self.assertEqual([row['chunk_summary'] for row in rows], expected)
+        self.assertEqual(total, "\n\n".join(expected))
+        with open(output_path, "r", encoding="utf-8") as f:
+            self.assertEqual(f.read().split("\n\n")[:-1], expected)
+        self.assertEqual(self.server.requests, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
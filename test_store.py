@@ -0,0 +1,53 @@
+import os, json, shutil, tempfile, unittest
+
+from store import CollectionManager
+from docstore import ChunkStore, write_store
+from model import DocumentReader
+from backends import FakeBackend
+
+
+class CollectionManagerTest(unittest.TestCase):
+    """ The manifest of collections, the conversion of earlier chunk lists and compaction. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, "chunks"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_migrate_legacy_chunk_lists(self):
+        chunks = [{'page_content': "first", 'metadata': {'page': 1}}, {'page_content': "second", 'metadata': {}}]
+        # a JSON list, and one JSON document per line
+        with open(os.path.join(self.dir, "chunks", "listed.json"), "w", encoding="utf-8") as f:
+            json.dump(chunks, f)
+        with open(os.path.join(self.dir, "chunks", "lined.jsonl"), "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(chunk) + "\n" for chunk in chunks))
+
+        store = CollectionManager(self.dir)
+        self.assertEqual(sorted(store.entries), ["lined", "listed"])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, "chunks"))), ["lined", "listed"])
+        for key in store.entries:
+            self.assertEqual(store.entries[key]['chunks'], 2)
+            chunk_store = ChunkStore(store.paths(key)[1])
+            self.assertEqual([chunk.page_content for chunk in chunk_store], ["first", "second"])
+            self.assertEqual(chunk_store[0].metadata['page'], 1)
+            chunk_store.close()
+
+    def test_compact_skips_unknown_embedding_model(self):
+        doc_reader = DocumentReader(db_dir=self.dir, backend=FakeBackend())
+        doc_reader.load(None, "\n\n".join("Paragraph {}.".format(i) for i in range(5)), chunk_size=50)
+        built, = doc_reader.store.entries
+        # a collection another reader embedded with a model this one does not have, and one found on disk
+        write_store(doc_reader.store.paths("other")[1], ["text"])
+        doc_reader.store.add("other", embedding_model="other-model")
+        write_store(doc_reader.store.paths("found")[1], ["text"])
+        doc_reader.store.reconcile()
+
+        self.assertTrue(doc_reader.compact(built))
+        self.assertFalse(doc_reader.compact("other"))
+        self.assertFalse(doc_reader.compact("found"))
+        self.assertFalse(os.path.exists(doc_reader.store.paths("other")[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
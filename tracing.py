@@ -0,0 +1,237 @@
+import os, json, time, threading, contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# upper bounds (s) of the latency histogram buckets, from a cache hit to a long completion
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# the job (or other unit of work) the spans of the current thread belong to; thread pools copy it with the context
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Span(object):
+    """ One timed stage; `child` is the time spent in spans nested inside it in the same thread. """
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.child = 0.0
+
+
+class Tracer(object):
+    """ Records timed spans of the pipeline stages to a JSON lines file and aggregates them into Prometheus metrics. """
+    def __init__(self, path=None, max_traces=256, max_bytes=64 << 20, namespace="gptreader"):
+        self.namespace = namespace
+        self.max_traces = max_traces
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.path, self.file = None, None
+        self.histograms = {}            # span name -> [count per bucket..., count, sum]
+        self.totals = {}                # (span name, attribute) -> sum
+        self.traces = OrderedDict()     # trace id -> span name -> totals
+        self.collectors = []
+        if path is not None:
+            self.open(path)
+
+    def open(self, path):
+        """ This function starts appending spans to a JSON lines file. """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.path, self.file = path, open(path, "a", encoding="utf-8")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.path, self.file = None, None
+
+    def add_collector(self, collector):
+        """ This function adds a callable returning {name: value} gauges, read on every `render_metrics`. """
+        self.collectors.append(collector)
+
+    # * Recording
+
+    @contextmanager
+    def trace(self, trace_id):
+        """ Attribute the spans of the block (and of the calls it submits to thread pools) to `trace_id`. """
+        token = current_trace.set(trace_id)
+        try:
+            yield
+        finally:
+            current_trace.reset(token)
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """ Time the block as one span; attributes can be added to the yielded span while it runs. """
+        stack = self._stack()
+        span = Span(name, attrs)
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs['error'] = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1].child += duration
+            self.record(span, duration)
+
+    def annotate(self, **attrs):
+        """ This function adds attributes to the innermost open span of the calling thread, if any. """
+        stack = self._stack()
+        if stack:
+            stack[-1].attrs.update(attrs)
+
+    def timed(self, name, iterable, **attrs):
+        """ This function wraps an iterable, recording the time spent producing its items as one span. """
+        span = Span(name, attrs)
+        iterator = iter(iterable)
+        duration, items = 0.0, 0
+        try:
+            while True:
+                stack = self._stack()
+                stack.append(span)
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = time.perf_counter() - start
+                    stack.pop()
+                    if stack:
+                        stack[-1].child += elapsed
+                    duration += elapsed
+                items += 1
+                yield item
+        finally:
+            span.attrs['items'] = items
+            self.record(span, duration)
+
+    def record(self, span, duration):
+        """ This function exports a finished span and adds it to the metrics. """
+        trace_id = current_trace.get()
+        self_time = max(duration - span.child, 0.0)
+        numeric = [
+            (key, value) for key, value in span.attrs.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+            ]
+        with self.lock:
+            if self.file is not None:
+                entry = dict(span.attrs, span=span.name, trace=trace_id, start=round(span.start, 6),
+                             duration=round(duration, 6), self=round(self_time, 6), thread=threading.current_thread().name)
+                self.file.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+                self.file.flush()
+                if self.max_bytes and self.file.tell() > self.max_bytes:
+                    self._rotate()
+
+            histogram = self.histograms.get(span.name)
+            if histogram is None:
+                histogram = self.histograms[span.name] = [0] * (len(BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += duration
+            for key, value in numeric + [('self_seconds', self_time)]:
+                self.totals[(span.name, key)] = self.totals.get((span.name, key), 0) + value
+
+            if trace_id is not None:
+                stages = self.traces.pop(trace_id, None) or {}
+                self.traces[trace_id] = stages
+                while len(self.traces) > self.max_traces:
+                    self.traces.popitem(last=False)
+                stage = stages.setdefault(span.name, {'count': 0, 'seconds': 0.0, 'self_seconds': 0.0})
+                stage['count'] += 1
+                stage['seconds'] += duration
+                stage['self_seconds'] += self_time
+                for key, value in numeric:
+                    stage[key] = stage.get(key, 0) + value
+
+    def _rotate(self):
+        """ Keep one previous file next to the current one, so the trace file stays under `max_bytes`. """
+        self.file.close()
+        os.replace(self.path, self.path + ".1")
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    # * Reading
+
+    def breakdown(self, trace_id):
+        """ This function returns {span name: totals} of the spans recorded under `trace_id`. """
+        with self.lock:
+            return {name: dict(stage) for name, stage in self.traces.get(trace_id, {}).items()}
+
+    def mean(self, name):
+        """ This function returns the mean duration of a span so far, or None before the first one. """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            return histogram[-1] / histogram[-2] if histogram else None
+
+    def render_metrics(self):
+        """ This function renders the metrics in the Prometheus text exposition format. """
+        ns, lines = self.namespace, []
+        with self.lock:
+            histograms = {name: list(histogram) for name, histogram in self.histograms.items()}
+            totals = dict(self.totals)
+
+        lines.append(f"# TYPE {ns}_span_seconds histogram")
+        for name, histogram in sorted(histograms.items()):
+            for bound, count in zip(BUCKETS, histogram):
+                lines.append(f'{ns}_span_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+            lines.append(f'{ns}_span_seconds_bucket{{span="{name}",le="+Inf"}} {histogram[-2]}')
+            lines.append(f'{ns}_span_seconds_sum{{span="{name}"}} {histogram[-1]}')
+            lines.append(f'{ns}_span_seconds_count{{span="{name}"}} {histogram[-2]}')
+
+        for key in sorted(set(key for _, key in totals)):
+            lines.append(f"# TYPE {ns}_span_{key}_total counter")
+            for (name, attr), value in sorted(totals.items()):
+                if attr == key:
+                    lines.append(f'{ns}_span_{key}_total{{span="{name}"}} {value}')
+
+        for collector in self.collectors:
+            for key, value in sorted(collector().items()):
+                lines.append(f"# TYPE {ns}_{key} gauge")
+                lines.append(f"{ns}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        """ This function serves `render_metrics` at http://host:port/metrics from a daemon thread. """
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracer.render_metrics().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+# the tracer every module records to
+tracer = Tracer()
@@ -5,8 +5,12 @@ import mistune
 import bleach
 import html
 import re
+import hashlib
+from collections import OrderedDict
 from mistune.renderers import HTMLRenderer
 
+from tracing import tracer
+
 # * Set up the port
 def find_free_port():
     """ Find a free port on localhost. """
@@ -41,43 +45,137 @@ class CustomRenderer(HTMLRenderer):
         return '<pre><code class="lang-%s" style="white-space: pre-wrap;">%s</code></pre>\n' % (lang, mistune.escape(text))
 
 
+INLINE_CODE_PATTERN = re.compile(r'`[^`]+`')
+CODE_BLOCK_PATTERN = re.compile(r'```[\s\S]*?```')
+LEADING_SPACES_PATTERN = re.compile(r'^[^\S\n]+', re.MULTILINE)
+
 def remove_code_blocks(text):
     # Remove inline code
-    inline_code_pattern = r'`[^`]+`'
-    text = re.sub(inline_code_pattern, '', text)
+    text = INLINE_CODE_PATTERN.sub('', text)
 
     # Remove code blocks
-    code_block_pattern = r'```[\s\S]*?```'
-    text = re.sub(code_block_pattern, '', text)
+    text = CODE_BLOCK_PATTERN.sub('', text)
 
     # Remove leading spaces to avoid treating them as code blocks
-    text = '\n'.join([line.lstrip() for line in text.split('\n')])
+    text = LEADING_SPACES_PATTERN.sub('', text)
     
     return text
 
 
-def generate_side_by_side_html(chunk_summaries):
+_markdown = None
+
+def get_markdown():
+    """ The shared markdown parser, compiled once. """
+    global _markdown
+    if _markdown is None:
+        _markdown = mistune.create_markdown(renderer=CustomRenderer())
+    return _markdown
+
+
+class SideBySideRenderer(object):
+    """ Renders a window of the chunk/summary table, caching the HTML of each row by content hash. """
+    def __init__(self, max_rows=20000):
+        self.max_rows = max_rows
+        self.rows = OrderedDict()
+        self.lock = threading.Lock()
+
+    def render_row(self, chunk_content, summary, changed=False):
+        key = hashlib.sha1((chunk_content + "\0" + summary + ("\0changed" if changed else "")).encode('utf-8')).digest()
+        with self.lock:
+            row = self.rows.get(key)
+            if row is not None:
+                self.rows.move_to_end(key)
+                return row
+
+        markdown = get_markdown()
+        chunk_content_html = markdown(remove_code_blocks(chunk_content))
+        summary_html = markdown(remove_code_blocks(summary))
+        # changed rows get a colored left edge
+        edge = " border-left: 4px solid #f0a020;" if changed else ""
+        row = (
+            "<tr>"
+            f"<td style='width: 50%; padding: 10px; border: 1px solid #ccc;{edge} word-wrap: break-word;'>{chunk_content_html}</td>"
+            f"<td style='width: 50%; padding: 10px; border: 1px solid #ccc; word-wrap: break-word;'>{summary_html}</td>"
+            "</tr>"
+        )
+
+        with self.lock:
+            self.rows[key] = row
+            while len(self.rows) > self.max_rows:
+                self.rows.popitem(last=False)
+        return row
+
+    def render(self, chunk_summaries, start=0, limit=None):
+        """ Render rows [start, start + limit) of the table. """
+        end = len(chunk_summaries) if limit is None else min(len(chunk_summaries), start + limit)
+        with tracer.span("render", rows=max(end - start, 0)):
+            parts = ["<table style='width: 100%; border-collapse: collapse;'>"]
+            for element in chunk_summaries[start:end]:
+                parts.append(self.render_row(element["chunk_content"], element["chunk_summary"], element.get("changed", False)))
+            parts.append("</table>")
+            if start > 0 or end < len(chunk_summaries):
+                parts.append(f"<p>Paragraphs {start + 1}-{end} of {len(chunk_summaries)}</p>")
+            return "".join(parts)
+
+
+side_by_side_renderer = SideBySideRenderer()
+
+def generate_side_by_side_html(chunk_summaries, start=0, limit=None):
     """ Generate the side-by-side HTML for the summary and the source document."""
-
-    renderer = CustomRenderer()
-    markdown = mistune.create_markdown(renderer=renderer)
-
+    return side_by_side_renderer.render(chunk_summaries, start, limit)
+
+
+def generate_section_summaries_html(section_summaries):
+    """ Generate the HTML for the section summaries of each reduce level, coarsest first."""
+
+    markdown = get_markdown()
+
+    sections_html = ""
+    for level_id, level in reversed(list(enumerate(section_summaries))):
+        sections_html += f"<details><summary>Level {level_id + 1} ({len(level)} sections)</summary>"
+        for section in level:
+            start, end = section["chunk_range"]
+            summary_html = markdown(remove_code_blocks(section["summary"]))
+            sections_html += f"<p><b>Paragraphs {start + 1}-{end}</b></p>{summary_html}"
+        sections_html += "</details>"
+
+    return sections_html
+
+
+def generate_timing_html(breakdown):
+    """ Generate the HTML table of where the time of a job went, per stage (see `Tracer.breakdown`)."""
+    if not breakdown:
+        return ""
+    rows = ""
+    for name, stage in sorted(breakdown.items(), key=lambda item: -item[1]['self_seconds']):
+        tokens = stage.get('prompt_tokens', 0) + stage.get('completion_tokens', 0)
+        rows += (
+            f"<tr><td>{html.escape(name)}</td><td>{stage['count']}</td>"
+            f"<td>{stage['seconds']:.2f}</td><td>{stage['self_seconds']:.2f}</td>"
+            f"<td>{stage.get('queue_wait', 0):.2f}</td><td>{stage.get('rate_wait', 0):.2f}</td><td>{tokens}</td></tr>"
+        )
+    return (
+        "<table style='width: 100%; border-collapse: collapse;'>"
+        "<tr><th>Stage</th><th>Spans</th><th>Total (s)</th><th>Self (s)</th>"
+        "<th>Queue wait (s)</th><th>Rate limit wait (s)</th><th>Tokens</th></tr>"
+        + rows + "</table>"
+    )
+
+
+def generate_answer_html(source_chunks, answer):
+    """ Generate the side-by-side HTML for the source chunks and the answer."""
+
+    # Combine the source document and answer side by side in HTML
     side_by_side_html = "<table style='width: 100%; border-collapse: collapse;'>"
-    for element in chunk_summaries:
-        chunk_content = element["chunk_content"]
-        summary = element["chunk_summary"]
-
-        chunk_content = remove_code_blocks(chunk_content)
-        summary = remove_code_blocks(summary)
-
-        chunk_content_html = markdown(chunk_content)
-        summary_html = markdown(summary)
-
-        side_by_side_html += "<tr>"
-        side_by_side_html += f"<td style='width: 50%; padding: 10px; border: 1px solid #ccc; word-wrap: break-word;'>{chunk_content_html}</td>"
-        side_by_side_html += f"<td style='width: 50%; padding: 10px; border: 1px solid #ccc; word-wrap: break-word;'>{summary_html}</td>"
-        side_by_side_html += "</tr>"
+    html = ""
+    for chunk_id, chunk in enumerate(source_chunks):
+        html += "<p>" + chunk.page_content.replace("\n\n", "</p><p>").replace("\n", "<br>") + "</p>"
+        html += "<hr>" if chunk_id < len(source_chunks) - 1 else ""
+
+    side_by_side_html += "<tr>"
+    side_by_side_html += f"<td style='width: 50%; padding: 10px; border: 1px solid #ccc;'>{html}</td>"
+    side_by_side_html += f"<td style='width: 50%; padding: 10px; border: 1px solid #ccc;'>{answer}</td>"
+    side_by_side_html += "</tr>"
     side_by_side_html += "</table>"
 
     return side_by_side_html
-
@@ -1,107 +1,171 @@
 ###
 import gradio as gr
-import os, json 
+import os, json, time, queue, threading
+import argparse
 from functools import partial
 
 
 from model import DocumentReader
+from scheduler import FairLane
+from jobs import JobManager
+from tracing import tracer
 from utils import * 
 from prompts import * 
 ###
 
-templates = {       # Global variable to store the templates
-    "map_prompt_template": MAP_PROMPT_TEMPLATE,
-    "combine_prompt_template": COMBINE_PROMPT_TEMPLATE,
-    "refine_initial_prompt_template": PROPOSAL_REFINE_INITIAL_TEMPLATE,
-    "refine_prompt_template": PROPOSAL_REFINE_TEMPLATE,
-    "translate_prompt_template": TRANSLATE_PROMPT_TEMPLATE,
-    "query_prompt_template": QUERY_PROMPT_TEMPLATE,
-}  
+PAGE_SIZE = 50      # Number of paragraphs shown per page of the side-by-side table
+
+def render_rows(chunk_summaries, page):
+    """ This function renders one page of the side-by-side table. """
+    start = (max(int(page or 1), 1) - 1) * PAGE_SIZE
+    return generate_side_by_side_html(chunk_summaries, start=start, limit=PAGE_SIZE)
+
+def render_page(jobs, job_id, page):
+    """ This function renders one page of the side-by-side table of a job, reopening its result. """
+    job = jobs.get(job_id) if job_id else None
+    if job is None:
+        return ""
+    return render_rows(jobs.load_result(job)[1], page)
+
+def session_id(request):
+    """ This function identifies the browser session of a request. """
+    if request is None:
+        return "local"
+    return getattr(request, "session_hash", None) or request.client.host
 
 def summarize_document(
-        doc_reader, file, text, 
-        summary_option, chunk_size, temperature,
-        debug=False
+        jobs, file, text, 
+        summary_option, chunk_size, temperature, page, templates, translate_context_tokens=0,
+        refine_segments=0, refine_target_seconds=0, pack=False,
+        request: gr.Request = None,
+        poll_interval=0.5,
         ):
-    """ This function summarizes a document. 
+    """ This function summarizes a document as a background job, polling it for the side-by-side table and progress.
     
     """
-    global templates
-    # Convert the templates from Gradio to a dictionary
-    # templates_dict = {k: v.value for k, v in templates.items()}
-
     doc_path = file.name if file is not None else None
-    text_str = text
-    
-    chunks, vectordb = doc_reader.load(
-        doc_path, text_str,
-        chunk_size=chunk_size,                               
-        debug=debug
-        )
-    total_summary, chunk_summaries = doc_reader.summarize(
-        chunks, templates, 
-        summary_option=summary_option, temperature=temperature,
-        debug=debug
+    # (uploads are temporary copies; Gradio keeps the original file name aside)
+    document_name = getattr(file, "orig_name", None) if file is not None else None
+    # (chunk size 0 on the slider is "auto": the largest chunks the model context allows, see `chunk_budget`)
+    job = jobs.submit(
+        doc_path, text, templates,
+        summary_option=summary_option, chunk_size=chunk_size or None, temperature=temperature,
+        translate_context_tokens=int(translate_context_tokens or 0),
+        refine_segments=int(refine_segments or 0) or None, refine_target_seconds=refine_target_seconds or None,
+        pack=bool(pack), user=session_id(request),
+        document_name=os.path.basename(document_name) if document_name else None,
         )
 
-    # Combine the original paragraphs and summaries side by side in HTML
-    side_by_side_html = generate_side_by_side_html(chunk_summaries)
-    # side_by_side_md = generate_side_by_side_markdown(chunk_summaries)
+    while True:
+        finished = not job.is_scheduled()
+        total_summary, chunk_summaries, section_summaries = jobs.load_result(job)
+
+        # Combine the original paragraphs and summaries side by side in HTML
+        side_by_side_html = render_rows(chunk_summaries, page)
+        # side_by_side_md = generate_side_by_side_markdown(chunk_summaries)
+        sections_html = generate_section_summaries_html(section_summaries)
+    
+        timing_html = generate_timing_html(jobs.breakdown(job))
     
-    return side_by_side_html, total_summary
+        yield side_by_side_html, total_summary, sections_html, job.describe(), job.job_id, timing_html
+        if finished:
+            return
+        time.sleep(poll_interval)
+
+def estimate_summary(doc_reader, file, text, summary_option, chunk_size, templates):
+    """ This function reports the chunks, LLM calls and tokens a summary will take, before it starts. """
+    doc_path = file.name if file is not None else None
+    if doc_path is None and not text:
+        return "No document"
+    plan = doc_reader.plan(doc_path, text, templates, summary_option=summary_option, chunk_size=chunk_size or None)
+    return "{chunks} chunks of up to {chunk_size} tokens: {calls} calls, {total_tokens} tokens at most".format(**plan)
+
+def cancel_summary(jobs, job_id):
+    """ This function cancels the summary job of the session. """
+    job = jobs.cancel(job_id) if job_id else None
+    return job.describe() if job is not None else "No running job"
 
 
 def ask_document(
-        doc_reader, file, text, query, 
-        chunk_size, temperature,
+        doc_reader, lanes, file, text, query, 
+        chunk_size, temperature, templates, retrieval="hybrid",
+        request: gr.Request = None,
         debug=False
         ):
-    """ This function answers a question about a document.
+    """ This function answers a question about a document, streaming the answer as its tokens arrive.
     
     """
-    global templates
-
     doc_path = file.name if file is not None else None
     text_str = text
-
-    chunks, vectordb = doc_reader.load(
-        doc_path, text_str,
-        chunk_size=chunk_size,                               
-        debug=debug
-        )
-
-    answer, source_chunks = doc_reader.ask(
-        query, vectordb, templates,
-        temperature=temperature,
-        debug=debug,
-        )
-
-    # Combine the source document and answer side by side in HTML
-    side_by_side_html = "<table style='width: 100%; border-collapse: collapse;'>"
-    html = ""
-    for chunk_id, chunk in enumerate(source_chunks):
-        html += "<p>" + chunk.page_content.replace("\n\n", "</p><p>").replace("\n", "<br>") + "</p>"
-        html += "<hr>" if chunk_id < len(source_chunks) - 1 else ""
-
-    side_by_side_html += "<tr>"
-    side_by_side_html += f"<td style='width: 50%; padding: 10px; border: 1px solid #ccc;'>{html}</td>"
-    side_by_side_html += f"<td style='width: 50%; padding: 10px; border: 1px solid #ccc;'>{answer}</td>"
-    side_by_side_html += "</tr>"
-    side_by_side_html += "</table>"
-
-    return side_by_side_html, answer
-
-def update_prompt_templates(key, value):
-    global templates
-    templates[key] = value
+    updates, failed = queue.Queue(), []
+
+    def run():
+        lanes["ask"].acquire(session_id(request))
+        try:
+            chunks, retriever = doc_reader.load(
+                doc_path, text_str,
+                chunk_size=doc_reader.ask_chunk_size(doc_path, text_str, chunk_size, templates=templates),
+                )
+            for answer, source_chunks in doc_reader.ask_stream(
+                    query, retriever, templates,
+                    temperature=temperature, retrieval=retrieval,
+                    debug=debug,
+                    ):
+                updates.put((generate_answer_html(source_chunks, answer), answer))
+        except Exception as e:
+            failed.append(e)
+        finally:
+            lanes["ask"].release()
+            updates.put(None)
+
+    # (the slot is released when the answer ends, whether or not the page still reads it)
+    threading.Thread(target=run, daemon=True).start()
+    yield from iter(updates.get, None)
+    if failed:
+        raise failed[0]
+
+def update_prompt_templates(key, templates, value):
+    """ This function updates one prompt template of the session. """
+    return dict(templates, **{key: value})
 
 # def update_prompt_templates(element):
 #     global templates
 #     print (element)
 
 def main():
+    parser = argparse.ArgumentParser(description="GPT-Book Reader web UI")
+    parser.add_argument("--summarize-workers", type=int, default=2, help="Summaries running at once")
+    parser.add_argument("--max-jobs", type=int, default=16, help="Summary jobs queued or running at once")
+    parser.add_argument("--ask-workers", type=int, default=8, help="Questions answered at once")
+    parser.add_argument("--queue-workers", type=int, default=64, help="Requests the Gradio queue admits at once")
+    parser.add_argument("--trace-file", default=os.path.join("db", "traces.jsonl"), help="JSON lines file of the per-stage spans")
+    parser.add_argument("--metrics-port", type=int, default=9464, help="Port of the Prometheus /metrics endpoint (0 to disable)")
+    parser.add_argument("--embedding-model", default="text-embedding-ada-002", help='OpenAI embedding model, or "local:<model>" to embed on the CPU')
+    parser.add_argument("--store-gb", type=float, default=None, help="Disk quota of the document collections (least recently used evicted first)")
+    args = parser.parse_args()
+
     # * Initialize the document reader
-    doc_reader = DocumentReader()
+    doc_reader = DocumentReader(
+        embedding_model=args.embedding_model,
+        trace_path=args.trace_file or None,
+        max_store_bytes=int(args.store_gb * (1 << 30)) if args.store_gb else None,
+        )
+
+    # * Per-stage metrics, scraped next to the app
+    tracer.add_collector(doc_reader.metrics)
+    if args.metrics_port:
+        tracer.serve(args.metrics_port)
+        print(f"Metrics http://localhost:{args.metrics_port}/metrics")
+
+    # * Separate lanes, so short questions never wait behind long summaries
+    lanes = {
+        "summarize": FairLane(args.summarize_workers),
+        "ask": FairLane(args.ask_workers),
+    }
+
+    # * Summaries run as background jobs; the ones cut short by a restart pick up from their checkpoints
+    jobs = JobManager(doc_reader, max_jobs=args.max_jobs, lane=lanes["summarize"])
+    jobs.resume()
 
     # * Create the Gradio interface
     with open("assets/style.css", "r", encoding="utf-8") as f:
@@ -118,12 +182,24 @@ def main():
             with gr.Row(scale=1):
                 with gr.Column():
                     summary_btn = gr.Button("📝Summarize")
+                    estimate_btn = gr.Button("Estimate")
+                    cancel_btn = gr.Button("Cancel")
+                    progress_output = gr.Textbox(label="Progress", interactive=False)
                 with gr.Column():
                     summary_output = gr.outputs.Textbox(label="Summary").style(height="80%")
+            with gr.Row(scale=2):
+                sections_summary_output = gr.HTML(
+                    label="Section Summaries", elem_classes='output', elem_id='sections_summary_output',
+                    )
             with gr.Row(scale=5):
                 chunks_summary_output = gr.HTML(
                     label="Paragraphs and Summaries", elem_classes='output', elem_id='chunks_summary_output',
                     )
+            with gr.Row(scale=1):
+                chunks_page = gr.Number(label="Page", value=1, precision=0, interactive=True)
+            with gr.Row(scale=1):
+                timing_output = gr.HTML(label="Time per Stage", elem_classes='output', elem_id='timing_output')
+            job_state = gr.State(None)
         
         with gr.Tab(label="Ask"):
             with gr.Row(scale=1):
@@ -151,46 +227,66 @@ def main():
             with gr.Row(label="Model Options"):
                 with gr.Column():
                     chunk_size = gr.Slider(
-                        label="Chunk Size",
-                        minimum=100, maximum=3000, step=100,
-                        value=1000, interactive=True,
+                        label="Chunk Size (0 = as large as the model context allows)",
+                        minimum=0, maximum=3000, step=100,
+                        value=0, interactive=True,
                         )
                     temperature = gr.Slider(
                         label="Temperature",
                         minimum=0.0, maximum=1.0, step=0.01,
                         value=0.0, interactive=True,
                         )
+                    retrieval = gr.Radio(
+                        label="Retrieval (lexical needs no embedding call)",
+                        choices=['hybrid', 'lexical', 'vector'],
+                        value="hybrid", interactive=True,
+                        )
                     
             with gr.Row(label="Summarization Options"):
                 with gr.Row():
                     summary_option = gr.Radio(
                         label="Summary Option",
-                        choices =['map_reduce', 'refine', 'translate'],
+                        choices =['map_reduce', 'refine', 'segmented_refine', 'translate'],
                         # label=["分段摘要", "逐步总结"],
                         value="map_reduce", interactive=True,
                         )
+                    pack = gr.Checkbox(label="Pack small chunks into one request (map_reduce, translate)", value=False, interactive=True)
                 with gr.Row():
                     
                     with gr.Tab(label="Map-Reduce Options") as map_reduce_tab:
                         with gr.Column():
-                            map_prompt_template = gr.Textbox(label="Map Prompt Template", value=MAP_PROMPT_TEMPLATE, lines=5, interactive=True, on_change=lambda value: update_prompt_templates("map_prompt_template", value))
-                            map_prompt_template.change(update_prompt_templates, map_prompt_template)
+                            map_prompt_template = gr.Textbox(label="Map Prompt Template", value=MAP_PROMPT_TEMPLATE, lines=5, interactive=True)
                         with gr.Column():
-                            combine_prompt_template = gr.Textbox(label="Combine Prompt Template", value=COMBINE_PROMPT_TEMPLATE, lines=5, interactive=True, on_change=lambda value: update_prompt_templates("combine_prompt_template", value))
+                            combine_prompt_template = gr.Textbox(label="Combine Prompt Template", value=COMBINE_PROMPT_TEMPLATE, lines=5, interactive=True)
                     with gr.Tab(label="Refine Options") as refine_tab:
                         with gr.Column():
-                            refine_initial_prompt_template = gr.Textbox(label="Initial Prompt Template", value=PROPOSAL_REFINE_INITIAL_TEMPLATE, lines=5, interactive=True, on_change=lambda value: update_prompt_templates("refine_initial_prompt_template", value))
+                            refine_initial_prompt_template = gr.Textbox(label="Initial Prompt Template", value=PROPOSAL_REFINE_INITIAL_TEMPLATE, lines=5, interactive=True)
+                        with gr.Column():
+                            refine_prompt_template = gr.Textbox(label="Refine Prompt Template", value=PROPOSAL_REFINE_TEMPLATE, lines=5, interactive=True)
                         with gr.Column():
-                            refine_prompt_template = gr.Textbox(label="Refine Prompt Template", value=PROPOSAL_REFINE_TEMPLATE, lines=5, interactive=True, on_change=lambda value: update_prompt_templates("refine_prompt_template", value))
+                            refine_merge_prompt_template = gr.Textbox(label="Merge Prompt Template (segmented refine)", value=PROPOSAL_MERGE_TEMPLATE, lines=5, interactive=True)
+                            refine_segments = gr.Slider(
+                                label="Segments refined in parallel (0 = auto)",
+                                minimum=0, maximum=32, step=1,
+                                value=0, interactive=True,
+                                )
+                            refine_target_seconds = gr.Number(label="Target time in seconds for auto segments (0 = none)", value=0, interactive=True)
 
                     with gr.Tab(label="Trasnlation Options"):
                         with gr.Column():
-                            translate_prompt_template = gr.Textbox(label="Translate Prompt Template", value=TRANSLATE_PROMPT_TEMPLATE, lines=5, interactive=True, on_change=lambda value: update_prompt_templates("translate_prompt_template", value))
+                            translate_prompt_template = gr.Textbox(label="Translate Prompt Template", value=TRANSLATE_PROMPT_TEMPLATE, lines=5, interactive=True)
+                        with gr.Column():
+                            translate_context_prompt_template = gr.Textbox(label="Translate With Context Prompt Template", value=TRANSLATE_CONTEXT_PROMPT_TEMPLATE, lines=5, interactive=True)
+                            translate_context_tokens = gr.Slider(
+                                label="Context Tokens (end of the previous paragraph, 0 to disable)",
+                                minimum=0, maximum=500, step=50,
+                                value=0, interactive=True,
+                                )
 
 
                     with gr.Tab(label="Question Answering Options"):
                         with gr.Column():
-                            query_prompt_template = gr.Textbox(label="Query Prompt Template", value=QUERY_PROMPT_TEMPLATE, lines=5, interactive=True, on_change=lambda value: update_prompt_templates("query_prompt_template", value))  
+                            query_prompt_template = gr.Textbox(label="Query Prompt Template", value=QUERY_PROMPT_TEMPLATE, lines=5, interactive=True)  
 
         # templates = {map_prompt_template, combine_prompt_template, refine_initial_prompt_template, refine_prompt_template, translate_prompt_template, query_prompt_template}
 
@@ -207,6 +303,24 @@ def main():
         #     'query_prompt_template': query_prompt_template,
         #     })
         
+        # * Each browser session edits its own copy of the templates
+        templates_state = gr.State(dict(DEFAULT_TEMPLATES))
+        for key, textbox in [
+                ("map_prompt_template", map_prompt_template),
+                ("combine_prompt_template", combine_prompt_template),
+                ("refine_initial_prompt_template", refine_initial_prompt_template),
+                ("refine_prompt_template", refine_prompt_template),
+                ("refine_merge_prompt_template", refine_merge_prompt_template),
+                ("translate_prompt_template", translate_prompt_template),
+                ("translate_context_prompt_template", translate_context_prompt_template),
+                ("query_prompt_template", query_prompt_template),
+                ]:
+            textbox.change(
+                fn=partial(update_prompt_templates, key),
+                inputs=[templates_state, textbox],
+                outputs=[templates_state],
+            )
+
         # * Trigger the events
         # def update_tabs(summary_option, map_reduce_tab, refine_tab):
         #     if summary_option == 'map_reduced':
@@ -220,14 +334,35 @@ def main():
         #     outputs=[map_reduce_tab, refine_tab])
 
         summary_btn.click(
-            fn=partial(summarize_document, doc_reader, debug=False),
-            inputs=[file_input, text_input, summary_option, chunk_size, temperature],
-            outputs=[chunks_summary_output, summary_output],
+            fn=partial(summarize_document, jobs),
+            inputs=[
+                file_input, text_input, summary_option, chunk_size, temperature, chunks_page, templates_state,
+                translate_context_tokens, refine_segments, refine_target_seconds, pack,
+                ],
+            outputs=[chunks_summary_output, summary_output, sections_summary_output, progress_output, job_state, timing_output],
+        )
+
+        estimate_btn.click(
+            fn=partial(estimate_summary, doc_reader),
+            inputs=[file_input, text_input, summary_option, chunk_size, templates_state],
+            outputs=[progress_output],
+        )
+
+        cancel_btn.click(
+            fn=partial(cancel_summary, jobs),
+            inputs=[job_state],
+            outputs=[progress_output],
+        )
+
+        chunks_page.change(
+            fn=partial(render_page, jobs),
+            inputs=[job_state, chunks_page],
+            outputs=[chunks_summary_output],
         )
 
         ask_btn.click(
-            fn=partial(ask_document, doc_reader, debug=False),
-            inputs=[file_input, text_input, ask_input, chunk_size, temperature],
+            fn=partial(ask_document, doc_reader, lanes, debug=False),
+            inputs=[file_input, text_input, ask_input, chunk_size, temperature, templates_state, retrieval],
             outputs=[chunks_ask_output, ask_output],
         )
 
@@ -237,7 +372,7 @@ def main():
     PORT = find_free_port()
     print(f"URL http://localhost:{PORT}")
     auto_opentab_delay(PORT)
-    demo.queue().launch(server_name="0.0.0.0", share=False, server_port=PORT)
+    demo.queue(concurrency_count=args.queue_workers).launch(server_name="0.0.0.0", share=False, server_port=PORT)
 
 
 if __name__ == "__main__":